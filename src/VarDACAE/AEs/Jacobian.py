@@ -1,8 +1,86 @@
 import torch
 
 class Jacobian():
-    """Jacobian helpers. These are ***SLOW*** methods of
-    getting Network Jacobian (when AE.jac_explicit() is not implemented)"""
+    """Jacobian helpers for when AE.jac_explicit() is not implemented.
+    The accumulated_slow* methods are ***SLOW*** (one autograd pass per output).
+    Jacobian.vmap_model() uses batched jvps/vjps (torch.func) instead."""
+
+    @staticmethod
+    def vmap_model(inputs, model, device=None, mode="auto", max_bytes=2 ** 28, out_idx=None):
+        """Computes the jacobian of model.decode at `inputs` with vmapped
+        forward-mode (jvp) or reverse-mode (vjp) products.
+        Basis vectors are processed in chunks so that the (estimated) memory
+        of the intermediate activations stays below `max_bytes`.
+        args
+            :inputs - latent vector (L,) or batch (B x L)
+            :mode - "fwd", "rev" or "auto". "auto" uses forward mode when
+                the input size L is less than or equal to the output size n
+                (i.e. L jvps instead of n vjps)
+            :out_idx (opt) - only return the rows of the jacobian for these
+                (flattened) outputs e.g. the observation locations
+        returns
+            :jac - tensor (n x L) or (B x n x L) for batched input"""
+        if device == None:
+            device = inputs.device
+        model.to(device)
+        inputs = inputs.detach().to(device)
+
+        if len(inputs.shape) > 1:
+            return torch.stack([Jacobian.vmap_model(z, model, device, mode, max_bytes, out_idx)
+                                for z in inputs])
+        if out_idx is not None:
+            out_idx = torch.as_tensor(out_idx, device=device)
+
+        def decode(z):
+            out = model.decode(z).flatten()
+            return out if out_idx is None else out[out_idx]
+
+        act_numel = Jacobian.__activation_numel(model, decode, inputs)
+        with torch.no_grad():
+            n = decode(inputs).numel()
+        L = inputs.numel()
+
+        if mode == "auto":
+            mode = "fwd" if L <= n else "rev"
+        #primal + tangent activations per basis vector
+        bytes_per_vec = 2 * act_numel * inputs.element_size()
+        chunk = max(1, int(max_bytes // max(bytes_per_vec, 1)))
+
+        if mode == "fwd":
+            jvp_fn = lambda v: torch.func.jvp(decode, (inputs,), (v,))[1]
+            eye = torch.eye(L, dtype=inputs.dtype, device=device)
+            cols = [torch.func.vmap(jvp_fn)(eye[i:i + chunk]) for i in range(0, L, chunk)]
+            jac = torch.cat(cols, dim=0).t()
+        elif mode == "rev":
+            _, vjp_fn = torch.func.vjp(decode, inputs)
+            rows = []
+            for i in range(0, n, chunk):
+                i_end = min(i + chunk, n)
+                E = torch.zeros((i_end - i, n), dtype=inputs.dtype, device=device)
+                E[torch.arange(i_end - i), torch.arange(i, i_end)] = 1
+                rows.append(torch.func.vmap(vjp_fn)(E)[0])
+            jac = torch.cat(rows, dim=0)
+        else:
+            raise ValueError("mode = {} is not allowed. Must be in {{fwd, rev, auto}}".format(mode))
+        return jac.detach()
+
+    @staticmethod
+    def __activation_numel(model, fn, inputs):
+        """Returns the number of elements in all intermediate (leaf module)
+        outputs for one call of fn(inputs)"""
+        numel = [0]
+        def hook(module, inp, out):
+            if isinstance(out, torch.Tensor):
+                numel[0] += out.numel()
+        handles = [m.register_forward_hook(hook) for m in model.modules()
+                        if len(list(m.children())) == 0]
+        try:
+            with torch.no_grad():
+                fn(inputs)
+        finally:
+            for h in handles:
+                h.remove()
+        return max(numel[0], inputs.numel())
     @staticmethod
     def accumulated_slow_model(inputs, model, device=None):
         inputs.requires_grad = True
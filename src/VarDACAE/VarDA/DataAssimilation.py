@@ -1,6 +1,7 @@
 """All VarDA ingesting and evaluation helpers"""
 
 import numpy as np
+import copy
 import os
 import random
 import torch
@@ -8,21 +9,34 @@ from scipy.optimize import minimize
 
 from VarDACAE import ML_utils
 from VarDACAE.AEs import Jacobian
+from VarDACAE.AEs import BaseAE
 from VarDACAE import fluidity
 from VarDACAE import SplitData
 from VarDACAE.VarDA import VDAInit
 from VarDACAE.VarDA import SVD
-from VarDACAE.VarDA.cost_fn import cost_fn_J, grad_J
+from VarDACAE.VarDA.direct_solver import DirectSolver, NestedDirectSolver
+from VarDACAE.VarDA.reg_path import RegPathSolver
+from VarDACAE.VarDA.svd_cache import SVDCache
+from VarDACAE.VarDA.torch_solver import TorchLBFGS
+from VarDACAE.VarDA.gauss_newton import GaussNewtonSolver
+from VarDACAE.VarDA.operators import IdentityOperator, get_H
+from VarDACAE.VarDA.profiler import DAProfiler
+from VarDACAE.VarDA.cost_fn import cost_and_grad_J, cost_and_grad_J_batch, get_AE_grad_mode
 import time
 
 class DAPipeline():
     """Class to hold pipeline functions for Variational DA
     """
 
-    def __init__(self, settings, AEmodel=None, u_c=None):
+    def __init__(self, settings, AEmodel=None, u_c=None, data=None):
+        """If `data` is provided (e.g. a previously initialized data dict)
+        the VDAInit routine is not run"""
         self.settings = settings
-        vda_initilizer = VDAInit(self.settings, AEmodel, u_c=u_c)
-        self.data = vda_initilizer.run()
+        if data is not None:
+            self.data = data
+        else:
+            vda_initilizer = VDAInit(self.settings, AEmodel, u_c=u_c)
+            self.data = vda_initilizer.run()
 
     def run(self, return_stats=False):
         """Runs the variational DA routine using settings from the passed config class
@@ -54,7 +68,17 @@ class DAPipeline():
 
 
 
-    def DA_AE(self, force_init=False, save_vtu=False):
+    def DA_AE(self, force_init=False, save_vtu=False, profiler=None):
+        profiler = profiler if profiler is not None else DAProfiler.from_settings(self.settings)
+        with profiler.phase("setup"):
+            self.init_AE(force_init)
+        DA_results = self.perform_VarDA(self.data, self.settings, save_vtu=save_vtu,
+                                        profiler=profiler)
+        return DA_results
+
+    def init_AE(self, force_init=False):
+        """Initializes the AE background matrices in self.data (if not already
+        initialized) without performing any assimilation"""
         if self.data.get("model") == None or force_init:
             self.model = ML_utils.load_model_from_settings(self.settings, self.data.get("device"))
             self.data["model"] = self.model
@@ -70,137 +94,455 @@ class DAPipeline():
                 self.data["V_trunc"] = V_red.T #tau x M
 
                 self.data["w_0"] = np.zeros((V_red.shape[0]))
-                if self.data["G"] is 1:
-                    self.data["G_V"] =self.data["V_trunc"]
-                else:
-                    self.data["G_V"] = (self.data["G"] @ self.data["V_trunc"] ).astype(float)
+                self.data["G_V"] = (self.data["G"] @ self.data["V_trunc"] ).astype(float)
 
             self.data["V_grad"] = None
         else:
-
-            # Now access explicit gradient function
-            self.data["V_grad"] = self.__maybe_get_jacobian()
-
-        DA_results = self.perform_VarDA(self.data, self.settings, save_vtu=save_vtu)
+            grad_mode = get_AE_grad_mode(self.settings)
+            if grad_mode == "vjp":
+                #gradient by backpropagation through model.decode (see cost_fn.py)
+                self.data["V_grad"] = None
+            elif grad_mode == "jacobian":
+                # Now access explicit gradient function
+                self.data["V_grad"] = self.__maybe_get_jacobian()
+            else:
+                raise ValueError("AE_GRAD_MODE = {} is not allowed.".format(grad_mode))
+        return self.data
+
+    def DA_SVD(self, force_init=False, save_vtu=False, profiler=None):
+        profiler = profiler if profiler is not None else DAProfiler.from_settings(self.settings)
+        with profiler.phase("setup"):
+            self.init_SVD(force_init)
+        DA_results = self.perform_VarDA(self.data, self.settings, save_vtu=save_vtu,
+                                        profiler=profiler)
         return DA_results
 
-    def DA_SVD(self, force_init=False, save_vtu=False):
-        if self.data.get("V") is None or force_init:
-            V = VDAInit.create_V_from_X(self.data.get("train_X"), self.settings)
-
-            if self.settings.THREE_DIM:
-                #(M x nx x ny x nz)
-                V = V.reshape((V.shape[0], -1)).T #(n x M)
-            else:
-                #(M x n)
-                V = V.T #(n x M)
+    def init_SVD(self, force_init=False):
+        """Initializes the TSVD background matrices in self.data (if not already
+        initialized) without performing any assimilation"""
+        if (self.data.get("V") is None and self.data.get("U") is None) or force_init:
+            if SVD.get_SVD_method(self.settings) == "snapshots":
+                #out-of-core: stream X from disk rather than using train_X
+                U, s, W = SVD.snapshot_TSVD(self.settings.get_X_fp(), self.settings,
+                                            self.settings.get_number_modes())
+                self.data["V"] = None
+                self.__set_SVD_background(U, s, W)
+                return self.data
+
+            if SVDCache.use_cache(self.settings):
+                #content-addressed cache: the full V is only created on a cache miss
+                cache = SVDCache(self.settings)
+                U, s, W = cache.get_TSVD(self.data.get("train_X"), self.__create_V,
+                                        self.settings, self.settings.get_number_modes())
+                self.data["V"] = None
+                self.__set_SVD_background(U, s, W)
+                return self.data
+
+            V = self.__create_V()
             V_trunc, U, s, W = SVD.TSVD(V, self.settings, self.settings.get_number_modes())
 
-            #Define intial w_0
-            V_trunc_plus = SVD.SVD_V_trunc_plus(U, s, W, self.settings.get_number_modes())
-            if self.settings.NORMALIZE:
-                w_0 = V_trunc_plus @ np.zeros_like(self.data["u_0"].flatten()) #i.e. this is the value given in Rossella et al (2019).
-            else:
-                w_0 = V_trunc_plus @ self.data["u_0"].flatten()
-            #w_0 = np.zeros((W.shape[-1],)) #TODO - I'm not sure about this - can we assume is it 0?
-
-            self.data["V_trunc"] = V_trunc
             self.data["V"] = V
-            self.data["w_0"] = w_0
-            self.data["V_grad"] = None
+            self.__set_SVD_background(U, s, W, V_trunc)
+        return self.data
+
+    def init_SVD_modes(self, num_modes):
+        """Returns TSVD factors U, s, W with at least `num_modes` modes (the
+        full SVD is used if num_modes = -1). The factors in self.data are
+        used if they have enough modes. Otherwise the factors are computed
+        in a copy of self.data so the background used by DA_SVD (i.e. V_trunc,
+        G_V and w_0 with settings.NUMBER_MODES) is unchanged"""
+        U = self.data.get("U")
+        if num_modes == -1:
+            train_X = self.data.get("train_X")
+            num_modes = min(train_X.shape[0], int(np.prod(train_X.shape[1:])))
+        if U is not None and U.shape[1] >= num_modes:
+            return U, self.data["s"], self.data["W"]
+        settings = copy.copy(self.settings)
+        settings.NUMBER_MODES = num_modes
+        data = DAPipeline(settings, data=dict(self.data)).init_SVD(force_init=True)
+        return data["U"], data["s"], data["W"]
+
+    def DA_SVD_levels(self, levels, save_vtu=False):
+        """Performs TSVD-VarDA for every truncation level (number of modes)
+        in `levels` (use -1 for all modes) with a single factorisation
+        (see NestedDirectSolver) so the cost is that of the largest level.
+        returns
+            :dict {level: DA_results}. Each DA_results has `time_online` (the
+            level's solve, decode and unnorm) and `time_factorise` (shared)"""
+        settings = self.settings
+        if settings.COMPRESSION_METHOD != "SVD":
+            raise ValueError("DA_SVD_levels requires COMPRESSION_METHOD = 'SVD'")
+        U, s, W = self.init_SVD_modes(-1 if -1 in levels else max(levels))
+        U, s, W = np.asarray(U), np.asarray(s), np.asarray(W)
+        ks = [len(s) if k == -1 else k for k in levels]
+        K = max(ks)
+
+        t1 = time.time()
+        G_z = get_H(self.data) @ U[:, :K] * s[:K]
+        solver = NestedDirectSolver(G_z, settings.ALPHA, self.data.get("R_inv"),
+                                    settings.OBS_VARIANCE)
+        t_fact = time.time() - t1
+
+        Z = solver.solve(np.asarray(self.data.get("d")), ks)
+        results = {}
+        for level, k in zip(levels, ks):
+            t2 = time.time()
+            z = Z[k]
+            w_opt = W[:k].T @ z
+            delta_u_DA = U[:, :k] @ (s[:k] * z)
+            DA_results = self.calc_DA_stats(delta_u_DA, w_opt, self.data, settings,
+                                            save_vtu=save_vtu)
+            t3 = DA_results.pop("t_unnorm")
+            DA_results["time_online"] = t3 - t2
+            DA_results["time_factorise"] = t_fact
+            DA_results["num_modes"] = k
+            results[level] = DA_results
+        return results
+
+    def select_alpha(self, alphas, method="gcv", d=None):
+        """Selects ALPHA from the grid `alphas` (for settings.OBS_VARIANCE)
+        with the GCV function or the L-curve (see RegPathSolver). Uses the
+        innovation d in self.data unless `d` (nobs,) or (B x nobs) is given.
+        The SVD of G_V is cached in self.data so subsequent calls
+        (with the same observations) are O(k) per alpha.
+        returns
+            :alpha_opt, path"""
+        settings = self.settings
+        if settings.COMPRESSION_METHOD == "SVD":
+            self.init_SVD()
+        elif settings.COMPRESSION_METHOD == "AE" and settings.REDUCED_SPACE:
+            self.init_AE()
+        else:
+            raise ValueError("select_alpha requires a cost function that is quadratic in w (i.e. not for full-space AE)")
+        if self.data.get("R_inv") is not None:
+            raise NotImplementedError("select_alpha is only implemented for R = OBS_VARIANCE * I")
+
+        solver = RegPathSolver.from_data(self.data)
+        d = np.asarray(self.data.get("d") if d is None else d)
+        return solver.select_alpha(d, alphas, settings.OBS_VARIANCE, method)
+
+    def update_obs_network(self, obs_idx=None, add_idx=(), remove_idx=()):
+        """Changes the observation locations to `obs_idx` (or to the current
+        locations plus `add_idx` minus `remove_idx`) for TSVD-VarDA. The cached
+        DirectSolver factorisation is updated by rank-one updates/downdates
+        (see DirectSolver.update_network) so that a few sensors changing costs
+        O(k^2) per sensor (plus an O(nobs * k) copy of the stored rows). The observations and d are taken from data["u_c"]
+        (and the batched innovations D from data["U_c"] if they were set)"""
+        settings = self.settings
+        if settings.COMPRESSION_METHOD != "SVD":
+            raise ValueError("update_obs_network requires COMPRESSION_METHOD = 'SVD'")
+        if self.data.get("obs_agg") is not None:
+            raise NotImplementedError("update_obs_network is not implemented for super-observations (SUPEROBS_FACTOR)")
+        self.init_SVD()
+        data = self.data
+        if obs_idx is None:
+            obs_idx = np.setdiff1d(data.get("obs_idx"), remove_idx)
+            obs_idx = np.union1d(obs_idx, np.asarray(add_idx, dtype=np.int64))
+
+        solver = DirectSolver.from_data(data, settings)
+        data["G_V"] = solver.update_network(data["V_trunc"], obs_idx)
+        data["obs_idx"] = solver.obs_idx
+
+        u_c = data.get("u_c").flatten()
+        data["observations"] = u_c[solver.obs_idx]
+        data["d"] = data["observations"] - data["u_0"].flatten()[solver.obs_idx]
+        if data.get("U_c") is not None:
+            data = VDAInit.provide_u_c_batch_update_data(data, settings, data["U_c"])
+        else:
+            data.pop("D", None)
+        return data
 
-            if self.data.get("G") is 1:
-                self.data["G_V"] = self.data["V_trunc"]
-            elif self.data.get("G") is None:
-                assert self.data.get("obs_idx") is not None
-                self.data["G_V"] = self.data["V_trunc"][self.data.get("obs_idx")]
+    def __create_V(self):
+        """Returns the (n x M) matrix of (centred) training snapshots"""
+        V = VDAInit.create_V_from_X(self.data.get("train_X"), self.settings)
+
+        if self.settings.THREE_DIM:
+            #(M x nx x ny x nz)
+            V = V.reshape((V.shape[0], -1)).T #(n x M)
+        else:
+            #(M x n)
+            V = V.T #(n x M)
+        return V
+
+    def update_SVD(self, X_new, forget=1.0, max_rank=None):
+        """Appends new snapshots to the SVD background using an incremental
+        (Brand) update of the stored U, s, W factors. The cost is proportional
+        to the size of the update rather than to the number of snapshots.
+        args
+            :X_new - new (un-normalized) snapshots (B x n) or (B x nx x ny x nz).
+                These are normalized/centred with the training set mean and std.
+            :forget - forgetting factor in (0, 1] applied to existing snapshots
+            :max_rank - rank of updated factors (defaults to the current rank)
+        """
+        self.init_SVD()
+
+        C = X_new.reshape((X_new.shape[0], -1)) - self.data.get("mean").flatten()
+        if self.settings.NORMALIZE:
+            C = C / self.data.get("std").flatten()
+
+        U, s, W = SVD.incremental_SVD_update(self.data["U"], self.data["s"],
+                                    self.data["W"], C.T, forget, max_rank)
+
+        self.data["V"] = None #full V is no longer consistent with the background
+        self.__set_SVD_background(U, s, W)
+        return self.data
+
+    def __set_SVD_background(self, U, s, W, V_trunc=None):
+        """Sets the TSVD background matrices and initial w_0 in self.data
+        from the (truncated) factors U, s, W"""
+        if V_trunc is None:
+            V_trunc = SVD.SVD_V_trunc(U, s, W)
+
+        #Define intial w_0
+        V_trunc_plus = SVD.SVD_V_trunc_plus(U, s, W)
+        if self.settings.NORMALIZE:
+            w_0 = V_trunc_plus @ np.zeros_like(self.data["u_0"].flatten()) #i.e. this is the value given in Rossella et al (2019).
+        else:
+            w_0 = V_trunc_plus @ self.data["u_0"].flatten()
+        #w_0 = np.zeros((W.shape[-1],)) #TODO - I'm not sure about this - can we assume is it 0?
+
+        self.data["U"], self.data["s"], self.data["W"] = U, s, W
+        self.data["V_trunc"] = V_trunc
+        self.data["w_0"] = w_0
+        self.data["V_grad"] = None
+
+        if isinstance(self.data.get("G"), IdentityOperator):
+            self.data["G_V"] = self.data["V_trunc"]
+        elif self.data.get("G") is None:
+            assert self.data.get("obs_idx") is not None
+            self.data["G_V"] = self.data["V_trunc"][self.data.get("obs_idx")]
+            if self.data.get("obs_agg") is not None: #super-observations
+                self.data["G_V"] = self.data["obs_agg"] @ self.data["G_V"]
+        else:
+            raise ValueError("G has be deprecated in favour of `obs_idx`. It should be None")
+
+    def DA_batch(self, control_states, save_vtu=False, profiler=None):
+        """Assimilates a batch of control states (B x n) or (B x nx x ny x nz)
+        with a single vectorised minimisation. Returns a list of DA_results.
+        All states must share the same observation locations (i.e. OBS_MODE
+        must be `rand` or `all`)"""
+        settings = self.settings
+        profiler = profiler if profiler is not None else DAProfiler.from_settings(self.settings)
+        with profiler.phase("obs"):
+            if settings.REDUCED_SPACE:
+                self.data = VDAInit.provide_u_c_update_data_reduced_AE(self.data,
+                                                        settings, control_states[0])
             else:
-                raise ValueError("G has be deprecated in favour of `obs_idx`. It should be None")
-        DA_results = self.perform_VarDA(self.data, self.settings, save_vtu=save_vtu)
-        return DA_results
+                self.data = VDAInit.provide_u_c_update_data_full_space(self.data,
+                                                        settings, control_states[0])
+
+        with profiler.phase("setup"):
+            if settings.COMPRESSION_METHOD == "SVD":
+                self.init_SVD()
+            elif settings.COMPRESSION_METHOD == "AE":
+                if not settings.REDUCED_SPACE:
+                    raise NotImplementedError("Batched DA is only available when the cost function is linear in w (i.e. not for full-space AE)")
+                self.init_AE()
+            else:
+                raise ValueError("COMPRESSION_METHOD must be in {SVD, AE}")
 
+        with profiler.phase("obs"):
+            self.data = VDAInit.provide_u_c_batch_update_data(self.data, settings, control_states)
+        return self.perform_VarDA_batch(self.data, settings, save_vtu=save_vtu,
+                                        profiler=profiler)
 
     @staticmethod
-    def perform_VarDA(data, settings, save_vtu=False):
-        """This is a static method so that it can be performed in AE_train with user specified data"""
-        timing_debug = False
+    def perform_VarDA(data, settings, save_vtu=False, profiler=None):
+        """This is a static method so that it can be performed in AE_train with user specified data.
+        The phase timings, solver iterations and decoder calls are recorded in
+        `profiler` (a DAProfiler) and returned in results_data["profile"]"""
+        profiler = profiler if profiler is not None else DAProfiler.from_settings(settings)
 
-        args = (data, settings)
         w_0 = data.get("w_0")
         if w_0 is None:
             raise ValueError("w_0 was not initialized")
 
-        t1 = time.time()
-        res = minimize(cost_fn_J, data.get("w_0"), args = args, method='L-BFGS-B',
-                jac=grad_J, tol=settings.TOL)
-        t2 = time.time()
-        string_out = "min = {:.4f}, ".format(t2 - t1)
-        w_opt = res.x
+        with profiler.count_decoder(data):
+            t1 = time.time()
+            with profiler.memory("minimize"):
+                w_opt = DAPipeline.minimize_J(data, settings, profiler)
+            t2 = time.time()
+
+            with profiler.memory("decode"):
+                delta_u_DA = DAPipeline.decode_w_opt(w_opt, data, settings)
+            t3 = time.time()
+
+        results_data = DAPipeline.calc_DA_stats(delta_u_DA, w_opt, data, settings,
+                                                save_vtu=save_vtu, profiler=profiler)
+        t4 = results_data.pop("t_unnorm")
+        t5 = time.time()
+
+        results_data["time_online"] = t4 - t1
+
+        profiler.add_time("minimize", t2 - t1)
+        profiler.add_time("decode", t3 - t2)
+        profiler.add_time("unnorm", t4 - t3)
+        profiler.add_time("metrics", t5 - t4)
+        results_data["profile"] = profiler.as_dict()
+
+        return results_data
+
+    @staticmethod
+    def perform_VarDA_batch(data, settings, save_vtu=False, profiler=None):
+        """Batched equivalent of perform_VarDA. The B independent cost functions
+        (one per row of data["D"]) are summed and minimised together so that
+        cost and gradient evaluations are matrix-matrix products over the
+        (B x M) matrix of control variables. Returns a list of B DA_results.
+        The profile of each state has the per-state share (1/B) of the batch
+        timings and the nit/nfev of the whole batch"""
+        profiler = profiler if profiler is not None else DAProfiler.from_settings(settings)
+
+        D = data.get("D")
+        w_0 = data.get("w_0")
+        if w_0 is None:
+            raise ValueError("w_0 was not initialized")
+        if D is None:
+            raise ValueError("D was not initialized. Use VDAInit.provide_u_c_batch_update_data()")
+        B = D.shape[0]
+        W_0 = np.tile(np.asarray(w_0).flatten(), (B, 1))
+
+        with profiler.count_decoder(data):
+            t1 = time.time()
+            with profiler.memory("minimize"):
+                solver = DAPipeline.get_solver(settings)
+                if solver == "direct":
+                    W_opt = DirectSolver.from_data(data, settings).solve(D)
+                elif solver == "torch":
+                    W_opt, info = TorchLBFGS(data, settings).minimize(D, W_0)
+                    profiler.record_solver(info)
+                else:
+                    Q_buf = np.empty(D.shape) #work buffer for innovations
+                    res = minimize(cost_and_grad_J_batch, W_0.flatten(), args = (data, settings, Q_buf),
+                            method='L-BFGS-B', jac=True, tol=settings.TOL)
+                    profiler.record_solver(res)
+                    W_opt = res.x.reshape((B, -1))
+            t_min = time.time()
+
+            with profiler.memory("decode"):
+                delta_u_DA = DAPipeline.decode_w_opt(W_opt, data, settings)
+            t2 = time.time()
+        profiler.add_time("minimize", t_min - t1)
+        profiler.add_time("decode", t2 - t_min)
+
+        U_c = data.get("U_c")
+        results = []
+        for idx in range(B):
+            state_profiler = profiler.scaled(B)
+            t3 = time.time()
+            results_data = DAPipeline.calc_DA_stats(delta_u_DA[idx], W_opt[idx], data,
+                                            settings, u_c=U_c[idx], save_vtu=save_vtu,
+                                            profiler=state_profiler)
+            t4 = results_data.pop("t_unnorm")
+            results_data["time_online"] = (t2 - t1) / B
+            state_profiler.times["unnorm"] = t4 - t3
+            state_profiler.times["metrics"] = time.time() - t4
+            results_data["profile"] = state_profiler.as_dict()
+            results.append(results_data)
+        return results
+
+    @staticmethod
+    def minimize_J(data, settings, profiler=None):
+        """Minimises the VarDA cost function using the solver given by
+        settings.DA_SOLVER and returns w_opt. The solver iterations and
+        function evaluations are recorded in `profiler` (if not None)"""
+        solver = DAPipeline.get_solver(settings)
+        info = None
+        if solver == "direct":
+            w_opt = DirectSolver.from_data(data, settings).solve(data.get("d"))
+        elif solver == "L-BFGS-B":
+            Q_buf = np.empty(np.shape(data.get("d"))) #work buffer for innovation
+            res = minimize(cost_and_grad_J, data.get("w_0"), args = (data, settings, Q_buf),
+                    method='L-BFGS-B', jac=True, tol=settings.TOL)
+            w_opt, info = res.x, res
+        elif solver == "torch":
+            history = data.get("lbfgs_history") #only set when cycling (see BatchDA)
+            w_opt, info = TorchLBFGS(data, settings).minimize(data.get("d"), data.get("w_0"), history)
+            if history is not None:
+                data["lbfgs_history"] = info.pop("history")
+        elif solver == "gauss-newton":
+            w_opt, info = GaussNewtonSolver(data, settings).minimize(data.get("d"), data.get("w_0"))
+        else:
+            raise ValueError("DA_SOLVER = {} is not allowed.".format(solver))
+        if profiler is not None and info is not None:
+            profiler.record_solver(info)
+        return w_opt
+
+    @staticmethod
+    def get_solver(settings):
+        if hasattr(settings, "DA_SOLVER") and settings.DA_SOLVER:
+            return settings.DA_SOLVER
+        return "L-BFGS-B"
+
+    @staticmethod
+    def decode_w_opt(w_opt, data, settings):
+        """Returns the DA increment delta_u_DA for a single control variable w_opt
+        or for a batch of control variables (B x M)"""
+        batched = len(w_opt.shape) == 2
+
+        if settings.COMPRESSION_METHOD == "SVD":
+            if batched:
+                delta_u_DA = (data.get("V_trunc") @ w_opt.T).T
+            else:
+                delta_u_DA = (data.get("V_trunc") @ w_opt).flatten()
+
+        elif settings.COMPRESSION_METHOD == "AE" and settings.REDUCED_SPACE:
+            if batched:
+                q_opt = w_opt @ data.get("V_trunc").T
+            else:
+                q_opt = data.get("V_trunc") @ w_opt
+            delta_u_DA  = data.get("decoder")(q_opt)
+
+        elif settings.COMPRESSION_METHOD == "AE":
+            delta_u_DA = data.get("decoder")(w_opt)
+            if settings.THREE_DIM and len(delta_u_DA.shape) != 3 and not batched:
+                delta_u_DA = delta_u_DA.squeeze(0)
+        else:
+            raise ValueError("COMPRESSION_METHOD must be in {SVD, AE}")
+
+        return delta_u_DA
+
+    @staticmethod
+    def calc_DA_stats(delta_u_DA, w_opt, data, settings, u_c=None, save_vtu=False, profiler=None):
+        """Adds the DA increment to u_0, undoes normalization (if required) and
+        calculates the DA performance metrics against the control state u_c.
+        If u_c is None, data["u_c"] is used. The memory of the unnorm and
+        metrics phases is recorded in `profiler` (a DAProfiler) if given"""
+        profiler = profiler if profiler is not None else DAProfiler()
         u_0 = data.get("u_0")
-        u_c = data.get("u_c")
+        u_c = data.get("u_c") if u_c is None else u_c
         std = data.get("std")
         mean = data.get("mean")
 
         if settings.COMPRESSION_METHOD == "SVD":
-            delta_u_DA = (data.get("V_trunc") @ w_opt).flatten()
             u_0 = u_0.flatten()
             u_c = u_c.flatten()
             std = std.flatten()
             mean = mean.flatten()
-            u_DA = u_0 + delta_u_DA
-            out_str_2 = ""
-
-        elif settings.COMPRESSION_METHOD == "AE" and settings.REDUCED_SPACE:
-            #w_0 = data.get("w_0")
-            # delta_w_DA = w_opt + w_0
-            # u_DA = data.get("decoder")(delta_w_DA)
-            # u_DA = u_0 + u_DA
-
-
 
-            ta = time.time()
-            q_opt = data.get("V_trunc") @ w_opt
-            tb = time.time()
-            delta_u_DA  = data.get("decoder")(q_opt)
-            tc = time.time()
+        with profiler.memory("unnorm"):
             u_DA = u_0 + delta_u_DA
-            td = time.time()
-            out_str_2 = "v_trunc = {:.4f}, dec = {:.4f}, add= {:.4f}"
-            out_str_2 = out_str_2.format(tb - ta, tc - tb, td-tc)
 
-        elif settings.COMPRESSION_METHOD == "AE":
-            delta_u_DA = data.get("decoder")(w_opt)
-            if settings.THREE_DIM and len(delta_u_DA.shape) != 3:
-                delta_u_DA = delta_u_DA.squeeze(0)
+            if settings.UNDO_NORMALIZE:
+                u_DA = (u_DA * std + mean)
+        t_unnorm = time.time() #end of DA: could return now with assilated state
 
-            u_DA = u_0 + delta_u_DA
+        with profiler.memory("metrics"):
+            if settings.UNDO_NORMALIZE:
+                u_c = (u_c * std + mean)
+                u_0 = (u_0 * std + mean)
+            elif settings.NORMALIZE:
+                print("Normalization not undone")
 
-        t3 = time.time()
-        string_out += "decode = {:.4f}, ".format(t3 - t2)
-        if settings.UNDO_NORMALIZE:
-
-            u_DA = (u_DA * std + mean)
-            t4 = time.time() #end of DA: could return now with assilated state
-            # Now calculate stats
-
-            u_c = (u_c * std + mean)
-            u_0 = (u_0 * std + mean)
-        elif settings.NORMALIZE:
-            t4 = time.time()
-            print("Normalization not undone")
-
-        string_out += "unnorm = {:.4f}, ".format(t4 - t3)
-        string_out += "TOTAL = {:.4f}, ".format(t4 - t1)
-        ref_MAE = np.abs(u_0 - u_c)
-        da_MAE = np.abs(u_DA - u_c)
-        ref_MAE_mean = np.mean(ref_MAE)
-        da_MAE_mean = np.mean(da_MAE)
-        percent_improvement = 100 * (ref_MAE_mean - da_MAE_mean)/ref_MAE_mean
-        counts = (da_MAE < ref_MAE).sum()
-        mse_ref = np.linalg.norm(u_0 - u_c) /  np.linalg.norm(u_c)
-        mse_DA = np.linalg.norm(u_DA - u_c) /  np.linalg.norm(u_c)
-
-        mse_percent = 100 * (mse_ref - mse_DA)/mse_ref
+            ref_MAE = np.abs(u_0 - u_c)
+            da_MAE = np.abs(u_DA - u_c)
+            ref_MAE_mean = np.mean(ref_MAE)
+            da_MAE_mean = np.mean(da_MAE)
+            percent_improvement = 100 * (ref_MAE_mean - da_MAE_mean)/ref_MAE_mean
+            counts = (da_MAE < ref_MAE).sum()
+            mse_ref = np.linalg.norm(u_0 - u_c) /  np.linalg.norm(u_c)
+            mse_DA = np.linalg.norm(u_DA - u_c) /  np.linalg.norm(u_c)
+
+            mse_percent = 100 * (mse_ref - mse_DA)/mse_ref
 
         results_data = {"u_DA": u_DA,
                     "ref_MAE_mean": ref_MAE_mean,
@@ -210,17 +552,11 @@ class DAPipeline():
                     "w_opt": w_opt,
                     "mse_ref": mse_ref,
                     "mse_DA": mse_DA,
-                    "time_online": t4 - t1}
+                    "t_unnorm": t_unnorm}
         if save_vtu:
             results_data["ref_MAE"] = ref_MAE.flatten()
             results_data["da_MAE"]  = da_MAE.flatten()
 
-        if timing_debug:
-            t5 = time.time()
-            string_out += "inc stats = {:.4f}, ".format(t5- t1)
-            print(string_out)
-            print(out_str_2)
-
         if settings.SAVE:
             if False:
                 out_fp_ref = settings.INTERMEDIATE_FP + "ref_MAE.vtu"
@@ -250,22 +586,22 @@ class DAPipeline():
     def __maybe_get_jacobian(self):
         jac = None
         if not self.settings.JAC_NOT_IMPLEM:
-            try:
-                jac = self.model.jac_explicit
-            except:
-                pass
-        else:
-            import warnings
-            warnings.warn("Using **Very** slow method of calculating jacobian. Consider disabling DA", UserWarning)
-            jac = self.slow_jac_wrapper
-
-        if jac == None:
-            raise NotImplementedError("This model type does not have a gradient available")
+            jac = getattr(self.model, "jac_explicit", None)
+            if getattr(jac, "__func__", None) is BaseAE.jac_explicit: #base class stub (not implemented)
+                jac = None
+        if jac is None:
+            #no explicit jacobian: use chunked vmap (jvp/vjp) engine
+            jac = self.vmap_jac_wrapper
         return jac
 
     def slow_jac_wrapper(self, x):
         return Jacobian.accumulated_slow_model(x, self.model, self.data.get("device"))
 
+    def vmap_jac_wrapper(self, x):
+        mode = self.settings.JAC_MODE if hasattr(self.settings, "JAC_MODE") else "auto"
+        max_bytes = self.settings.JAC_MAX_BYTES if hasattr(self.settings, "JAC_MAX_BYTES") else 2 ** 28
+        return Jacobian.vmap_model(x, self.model, self.data.get("device"), mode, max_bytes)
+
     @staticmethod
     def print_DA_results(DA_results):
 
@@ -1,26 +1,45 @@
 import numpy as np
+import multiprocessing
 
-def TSVD(V, settings, trunc_idx=None, test=False):
+from VarDACAE.VarDA.operators import LowRankOperator
+
+def TSVD(V, settings, trunc_idx=None, test=False, save=None):
     """Performs Truncated SVD where Truncation parameter is calculated
     via one of two methods:
         1) according to Rossella et al. 2018 (Optimal Reduced space ...).
         2) Alternatively, if trunc_ixd=n (where n is int), choose n modes with
             largest variance
+    The SVD is either a full SVD or a randomized SVD (that only computes the
+    leading modes) depending on settings.SVD_METHOD
     arguments
         :V - numpy array (n x M)
         :setttings - config for SVD
         :trunc_idx (opt) - index at which to truncate V.
+        :save (opt) - if True, the (untruncated) factors are saved to
+                    settings.INTERMEDIATE_FP (with the SVD_METHOD in the filename
+                    for non-full SVDs). Defaults to settings.SAVE
     returns
-        :V_trunc - truncated V (n x trunc_idx)
+        :V_trunc - truncated V (n x M) as a LowRankOperator (i.e. it is not
+                    formed explicitly. Use np.asarray(V_trunc) if required)
         :U, :s, :W - i.e. V can be factorized as:
                     V = U @ np.diag(s) @ W = U * s @ W
     """
-    U, s, W = np.linalg.svd(V, False)
+    method = get_SVD_method(settings)
+    if method == "full":
+        U, s, W = np.linalg.svd(V, False)
+    elif method == "randomized":
+        U, s, W = randomized_TSVD(V, settings, trunc_idx)
+    else:
+        raise ValueError("SVD_METHOD = {} is not allowed.".format(method))
 
 
-    if settings.SAVE:
+    if save is None:
+        save = settings.SAVE
+    if save:
 
         fp_base = settings.get_X_fp().split("/")[-1][1:]
+        if method != "full": #randomized factors only hold the leading modes
+            fp_base = "_" + method + fp_base
 
         np.save(settings.INTERMEDIATE_FP + "U" + fp_base, U)
         np.save(settings.INTERMEDIATE_FP + "s" + fp_base, s)
@@ -43,7 +62,7 @@ def TSVD(V, settings, trunc_idx=None, test=False):
     U_trunc = U[:, :trunc_idx]
     W_trunc = W[:trunc_idx, :]
     s_trunc = s[:trunc_idx]
-    V_trunc = U_trunc * s_trunc @ W_trunc
+    V_trunc = LowRankOperator(U_trunc, s_trunc, W_trunc)
 
     if settings.DEBUG:
         print("# modes kept: ", trunc_idx)
@@ -53,7 +72,8 @@ def TSVD(V, settings, trunc_idx=None, test=False):
         V_plus = W.T * (1 / s) @  U.T #Equivalent to W.T @ np.diag(1 / s) @  U.T
         V_plus_trunc =  W_trunc.T * (1 / s_trunc) @  U_trunc.T
 
-        assert np.allclose(V @ V_plus @ V, V), "V_plus should be generalized inverse of V"
+        if method == "full": #randomized SVD only holds the leading modes
+            assert np.allclose(V @ V_plus @ V, V), "V_plus should be generalized inverse of V"
         assert np.allclose(V_trunc @ V_plus_trunc @ V_trunc, V_trunc), "V_plus_trunc should be generalized inverse of V_trunc"
 
         #2) Check both methods to find V_trunc are equivalent
@@ -66,25 +86,228 @@ def TSVD(V, settings, trunc_idx=None, test=False):
 
     return V_trunc, U_trunc, s_trunc, W_trunc
 
+def randomized_SVD(V, k, oversample=10, power_iters=2, seed=None):
+    """Randomized range-finder SVD (Halko et al. 2011) that only computes
+    the leading k + oversample modes of V.
+    arguments
+        :V - numpy array (n x M)
+        :k - number of modes required
+        :oversample - number of extra random vectors used to capture the range of V
+        :power_iters - number of power iterations (improves accuracy when
+            the singular values decay slowly)
+        :seed - seed for (local) random number generator
+    returns
+        :U, :s, :W - of shapes (n x l), (l,), (l x M) where l = min(k + oversample, n, M)
+    """
+    n, M = V.shape
+    l = min(k + oversample, n, M)
+    rng = np.random.default_rng(seed)
+
+    Omega = rng.standard_normal((M, l))
+    Q, _ = np.linalg.qr(V @ Omega) #orthonormal basis for approx. range of V
+
+    for _ in range(power_iters):
+        #re-orthonormalize at each step for numerical stability
+        Z, _ = np.linalg.qr(V.T @ Q)
+        Q, _ = np.linalg.qr(V @ Z)
+
+    B = Q.T @ V #(l x M)
+    U_B, s, W = np.linalg.svd(B, False)
+    U = Q @ U_B
+
+    return U, s, W
+
+def randomized_TSVD(V, settings, trunc_idx=None):
+    """Calls randomized_SVD using the parameters in settings.
+    If trunc_idx is not given (i.e. the truncation is chosen according to
+    Rossella et al. 2018) the rank of the randomized SVD is doubled until
+    the smallest computed singular value is below the threshold (so that
+    the truncation is the same as with the full SVD)"""
+    oversample = settings.SVD_OVERSAMPLE if hasattr(settings, "SVD_OVERSAMPLE") else 10
+    power_iters = settings.SVD_POWER_ITERS if hasattr(settings, "SVD_POWER_ITERS") else 2
+    max_rank = min(V.shape)
+
+    if trunc_idx and trunc_idx > 0:
+        return randomized_SVD(V, trunc_idx, oversample, power_iters, settings.SEED)
+
+    k = settings.SVD_RANK_GUESS if hasattr(settings, "SVD_RANK_GUESS") else 32
+    while True:
+        U, s, W = randomized_SVD(V, k, oversample, power_iters, settings.SEED)
+        threshold = np.sqrt(s[0])
+        if s[-1] <= threshold or len(s) >= max_rank:
+            return U, s, W
+        k *= 2
+
+def incremental_SVD_update(U, s, W, C, forget=1.0, max_rank=None):
+    """Updates the (truncated) SVD of V = U * s @ W when new snapshot columns C
+    are appended, i.e. returns the SVD of [forget * V, C] (Brand 2006).
+    The cost is O(n * k * (k + c)) for k modes and c new columns so is
+    independent of the number of snapshots already in V.
+    arguments
+        :U, :s, :W - current factors of shape (n x k), (k,), (k x M).
+            W may be None if the right singular vectors are not required.
+        :C - new (mean-centred) snapshots as columns (n x c)
+        :forget - forgetting factor in (0, 1]. Existing snapshots are
+            down-weighted by this factor at each update
+        :max_rank - number of modes to retain (defaults to k)
+    returns
+        :U, :s, :W - updated factors. W has shape (max_rank x (M + c))
+    """
+    if len(C.shape) == 1:
+        C = C[:, None]
+    k = len(s)
+    c = C.shape[1]
+    if max_rank is None:
+        max_rank = k
+
+    P = U.T @ C #(k x c) component of C in span(U)
+    R = C - U @ P #(n x c) component orthogonal to span(U)
+    Q_R, R_R = np.linalg.qr(R)
+
+    K = np.zeros((k + c, k + c))
+    K[:k, :k] = np.diag(forget * s)
+    K[:k, k:] = P
+    K[k:, k:] = R_R
+
+    U_K, s_new, W_K = np.linalg.svd(K)
+
+    U_new = np.concatenate([U, Q_R], axis=1) @ U_K[:, :max_rank]
+    s_new = s_new[:max_rank]
+    W_K = W_K[:max_rank]
+
+    if W is not None:
+        #W_K @ [[W, 0], [0, I]]
+        W_new = np.concatenate([W_K[:, :k] @ W, W_K[:, k:]], axis=1)
+    else:
+        W_new = None
+
+    return U_new, s_new, W_new
+
+def snapshot_TSVD(X_fp, settings, trunc_idx=None, U_fp=None, chunk_sz=None,
+                num_workers=None):
+    """Out-of-core Truncated SVD by the method of snapshots.
+    The historical data in X_fp is streamed from disk in chunks of the state
+    dimension so that neither X nor V need to fit in memory:
+        1) The (M x M) Gram matrix V.T @ V is accumulated (in parallel) over
+            chunks of the state.
+        2) This is eigendecomposed: V.T @ V = W.T @ diag(s ** 2) @ W
+        3) U = V @ W.T / s is reconstructed chunk by chunk and written to disk.
+    Normalization/centring uses the same historical data (the first
+    HIST_FRAC of the snapshots) as SplitData. Truncation is as in TSVD().
+    NOTE: the columns of W are in file order (i.e. they are not shuffled)
+    and the Gram matrix squares the condition number of V so trailing modes
+    are less accurate than for TSVD().
+    arguments
+        :X_fp - path to an .npy file of shape (M x n) or (M x nx x ny x nz)
+        :settings - config for SVD
+        :trunc_idx (opt) - index at which to truncate
+        :U_fp (opt) - .npy fp to write U to (defaults to INTERMEDIATE_FP)
+        :chunk_sz (opt) - number of state variables per chunk
+        :num_workers (opt) - number of worker processes
+    returns
+        :U (memory-mapped (n x k)), :s, :W
+    """
+    if chunk_sz is None:
+        chunk_sz = settings.SVD_CHUNK_SZ if hasattr(settings, "SVD_CHUNK_SZ") else 2 ** 14
+    if num_workers is None:
+        num_workers = settings.SVD_NUM_WORKERS if hasattr(settings, "SVD_NUM_WORKERS") else 1
+    if U_fp is None:
+        U_fp = settings.INTERMEDIATE_FP + "U_snapshot_" + X_fp.split("/")[-1]
+
+    X = np.load(X_fp, mmap_mode="r")
+    M_total = X.shape[0]
+    n = X.reshape((M_total, -1)).shape[1]
+    hist_idx = int(M_total * settings.HIST_FRAC)
+
+    bounds = [(i, min(i + chunk_sz, n)) for i in range(0, n, chunk_sz)]
+    worker_bounds = [bounds[i::num_workers] for i in range(num_workers)]
+    worker_bounds = [b for b in worker_bounds if b]
+    base_args = (X_fp, hist_idx, settings.NORMALIZE)
+
+    #1) Gram matrix
+    grams = _map(_gram_worker, [base_args + (b,) for b in worker_bounds], num_workers)
+    gram = sum(grams)
+
+    #2) eigendecomposition (eigh returns ascending order)
+    lam, E = np.linalg.eigh(gram)
+    lam, E = lam[::-1], E[:, ::-1]
+    s = np.sqrt(np.maximum(lam, 0.))
+    rank = int((s > s[0] * max(gram.shape) * np.finfo(float).eps).sum()) #V is rank deficient after centring
+    s, W = s[:rank], E[:, :rank].T
+
+    if not trunc_idx:
+        threshold = np.sqrt(s[0])
+        trunc_idx = max(int((s > threshold).sum()), 1)
+    else:
+        assert type(trunc_idx) == int, "trunc_idx must be an integer"
+    s, W = s[:trunc_idx], W[:trunc_idx]
+
+    #3) reconstruct U chunk by chunk
+    U = np.lib.format.open_memmap(U_fp, mode="w+", shape=(n, len(s)))
+    del U #flush header. Workers reopen in r+ mode
+    W_scaled = W.T / s #(M x k)
+    _map(_U_worker, [base_args + (b, W_scaled, U_fp) for b in worker_bounds], num_workers)
+    U = np.load(U_fp, mmap_mode="r")
+
+    if settings.DEBUG:
+        print("# modes kept: ", trunc_idx)
+
+    return U, s, W
+
+def _map(fn, args, num_workers):
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            return pool.map(fn, args)
+    return [fn(arg) for arg in args]
+
+def _snapshot_chunk(X_fp, hist_idx, normalize, start, end):
+    """Returns the (M x c) block of V.T for state variables start:end"""
+    X = np.load(X_fp, mmap_mode="r")
+    X = X.reshape((X.shape[0], -1))
+    X_c = np.array(X[:hist_idx, start:end], dtype=float)
+    if normalize:
+        mean = np.mean(X_c, axis=0)
+        std = np.std(X_c, axis=0)
+        std = np.where(std <= 0., 1, std)
+        X_c = (X_c - mean) / std
+    return X_c - np.mean(X_c, axis=0)
+
+def _gram_worker(args):
+    X_fp, hist_idx, normalize, bounds = args
+    gram = 0.
+    for start, end in bounds:
+        V_c = _snapshot_chunk(X_fp, hist_idx, normalize, start, end)
+        gram = gram + V_c @ V_c.T
+    return gram
+
+def _U_worker(args):
+    X_fp, hist_idx, normalize, bounds, W_scaled, U_fp = args
+    U = np.load(U_fp, mmap_mode="r+")
+    for start, end in bounds:
+        V_c = _snapshot_chunk(X_fp, hist_idx, normalize, start, end)
+        U[start:end] = V_c.T @ W_scaled
+    U.flush()
+
+def get_SVD_method(settings):
+    if hasattr(settings, "SVD_METHOD") and settings.SVD_METHOD:
+        return settings.SVD_METHOD
+    return "full"
+
 def SVD_V_trunc(U, s, W, modes=-1):
-    """helper function to calc V_trunc when U, s, W are known"""
+    """helper function to calc V_trunc when U, s, W are known.
+    Returns a (factored) LowRankOperator"""
 
     if not modes == -1: #all modes
         U = U[:, :modes]
         W = W[:modes, :]
         s = s[:modes]
 
-    return U * s @ W
+    return LowRankOperator(U, s, W)
 
 def SVD_V_trunc_plus(U, s, W, modes=-1):
-    if not modes == -1: #all modes
-        U = U[:, :modes]
-        W = W[:modes, :]
-        s = s[:modes]
-    s = np.where(s <= 0., 1, s) #remove any zeros (when choosing init point)
-    V_trunc_plus = W.T * (1 / s) @  U.T
-
-    return V_trunc_plus
+    """Returns the pseudo-inverse of V_trunc as a LowRankOperator.
+    Any zero singular values are removed (when choosing init point)"""
+    return SVD_V_trunc(U, s, W, modes).pinv()
 
 
 def SVD_reconstruction_trunc(input, U, s, W, modes=-1):
@@ -114,14 +337,61 @@ def SVD_reconstruction(input, U, s, W):
     else:
         input = input.flatten()
 
-    V = U * s @ W
-    V_plus =  W.T * (1 / s) @  U.T
-
-
-    output = V @ (V_plus @ input)
+    #V @ V_plus = U @ U.T so project directly rather than forming V and V_plus
+    output = U @ (U.T @ input)
 
     if batched:
         output = output.T
 
     output = output.reshape(shpe)
     return output
+
+def SVD_reconstruction_proj(X, U, modes=-1, chunk_sz=None):
+    """Batched SVD reconstruction U_k @ (U_k.T @ X) of a set of states X
+    (B x n) or (B x nx x ny x nz) computed in chunks of `chunk_sz` state
+    variables so that only O(n * k) additional memory is required.
+    Returns reconstructions with the same shape as X"""
+    out = np.empty((X.shape[0], U.shape[0]), dtype=np.result_type(X, U))
+    for start, end, X_hat in _proj_chunks(X, U, modes, chunk_sz):
+        out[:, start:end] = X_hat
+    return out.reshape(X.shape)
+
+def SVD_reconstruction_errors(X, U, modes=-1, chunk_sz=None):
+    """Returns the L1 (sum of absolute errors) and L2 (sum of squared errors)
+    reconstruction losses of each state in X (B x n) or (B x nx x ny x nz).
+    This takes two streamed passes over the state dimension (see _proj_chunks)
+    so the (B x n) reconstruction is never allocated. The passes can't be fused
+    as the L1 loss needs every element of the reconstruction.
+    returns
+        :l1, :l2 - numpy arrays of shape (B,)"""
+    B = X.shape[0]
+    l1, l2 = np.zeros(B), np.zeros(B)
+    X_flat = X.reshape((B, -1))
+    for start, end, X_hat in _proj_chunks(X, U, modes, chunk_sz):
+        err = X_hat - X_flat[:, start:end]
+        l1 += np.abs(err).sum(axis=1)
+        l2 += (err * err).sum(axis=1)
+    return l1, l2
+
+def _proj_chunks(X, U, modes=-1, chunk_sz=None):
+    """Yields (start, end, X_hat[:, start:end]) where X_hat = X @ U_k @ U_k.T
+    is the projection of the flattened states X (B x n). X and U are read
+    twice: once for Z = X @ U_k and once for the chunks of Z @ U_k.T"""
+    if not modes == -1: #all modes
+        U = U[:, :modes]
+    n = U.shape[0]
+    if chunk_sz is None:
+        chunk_sz = 2 ** 14
+    X = X.reshape((X.shape[0], -1))
+    assert X.shape[1] == n, "X must have the same state dimension as U"
+
+    #first pass: Z = X @ U_k (B x k)
+    Z = np.zeros((X.shape[0], U.shape[1]), dtype=np.result_type(X, U))
+    for start in range(0, n, chunk_sz):
+        end = min(start + chunk_sz, n)
+        Z += X[:, start:end] @ U[start:end]
+
+    #second pass: reconstruct chunk by chunk
+    for start in range(0, n, chunk_sz):
+        end = min(start + chunk_sz, n)
+        yield start, end, Z @ U[start:end].T
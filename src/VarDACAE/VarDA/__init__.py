@@ -1,3 +1,4 @@
 from VarDACAE.VarDA.vda_init import VDAInit
+from VarDACAE.VarDA.direct_solver import DirectSolver
 from VarDACAE.VarDA.DataAssimilation import DAPipeline
 from VarDACAE.VarDA.batch_DA import BatchDA
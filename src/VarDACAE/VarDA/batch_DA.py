@@ -1,9 +1,14 @@
 import torch
 import time
+import os
+import copy
 
 from VarDACAE import ML_utils, SplitData, fluidity
+from VarDACAE.data import context
 from VarDACAE.VarDA import DAPipeline
 from VarDACAE.VarDA import SVD, VDAInit
+from VarDACAE.VarDA import parallel
+from VarDACAE.VarDA import profiler as DA_profiler
 from VarDACAE.utils.expdir import init_expdir
 from VarDACAE.settings import helpers
 import pandas as pd
@@ -11,7 +16,30 @@ import numpy as np
 
 class BatchDA():
     def __init__(self, settings, control_states=None, csv_fp=None, AEModel=None,
-                reconstruction=True, plot=False, save_vtu=False):
+                reconstruction=True, plot=False, save_vtu=False, batch_sz=None,
+                num_workers=None, threads_per_worker=1, resume=False, flush_every=1,
+                cycle=False, carry_lbfgs=False):
+        """Evaluates VarDA over a set of control states.
+        Arguments
+            batch_sz (int) - if not None, control states are assimilated in
+                    chunks of `batch_sz` with a single vectorised minimisation
+                    per chunk (use -1 to assimilate all states at once).
+                    If None, each state is assimilated separately.
+            num_workers (int) - if > 1, states are assimilated separately in a
+                    pool of `num_workers` processes (see VarDA/parallel.py).
+                    Results are identical (and in the same order) as num_workers=None
+            threads_per_worker (int) - BLAS/torch threads in each worker process
+            resume (bool) - if True (and csv_fp exists), states already in csv_fp
+                    are not re-assimilated and are loaded from the file instead.
+                    Results are always streamed to csv_fp (one row per state)
+            flush_every (int) - csv_fp is flushed (and fsync-ed) every `flush_every` states
+            cycle (bool) - if True, states are assimilated sequentially in time
+                    order and each minimisation is warm-started from the previous
+                    w_opt (rather than w_0). If control_states is None, test_X is
+                    loaded with SHUFFLE_DATA = False. The iterations per state are
+                    in the nit/nfev columns of the results
+            carry_lbfgs (bool) - (with cycle and DA_SOLVER = "torch") the L-BFGS
+                    curvature pairs are also carried over from the previous state"""
 
         self.settings = settings
         self.control_states = control_states
@@ -20,6 +48,25 @@ class BatchDA():
         self.model = AEModel
         self.csv_fp = csv_fp
         self.save_vtu = save_vtu
+        self.batch_sz = batch_sz
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.resume = resume
+        self.flush_every = flush_every
+        self.cycle = cycle
+        self.carry_lbfgs = carry_lbfgs
+
+        if self.cycle and (self.batch_sz is not None or (self.num_workers is not None and self.num_workers > 1)):
+            raise ValueError("cycle requires states to be assimilated sequentially (i.e. batch_sz = None and num_workers <= 1)")
+        if self.carry_lbfgs and not self.cycle:
+            raise ValueError("carry_lbfgs is only available with cycle = True")
+        if self.carry_lbfgs and DAPipeline.get_solver(settings) != "torch":
+            raise ValueError("carry_lbfgs is only available with DA_SOLVER = 'torch'")
+
+        if self.resume and not self.csv_fp:
+            raise ValueError("Must pass csv_fp to resume")
+        if self.resume and self.save_vtu:
+            raise ValueError("Cannot resume with save_vtu (average MAE fields are not saved per state)")
 
         if self.csv_fp:
             fps = self.csv_fp.split("/")
@@ -37,10 +84,10 @@ class BatchDA():
                 raise ValueError("Must past csv fp to save vtu file")
 
         if self.control_states is None:
-            loader, splitter = settings.get_loader(), SplitData()
-            X = loader.get_X(settings)
-
-            train_X, test_X, u_c_std, X, mean, std = splitter.train_test_DA_split_maybe_normalize(X, settings)
+            if self.cycle: #time ordered control states
+                settings = copy.copy(settings)
+                settings.SHUFFLE_DATA = False
+            train_X, test_X, u_c_std, X, mean, std = context.get_split(settings)
             self.control_states = test_X
 
 
@@ -54,24 +101,14 @@ class BatchDA():
             if self.settings.REDUCED_SPACE:
                 raise NotImplementedError("Cannot have reduced space SVD")
 
-            fp_base = self.settings.get_X_fp().split("/")[-1][1:]
-
-            U = np.load(self.settings.INTERMEDIATE_FP  + "U" + fp_base)
-            s = np.load(self.settings.INTERMEDIATE_FP  + "s" + fp_base)
-            W = np.load(self.settings.INTERMEDIATE_FP  + "W" + fp_base)
+            self.DA_pipeline = DAPipeline(self.settings)
+            #factors are taken from the SVD cache (if SAVE) so they are always
+            #consistent with the current training data and settings
+            DA_data = self.DA_pipeline.init_SVD()
 
+            U, s, W = DA_data.get("U"), DA_data.get("s"), DA_data.get("W")
             num_modes = self.settings.get_number_modes()
 
-            V_trunc = SVD.SVD_V_trunc(U, s, W, modes=num_modes)
-            V_trunc_plus = SVD.SVD_V_trunc_plus(U, s, W, modes=num_modes)
-
-            self.DA_pipeline = DAPipeline(self.settings)
-            DA_data = self.DA_pipeline.data
-            DA_data["V_trunc"] = V_trunc
-            DA_data["V"] = None
-            DA_data["w_0"] = V_trunc_plus @ DA_data.get("u_0").flatten()
-            DA_data["V_grad"] = None
-
         elif self.settings.COMPRESSION_METHOD == "AE":
             if self.model is None:
                 raise ValueError("Must provide an AE torch.nn model if settings.COMPRESSION_METHOD == 'AE'")
@@ -89,9 +126,11 @@ class BatchDA():
 
         self.settings.SHUFFLE_DATA = shuffle
 
-        if self.reconstruction:
-            L1 = torch.nn.L1Loss(reduction='sum')
-            L2 = torch.nn.MSELoss(reduction="sum")
+        if self.reconstruction and self.settings.COMPRESSION_METHOD == "SVD":
+            #reconstruction losses of all states in a single streamed pass
+            chunk_sz = self.settings.SVD_CHUNK_SZ if hasattr(self.settings, "SVD_CHUNK_SZ") else None
+            l1_SVD, l2_SVD = SVD.SVD_reconstruction_errors(self.control_states, U,
+                                                        num_modes, chunk_sz)
 
         totals = {"percent_improvement": 0,
                 "ref_MAE_mean": 0,
@@ -113,46 +152,68 @@ class BatchDA():
         else:
             num_states = self.control_states.shape[0]
 
-        for idx in range(num_states):
+        writer = None
+        done = {}
+        if self.csv_fp:
+            writer = ResultsCSV(self.csv_fp, self.flush_every)
+            if self.resume:
+                done = writer.load()
+                done = {idx: res for idx, res in done.items() if idx < num_states}
+            writer.open(append=self.resume)
+        for idx, result in done.items():
+            results.append(result)
+            totals = self.__add_result_to_totals(result, totals)
+        todo = [idx for idx in range(num_states) if idx not in done]
+        if len(done) > 0:
+            print("Resuming: {} of {} states loaded from {}".format(len(done), num_states, self.csv_fp))
+
+        batch_sz = self.batch_sz
+        if batch_sz is not None and (batch_sz == -1 or batch_sz > len(todo)):
+            batch_sz = max(len(todo), 1)
+
+        w_warm = None #previous analysis (when cycling)
+        if self.carry_lbfgs:
+            self.DA_pipeline.data["lbfgs_history"] = {}
+
+        parallel_results = None
+        if self.num_workers is not None and self.num_workers > 1:
+            if batch_sz is not None:
+                raise ValueError("batch_sz and num_workers > 1 cannot be used together")
+            if len(todo) > 0:
+                parallel_results = parallel.run_parallel(self.DA_pipeline, self.control_states[todo],
+                                                        self.num_workers, self.threads_per_worker,
+                                                        self.save_vtu, self.reconstruction)
+
+        for pos, idx in enumerate(todo):
             u_c = self.control_states[idx]
-            if self.settings.REDUCED_SPACE:
-                self.DA_pipeline.data = VDAInit.provide_u_c_update_data_reduced_AE(DA_data,
-                                                                                    self.settings, u_c)
+            if parallel_results is not None:
+                DA_results, t_tot, l1, l2 = parallel_results[pos]
+            elif batch_sz is not None:
+                if pos % batch_sz == 0:
+                    batch_idx = todo[pos:pos + batch_sz]
+                    t1 = time.time()
+                    batch_results = self.DA_pipeline.DA_batch(self.control_states[batch_idx],
+                                                                save_vtu=self.save_vtu)
+                    t2 = time.time()
+                    t_batch = (t2 - t1) / len(batch_idx)
+                    if self.reconstruction and self.settings.COMPRESSION_METHOD == "AE":
+                        l1_batch, l2_batch = self.AE_reconstruction_errors(self.DA_pipeline.data,
+                                                        self.control_states[batch_idx])
+                DA_results = batch_results[pos % batch_sz]
+                t_tot = t_batch
+                l1, l2 = None, None
+                if self.reconstruction and self.settings.COMPRESSION_METHOD == "AE":
+                    l1, l2 = l1_batch[pos % batch_sz], l2_batch[pos % batch_sz]
             else:
-                self.DA_pipeline.data = VDAInit.provide_u_c_update_data_full_space(DA_data,
-                                                                                        self.settings, u_c)
-            t1 = time.time()
-            if self.settings.COMPRESSION_METHOD == "AE":
-                DA_results = self.DA_pipeline.DA_AE(save_vtu=self.save_vtu)
-            elif self.settings.COMPRESSION_METHOD == "SVD":
-                DA_results = self.DA_pipeline.DA_SVD(save_vtu=self.save_vtu)
-            t2 = time.time()
-            t_tot = t2 - t1
+                DA_results, t_tot, l1, l2 = self.assimilate_state(self.DA_pipeline, u_c,
+                                                        self.save_vtu, self.reconstruction,
+                                                        w_0=w_warm)
+                if self.cycle:
+                    w_warm = DA_results["w_opt"]
             #print("time_online {:.4f}s".format(DA_results["time_online"]))
 
-            if self.reconstruction:
-                data_tensor = torch.Tensor(u_c)
-                if self.settings.COMPRESSION_METHOD == "AE":
-                    device = ML_utils.get_device()
-                    #device = ML_utils.get_device(True, 1)
-
-                    data_tensor = data_tensor.to(device)
-
-                    data_hat = decoder(encoder(u_c))
-                    data_hat = torch.Tensor(data_hat)
-                    data_hat = data_hat.to(device)
-
-                elif self.settings.COMPRESSION_METHOD == "SVD":
-
-                    data_hat = SVD.SVD_reconstruction_trunc(u_c, U, s, W, num_modes)
-
-                    data_hat = torch.Tensor(data_hat)
-                with torch.no_grad():
-                    l1 = L1(data_hat, data_tensor)
-                    l2 = L2(data_hat, data_tensor)
-            else:
-                l1, l2 = None, None
-
+            if self.reconstruction and self.settings.COMPRESSION_METHOD == "SVD":
+                l1, l2 = l1_SVD[idx], l2_SVD[idx]
 
             result = {}
             result["percent_improvement"] = DA_results["percent_improvement"]
@@ -162,15 +223,18 @@ class BatchDA():
             result["mse_ref"] = DA_results["mse_ref"]
             result["mse_DA"] = DA_results["mse_DA"]
             if self.reconstruction:
-                result["l1_loss"] = l1.detach().cpu().numpy()
-                result["l2_loss"] = l2.detach().cpu().numpy()
-            result["time"] = t2 - t1
+                result["l1_loss"] = l1
+                result["l2_loss"] = l2
+            result["time"] = t_tot
             result["time_online"] = DA_results["time_online"]
+            result.update(DA_results["profile"])
             if self.save_vtu:
                 tot_DA_MAE += DA_results.get("da_MAE")
                 tot_ref_MAE += DA_results.get("ref_MAE")
-            #add to results list (that will become a .csv)
+            #add to results list and stream to .csv
             results.append(result)
+            if writer is not None:
+                writer.write(idx, result)
 
             #add to aggregated dict results
             totals = self.__add_result_to_totals(result, totals)
@@ -178,7 +242,10 @@ class BatchDA():
             if idx % print_every == 0 and idx > 0:
                 if not print_small:
                     print("idx:", idx)
-                self.__print_totals(totals, idx + 1, print_small)
+                self.__print_totals(totals, len(results), print_small)
+        if writer is not None:
+            writer.close()
+        self.DA_pipeline.data.pop("lbfgs_history", None)
         if not print_small:
             print("------------")
         self.__print_totals(totals, num_states, print_small)
@@ -186,7 +253,18 @@ class BatchDA():
             print("------------")
 
 
-        results_df = pd.DataFrame(results)
+        results_df = pd.DataFrame(results, index=list(done.keys()) + todo)
+        results_df = results_df.sort_index()
+        if self.cycle:
+            print("Cycling DA - - mean nit: {:.1f}, mean nfev: {:.1f}".format(
+                                results_df["nit"].mean(), results_df["nfev"].mean()))
+
+        #percentiles of the phase timings/counters over all states
+        self.profile_summary = DA_profiler.summarize(results_df)
+        if not print_small:
+            print(self.profile_summary)
+        if self.csv_fp:
+            self.profile_summary.to_csv(self.csv_fp.replace(".csv", "_profile.csv"))
         if self.save_vtu:
             tot_DA_MAE /= num_states
             tot_ref_MAE /= num_states
@@ -195,14 +273,84 @@ class BatchDA():
             fluidity.utils.save_vtu(self.settings, out_fp_ref, tot_ref_MAE)
             fluidity.utils.save_vtu(self.settings, out_fp_DA, tot_DA_MAE)
 
-        #save to csv
-        if self.csv_fp:
-            results_df.to_csv(self.csv_fp)
-
         if self.plot:
             raise NotImplementedError("plotting functionality not implemented yet")
         return results_df
     @staticmethod
+    def assimilate_state(DA_pipeline, u_c, save_vtu=False, reconstruction=False,
+                        keep_full=True, w_0=None):
+        """Assimilates a single control state u_c with an initialized DAPipeline.
+        If w_0 is not None the minimisation starts from w_0 (a warm start)
+        rather than from data["w_0"].
+        returns
+            :DA_results - dict of DA results. If keep_full=False only the
+                    scalar metrics (and MAE fields if save_vtu) are kept
+            :t_tot - time for the assimilation
+            :l1, :l2 - AE reconstruction losses (None for SVD as these
+                    are calculated for all states at once)"""
+        settings = DA_pipeline.settings
+        DA_data = DA_pipeline.data
+        profiler = DA_profiler.DAProfiler.from_settings(settings)
+        with profiler.phase("obs"):
+            if settings.REDUCED_SPACE:
+                DA_pipeline.data = VDAInit.provide_u_c_update_data_reduced_AE(DA_data,
+                                                                                settings, u_c)
+            else:
+                DA_pipeline.data = VDAInit.provide_u_c_update_data_full_space(DA_data,
+                                                                                settings, u_c)
+        w_0_cold = DA_pipeline.data.get("w_0")
+        if w_0 is not None:
+            DA_pipeline.data["w_0"] = w_0
+        t1 = time.time()
+        if settings.COMPRESSION_METHOD == "AE":
+            DA_results = DA_pipeline.DA_AE(save_vtu=save_vtu, profiler=profiler)
+        elif settings.COMPRESSION_METHOD == "SVD":
+            DA_results = DA_pipeline.DA_SVD(save_vtu=save_vtu, profiler=profiler)
+        t2 = time.time()
+        if w_0 is not None:
+            DA_pipeline.data["w_0"] = w_0_cold
+        t_tot = t2 - t1
+
+        l1, l2 = None, None
+        if reconstruction and settings.COMPRESSION_METHOD == "AE":
+            encoder = DA_pipeline.data.get("encoder")
+            decoder = DA_pipeline.data.get("decoder")
+            L1 = torch.nn.L1Loss(reduction='sum')
+            L2 = torch.nn.MSELoss(reduction="sum")
+            device = ML_utils.get_device()
+            #device = ML_utils.get_device(True, 1)
+
+            data_tensor = torch.Tensor(u_c).to(device)
+
+            data_hat = decoder(encoder(u_c))
+            data_hat = torch.Tensor(data_hat)
+            data_hat = data_hat.to(device)
+
+            with torch.no_grad():
+                l1 = L1(data_hat, data_tensor).detach().cpu().numpy()
+                l2 = L2(data_hat, data_tensor).detach().cpu().numpy()
+
+        if not keep_full:
+            keys = ["percent_improvement", "ref_MAE_mean", "da_MAE_mean", "counts",
+                    "mse_ref", "mse_DA", "time_online", "profile"]
+            if save_vtu:
+                keys += ["da_MAE", "ref_MAE"]
+            DA_results = {k: DA_results[k] for k in keys}
+        return DA_results, t_tot, l1, l2
+
+    @staticmethod
+    def AE_reconstruction_errors(DA_data, U_c):
+        """Returns the L1 and L2 (sum of squares) AE reconstruction errors
+        (each of shape (B,)) of the batch of control states U_c. The batch is
+        encoded and decoded together"""
+        encoder = DA_data.get("encoder")
+        decoder = DA_data.get("decoder")
+        B = U_c.shape[0]
+        U_hat = decoder(encoder(U_c)).reshape((B, -1))
+        diff = U_hat - np.asarray(U_c, dtype=U_hat.dtype).reshape((B, -1))
+        return np.abs(diff).sum(axis=1), (diff ** 2).sum(axis=1)
+
+    @staticmethod
     def get_tots(results_df):
         data = {}
         data["mse_ref"] = results_df["mse_ref"].mean()
@@ -219,7 +367,8 @@ class BatchDA():
     @staticmethod
     def __add_result_to_totals(result, totals):
         for k, v in result.items():
-            totals[k] += v
+            if k in totals and v is not None: #profile columns are summarised separately
+                totals[k] += v
         return totals
 
     @staticmethod
@@ -240,5 +389,76 @@ class BatchDA():
             print(out_str)
 
 
+class ResultsCSV():
+    """Append-only csv of BatchDA results with one row per control state
+    (and a `state_idx` column) so that a run that is interrupted can be resumed.
+    Rows are written as they complete and the file is flushed (and fsync-ed)
+    every `flush_every` rows so that at most the last `flush_every` states are lost"""
+
+    IDX_COL = "state_idx"
+
+    def __init__(self, fp, flush_every=1):
+        self.fp = fp
+        self.flush_every = max(int(flush_every), 1)
+        self.columns = None
+        self.__file = None
+        self.__unflushed = 0
+
+    def load(self):
+        """Returns a dict {state_idx: result} of the rows in an existing file.
+        A partially written final row (e.g. after a crash) is discarded"""
+        if not os.path.isfile(self.fp) or os.path.getsize(self.fp) == 0:
+            return {}
+        with open(self.fp, "rb+") as f:
+            content = f.read()
+            end = content.rfind(b"\n") + 1
+            if end < len(content): #truncate partial row
+                f.truncate(end)
+        if end == 0:
+            return {}
+        df = pd.read_csv(self.fp)
+        if self.IDX_COL not in df.columns:
+            raise ValueError("{} is not a BatchDA results file (no {} column)".format(self.fp, self.IDX_COL))
+        df = df.drop_duplicates(self.IDX_COL, keep="last")
+        self.columns = [c for c in df.columns if c != self.IDX_COL]
+        done = {}
+        for row in df.to_dict("records"):
+            idx = int(row.pop(self.IDX_COL))
+            done[idx] = {k: (None if pd.isnull(v) else v) for k, v in row.items()}
+        return done
+
+    def open(self, append=False):
+        self.__file = open(self.fp, "a" if append else "w", newline="")
+        if not append:
+            self.columns = None
+
+    def write(self, idx, result):
+        if self.columns is None:
+            self.columns = list(result.keys())
+            self.__file.write(",".join([self.IDX_COL] + self.columns) + "\n")
+        elif list(result.keys()) != self.columns:
+            raise ValueError("Result columns {} do not match the columns in {}".format(list(result.keys()), self.fp))
+        vals = [str(int(idx))] + [self.__format(result[k]) for k in self.columns]
+        self.__file.write(",".join(vals) + "\n")
+        self.__unflushed += 1
+        if self.__unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__unflushed = 0
+
+    def close(self):
+        if self.__file is not None:
+            self.flush()
+            self.__file.close()
+            self.__file = None
 
-
+    @staticmethod
+    def __format(v):
+        if v is None:
+            return ""
+        if hasattr(v, "item"): #numpy scalars/0-d arrays
+            v = v.item()
+        return str(v)
@@ -1,19 +1,16 @@
 import numpy as np
 import torch
 
+from VarDACAE.VarDA.operators import get_H, get_R_inv, LowRankOperator
+
 
 def cost_fn_J(w, data, settings):
     """Computes VarDA cost function.
     """
 
-    device = data.get("device")
     d = data.get("d")
-    G = data.get("G")
-    V_trunc = data.get("V_trunc")
-    V =  V_trunc if V_trunc is not None else data.get("V")
     G_V = data.get("G_V")
-    V_grad = data.get("V_grad")
-    R_inv = data.get("R_inv")
+    R_inv = get_R_inv(data, settings)
 
     if settings.COMPRESSION_METHOD == "AE" and not settings.REDUCED_SPACE:
         decoder = data.get("decoder")
@@ -23,18 +20,12 @@ def cost_fn_J(w, data, settings):
         V_w = decoder(w)
         V_w = V_w.flatten()
 
-        Q = (G @ V_w - d)
+        Q = (get_H(data) @ V_w - d)
 
     else:
         Q = (G_V @ w - d)
 
-    if settings.OBS_VARIANCE and not R_inv:
-        #When R is proportional to identity
-        J_o = 0.5 / settings.OBS_VARIANCE * np.dot(Q, Q)
-    elif R_inv:
-        J_o = 0.5 * Q.T @ R_inv @ Q
-    else:
-        raise ValueError("Either R_inv or sigma must be provided")
+    J_o = 0.5 * np.dot(Q, R_inv @ Q)
 
     J_b = 0.5 * settings.ALPHA * np.dot(w, w)
     J = J_b + J_o
@@ -47,38 +38,194 @@ def cost_fn_J(w, data, settings):
 def grad_J(w, data, settings):
     device = data.get("device")
     d = data.get("d")
-    G = data.get("G")
-    V_trunc = data.get("V_trunc")
-    V =  V_trunc if V_trunc is not None else data.get("V")
     G_V = data.get("G_V")
     V_grad = data.get("V_grad")
-    R_inv = data.get("R_inv")
+    R_inv = get_R_inv(data, settings)
 
     if settings.COMPRESSION_METHOD == "AE" and not settings.REDUCED_SPACE:
-        decoder = data.get("model").decode
+        H = get_H(data)
+        if get_AE_grad_mode(settings) == "vjp":
+            V_w, vjp = decode_with_vjp(w, data)
+            Q = (H @ V_w - d)
+            grad_o = vjp(H.T @ (R_inv @ Q))
+        else:
+            decoder = data.get("model").decode
+
+            assert callable(V_grad), "V_grad must be a function if settings.COMPRESSION_METHOD=AE is used"
+            model = data.get("model").to(device)
+
+            w_tensor = torch.Tensor(w).to(device)
+            V_w = decoder(w_tensor).detach().cpu().numpy()
+            V_w = V_w.flatten()
+            V_grad_w = V_grad(w_tensor).detach().cpu().numpy()
+
+            Q = (H @ V_w - d)
+            P = (H @ V_grad_w).T
+            grad_o = P @ (R_inv @ Q)
+    else:
+        Q = (G_V @ w - d)
+        P = G_V.T
+        grad_o = P @ (R_inv @ Q)
 
-        assert callable(V_grad), "V_grad must be a function if settings.COMPRESSION_METHOD=AE is used"
-        model = data.get("model").to(device)
+    grad_J = settings.ALPHA * w + grad_o
 
-        w_tensor = torch.Tensor(w).to(device)
-        V_w = decoder(w_tensor).detach().cpu().numpy()
-        V_w = V_w.flatten()
-        V_grad_w = V_grad(w_tensor).detach().cpu().numpy()
+    return grad_J
+
+def cost_and_grad_J(w, data, settings, Q=None):
+    """Computes VarDA cost function and its gradient in a single pass so that
+    the innovation Q = G_V @ w - d (and, for the full-space AE, the decoding
+    of w) is only calculated once per iteration.
+    For use with scipy.optimize.minimize(..., jac=True).
+        :Q (opt) - pre-allocated (nobs,) work buffer for the innovation
+    returns
+        :(J, grad_J)"""
+
+    device = data.get("device")
+    d = data.get("d")
+    G_V = data.get("G_V")
+    V_grad = data.get("V_grad")
+    R_inv = get_R_inv(data, settings)
+
+    vjp = None
+    if settings.COMPRESSION_METHOD == "AE" and not settings.REDUCED_SPACE:
+        H = get_H(data)
+        if get_AE_grad_mode(settings) == "vjp":
+            #gradient is a single backward pass through the decoder
+            V_w, vjp = decode_with_vjp(w, data)
+        else:
+            decoder = data.get("decoder")
+            assert callable(decoder), "decoder must be a function if settings.COMPRESSION_METHOD=AE and bool(settings.REDUCED_SPACE) =False"
+            assert callable(V_grad), "V_grad must be a function if settings.COMPRESSION_METHOD=AE is used"
+
+            w_tensor = torch.Tensor(w).to(device)
+            V_w = decoder(w).flatten()
+            V_grad_w = V_grad(w_tensor).detach().cpu().numpy()
+            P = (H @ V_grad_w).T
+
+        Q = np.subtract(H @ V_w, d, out=Q)
 
-        Q = (G @ V_w - d)
-        P = V_grad_w.T @ G.T
     else:
-        Q = (G_V @ w - d)
+        if Q is not None and isinstance(G_V, LowRankOperator):
+            G_V.matmul(w, out=Q)
+            Q -= d
+        elif Q is not None and isinstance(G_V, np.ndarray):
+            np.matmul(G_V, w, out=Q)
+            Q -= d
+        else:
+            Q = G_V @ w - d
         P = G_V.T
 
-    if not R_inv and settings.OBS_VARIANCE:
-        #When R is proportional to identity
-        grad_o = (1.0 / settings.OBS_VARIANCE ) * np.dot(P, Q)
-    elif R_inv:
-        J_o = 1.0 * P @ R_inv @ Q
-    else:
-        raise ValueError("Either R_inv or sigma must be non-zero")
+    R_inv_Q = R_inv @ Q
 
+    J_o = 0.5 * np.dot(Q, R_inv_Q)
+    J_b = 0.5 * settings.ALPHA * np.dot(w, w)
+    J = J_b + J_o
+
+    if vjp is not None:
+        grad_o = vjp(H.T @ R_inv_Q)
+    else:
+        grad_o = P @ R_inv_Q
     grad_J = settings.ALPHA * w + grad_o
 
-    return grad_J
\ No newline at end of file
+    if settings.DEBUG:
+        print("J_b = {:.2f}, J_o = {:.2f}".format(J_b, J_o))
+    return J, grad_J
+
+
+def decode_with_vjp(w, data):
+    """Decodes w with data["model"] and returns the vector-Jacobian product
+    of the decoder at w. This avoids forming the (n x latent) Jacobian.
+    returns
+        :V_w - flattened decoded state (n,)
+        :vjp - function such that vjp(v) = J(w).T @ v for v of shape (n,)
+            (one backward pass through model.decode)"""
+    device = data.get("device")
+    model = data.get("model")
+
+    w_tensor = torch.tensor(np.asarray(w), dtype=torch.float, device=device,
+                            requires_grad=True)
+    with torch.enable_grad():
+        V_w = model.decode(w_tensor).flatten()
+
+    def vjp(v):
+        v = torch.as_tensor(np.asarray(v), dtype=V_w.dtype, device=V_w.device)
+        grad, = torch.autograd.grad(V_w, w_tensor, v, retain_graph=True)
+        return grad.detach().cpu().numpy().astype(float)
+
+    return V_w.detach().cpu().numpy().astype(float), vjp
+
+
+def get_AE_grad_mode(settings):
+    """Gradient calculation for full-space AE: "vjp" (backpropagation through
+    the decoder) or "jacobian" (explicit decoder jacobian)"""
+    if hasattr(settings, "AE_GRAD_MODE") and settings.AE_GRAD_MODE:
+        return settings.AE_GRAD_MODE
+    return "vjp"
+
+
+def cost_fn_J_batch(w, data, settings):
+    """Computes the sum of B independent VarDA cost functions.
+    The control variables are passed flattened (as required by
+    scipy.optimize.minimize) and are reshaped to (B x M) so that the
+    observation misfit of all states is a single matrix-matrix product.
+    Only valid when the cost function is linear in w (i.e. G_V is defined)"""
+
+    D = data.get("D")
+    G_V = data.get("G_V")
+    R_inv = get_R_inv(data, settings)
+
+    W = w.reshape((D.shape[0], -1))
+    Q = W @ G_V.T - D #(B x nobs)
+
+    J_o = 0.5 * np.sum((Q @ R_inv) * Q)
+
+    J_b = 0.5 * settings.ALPHA * np.sum(W * W)
+    J = J_b + J_o
+
+    return J
+
+
+def grad_J_batch(w, data, settings):
+    """Gradient of cost_fn_J_batch. Returns flattened (B x M) array"""
+    D = data.get("D")
+    G_V = data.get("G_V")
+    R_inv = get_R_inv(data, settings)
+
+    W = w.reshape((D.shape[0], -1))
+    Q = W @ G_V.T - D #(B x nobs)
+
+    grad_o = (Q @ R_inv) @ G_V
+
+    grad_J = settings.ALPHA * W + grad_o
+
+    return grad_J.flatten()
+
+
+def cost_and_grad_J_batch(w, data, settings, Q=None):
+    """Fused equivalent of cost_fn_J_batch and grad_J_batch.
+        :Q (opt) - pre-allocated (B x nobs) work buffer for the innovations
+    returns
+        :(J, grad_J) where grad_J is a flattened (B x M) array"""
+    D = data.get("D")
+    G_V = data.get("G_V")
+    R_inv = get_R_inv(data, settings)
+
+    W = w.reshape((D.shape[0], -1))
+    if Q is not None and isinstance(G_V, LowRankOperator):
+        G_V.T.rmatmul(W, out=Q)
+        Q -= D
+    elif Q is not None and isinstance(G_V, np.ndarray):
+        np.matmul(W, G_V.T, out=Q)
+        Q -= D
+    else:
+        Q = W @ G_V.T - D #(B x nobs)
+
+    R_inv_Q = Q @ R_inv
+
+    J_o = 0.5 * np.sum(R_inv_Q * Q)
+    J_b = 0.5 * settings.ALPHA * np.sum(W * W)
+    J = J_b + J_o
+
+    grad_J = settings.ALPHA * W + R_inv_Q @ G_V
+
+    return J, grad_J.flatten()
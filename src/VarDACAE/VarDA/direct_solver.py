@@ -0,0 +1,253 @@
+"""Closed-form solver for VarDA configurations in which the cost function is
+quadratic in w (i.e. COMPRESSION_METHOD = "SVD" or "AE" with REDUCED_SPACE = True)"""
+
+import numpy as np
+from scipy.linalg import solve_triangular
+
+from VarDACAE.VarDA.operators import ObsErrorInv, LowRankOperator
+
+
+class DirectSolver():
+    """Minimises the quadratic VarDA cost function
+            J(w) = 0.5 * ALPHA * w.T @ w + 0.5 * (G_V @ w - d).T @ R_inv @ (G_V @ w - d)
+    by solving the normal equations
+            (ALPHA * I + G_V.T @ R_inv @ G_V) @ w = G_V.T @ R_inv @ d
+    The matrix on the LHS is Cholesky factorised once at initialization so that
+    each subsequent control state (with the same observation locations) costs
+    only two triangular solves.
+
+    If G_V is a LowRankOperator U_o @ diag(s) @ W (where W has orthonormal rows
+    as for the TSVD background) the minimiser lies in the row space of W so
+    the system is solved in the k-dimensional coordinates z (w = W.T @ z):
+            (ALPHA * I + G_z.T @ R_inv @ G_z) @ z = G_z.T @ R_inv @ d
+    with G_z = U_o * s. This is a (k x k) rather than (M x M) factorisation.
+    """
+
+    def __init__(self, G_V, alpha, R_inv=None, obs_variance=None, obs_idx=None):
+        if R_inv is None and obs_variance is None:
+            raise ValueError("Either R_inv or obs_variance must be provided")
+
+        self.G_V_in = G_V
+        if isinstance(G_V, LowRankOperator):
+            self.W = G_V.W
+            G_V = np.asarray(G_V.U * G_V.s, dtype=float) #G_z
+        else:
+            self.W = None
+            G_V = np.asarray(G_V, dtype=float)
+
+        if R_inv is not None:
+            R_inv_G_V = R_inv @ G_V
+        else:
+            R_inv_G_V = ObsErrorInv.from_variance(obs_variance) @ G_V
+
+        A = alpha * np.eye(G_V.shape[1]) + G_V.T @ R_inv_G_V
+
+        self.L = np.linalg.cholesky(A) #lower triangular
+        self.R_inv_G_V = R_inv_G_V
+
+        #values used to check if cached factorisation is still valid
+        self.alpha = alpha
+        self.R_inv = R_inv
+        self.obs_variance = obs_variance
+        self.obs_idx = None if obs_idx is None else np.array(obs_idx)
+
+    def solve(self, d):
+        """Returns the exact minimiser w_opt for innovation vector d (nobs,)
+        or for a batch of innovations D (B x nobs) in which case
+        W_opt (B x M) is returned."""
+        batched = len(d.shape) == 2
+        rhs = self.R_inv_G_V.T @ (d.T if batched else d)
+
+        y = solve_triangular(self.L, rhs, lower=True)
+        w_opt = solve_triangular(self.L.T, y, lower=False)
+
+        if self.W is not None: #z -> w
+            w_opt = self.W.T @ w_opt
+
+        if batched:
+            w_opt = w_opt.T
+        return w_opt
+
+    def add_obs(self, g, r_inv):
+        """Rank-one update of the factorisation for a new observation with
+        row g of G_V (in the solver coordinates i.e. a row of G_z for a
+        LowRankOperator G_V) and inverse error variance r_inv: A += r_inv * g @ g.T.
+        NOTE: this only updates L. Use update_network() to also update the
+        observation rows used in solve()"""
+        self.L = chol_update(self.L, np.sqrt(r_inv) * np.asarray(g, dtype=float))
+
+    def remove_obs(self, g, r_inv):
+        """Rank-one downdate (A -= r_inv * g @ g.T) for a dropped observation.
+        See add_obs()"""
+        self.L = chol_downdate(self.L, np.sqrt(r_inv) * np.asarray(g, dtype=float))
+
+    def update_network(self, V_trunc, obs_idx):
+        """Updates the factorisation for a new observation network `obs_idx`
+        by a rank-one downdate for every dropped location and a rank-one update
+        for every new location i.e. O(k^2) per changed sensor rather than
+        O(nobs * k^2) for a new factorisation. Only the rows of the changed
+        locations are gathered from V_trunc (the background); the stored rows
+        of G_V and R_inv @ G_V are spliced (np.delete/np.insert) which is a single
+        O(nobs * k) copy. The new locations are inserted in sorted position so
+        self.obs_idx (and the rows of G_V) stay sorted if they were before.
+        Only implemented for R = OBS_VARIANCE * I and without super-observations.
+        returns
+            :G_V for the new network (rows in the order of self.obs_idx)"""
+        if self.obs_idx is None:
+            raise ValueError("The current observation locations are unknown (obs_idx = None)")
+        if self.G_V_in.shape[0] != len(self.obs_idx): #i.e. rows of G_V are super-observations
+            raise NotImplementedError("Network updates are not implemented for super-observations (SUPEROBS_FACTOR)")
+        r_inv = self.__get_scalar_r_inv()
+        obs_idx = np.asarray(obs_idx, dtype=np.int64).flatten()
+        if len(np.unique(obs_idx)) != len(obs_idx):
+            raise ValueError("obs_idx must not contain repeated locations")
+
+        removed = np.setdiff1d(self.obs_idx, obs_idx)
+        added = np.setdiff1d(obs_idx, self.obs_idx)
+        G_added = V_trunc[added]
+        rows_added = self.__get_rows(V_trunc, added, G_added)
+        for g in self.__get_rows(V_trunc, removed):
+            self.remove_obs(g, r_inv)
+        for g in rows_added:
+            self.add_obs(g, r_inv)
+
+        #splice the stored rows: drop removed locations, insert added ones
+        drop = np.flatnonzero(np.isin(self.obs_idx, removed))
+        kept_idx = np.delete(self.obs_idx, drop)
+        pos = np.searchsorted(kept_idx, added)
+        self.R_inv_G_V = np.insert(np.delete(self.R_inv_G_V, drop, axis=0), pos,
+                                   r_inv * rows_added, axis=0)
+        if isinstance(self.G_V_in, LowRankOperator):
+            U = np.insert(np.delete(self.G_V_in.U, drop, axis=0), pos, G_added.U, axis=0)
+            G_V = LowRankOperator(U, self.G_V_in.s, self.G_V_in.W)
+        else:
+            G_V = np.insert(np.delete(np.asarray(self.G_V_in), drop, axis=0), pos,
+                            np.asarray(G_added).reshape((len(added), -1)), axis=0)
+        self.G_V_in = G_V
+        self.obs_idx = np.insert(kept_idx, pos, added)
+        return G_V
+
+    def __get_rows(self, V_trunc, idx, G=None):
+        """Rows of V_trunc at locations idx (or of G = V_trunc[idx] if
+        already gathered) in the solver coordinates"""
+        if G is None:
+            G = V_trunc[idx]
+        if self.W is not None:
+            if not isinstance(G, LowRankOperator):
+                raise ValueError("V_trunc must be a LowRankOperator for a LowRankOperator G_V")
+            return np.asarray(G.U * G.s, dtype=float)
+        return np.asarray(G, dtype=float).reshape((len(idx), -1))
+
+    def __get_scalar_r_inv(self):
+        if self.R_inv is None:
+            if not np.isscalar(self.obs_variance):
+                raise NotImplementedError("Network updates are only implemented for R = OBS_VARIANCE * I")
+            return 1.0 / self.obs_variance
+        if isinstance(self.R_inv, ObsErrorInv) and np.isscalar(self.R_inv.r_inv):
+            return self.R_inv.r_inv
+        raise NotImplementedError("Network updates are only implemented for R = OBS_VARIANCE * I")
+
+    def is_valid(self, data, settings):
+        """Checks whether this factorisation was created for the
+        current G_V, observation locations and hyperparameters"""
+        G_V = data.get("G_V")
+        if G_V is not self.G_V_in:
+            return False
+        if self.alpha != settings.ALPHA:
+            return False
+        if self.R_inv is not data.get("R_inv"):
+            return False
+        if self.R_inv is None and not np.array_equal(self.obs_variance, settings.OBS_VARIANCE):
+            return False
+        obs_idx = data.get("obs_idx")
+        if (obs_idx is None) != (self.obs_idx is None):
+            return False
+        if obs_idx is not None and not np.array_equal(self.obs_idx, obs_idx):
+            return False
+        return True
+
+    @staticmethod
+    def from_data(data, settings):
+        """Returns the DirectSolver cached in `data` (if it is still valid)
+        or creates (and caches) a new factorisation."""
+        if settings.COMPRESSION_METHOD == "AE" and not settings.REDUCED_SPACE:
+            raise ValueError("The direct solver is only valid when the cost function is quadratic in w (i.e. not for full-space AE)")
+
+        solver = data.get("direct_solver")
+        if solver is not None and solver.is_valid(data, settings):
+            return solver
+
+        G_V = data.get("G_V")
+        if G_V is None:
+            raise ValueError("G_V must be initialized in `data` dict")
+        solver = DirectSolver(G_V, settings.ALPHA, data.get("R_inv"),
+                            settings.OBS_VARIANCE, data.get("obs_idx"))
+        data["direct_solver"] = solver
+        return solver
+
+
+def chol_update(L, x):
+    """Returns the Cholesky factor of L @ L.T + x @ x.T in O(k^2)
+    (by Givens rotations). L is (k x k) lower triangular and x is (k,)"""
+    return _chol_rank_one(L, x, 1.0)
+
+def chol_downdate(L, x):
+    """Returns the Cholesky factor of L @ L.T - x @ x.T in O(k^2).
+    Raises np.linalg.LinAlgError if the result is not positive definite"""
+    return _chol_rank_one(L, x, -1.0)
+
+def _chol_rank_one(L, x, sign):
+    L = np.array(L, dtype=float)
+    x = np.array(x, dtype=float).flatten()
+    k = L.shape[0]
+    for i in range(k):
+        r2 = L[i, i] ** 2 + sign * x[i] ** 2
+        if r2 <= 0:
+            raise np.linalg.LinAlgError("Cholesky downdate: matrix is not positive definite")
+        r = np.sqrt(r2)
+        c, s = r / L[i, i], x[i] / L[i, i]
+        L[i, i] = r
+        if i + 1 < k:
+            L[i + 1:, i] = (L[i + 1:, i] + sign * s * x[i + 1:]) / c
+            x[i + 1:] = c * x[i + 1:] - s * L[i + 1:, i]
+    return L
+
+
+class NestedDirectSolver():
+    """Exact minimisers of the TSVD-VarDA cost function for a set of nested
+    truncation levels k_1 < k_2 < ... < K. G_z = U_o * s (nobs x K) has its
+    columns ordered by singular value so the k-mode problem uses the leading
+    k columns and its normal-equation matrix
+            A_k = ALPHA * I + G_z[:, :k].T @ R_inv @ G_z[:, :k]
+    is the leading (k x k) block of A_K. The Cholesky factor of a leading block
+    is the leading block of the Cholesky factor (i.e. the factor grows by
+    bordering) so a single factorisation of A_K gives every level. The forward
+    substitution is also nested and only the back substitution (O(k^2)) is
+    performed per level. w_opt = W[:k].T @ z_k."""
+
+    def __init__(self, G_z, alpha, R_inv=None, obs_variance=None):
+        if R_inv is None and obs_variance is None:
+            raise ValueError("Either R_inv or obs_variance must be provided")
+        G_z = np.asarray(G_z, dtype=float)
+        if R_inv is None:
+            R_inv = ObsErrorInv.from_variance(obs_variance)
+        self.R_inv_G_z = R_inv @ G_z
+        A = alpha * np.eye(G_z.shape[1]) + G_z.T @ self.R_inv_G_z
+        self.L = np.linalg.cholesky(A)
+        self.max_level = G_z.shape[1]
+
+    def solve(self, d, levels):
+        """Returns a dict {k: z_k} of the minimisers in the k-mode coordinates
+        for innovation vector d (nobs,) or batch D (B x nobs) (in which
+        case z_k is (B x k))"""
+        batched = len(d.shape) == 2
+        rhs = self.R_inv_G_z.T @ (d.T if batched else d)
+        y = solve_triangular(self.L, rhs, lower=True)
+        res = {}
+        for k in levels:
+            if not 0 < k <= self.max_level:
+                raise ValueError("Truncation levels must be in [1, {}]. Got {}".format(self.max_level, k))
+            z = solve_triangular(self.L[:k, :k].T, y[:k], lower=False)
+            res[k] = z.T if batched else z
+        return res
+
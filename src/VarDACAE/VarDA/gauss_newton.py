@@ -0,0 +1,113 @@
+"""Incremental (Gauss-Newton) VarDA for the full-space AE where the
+cost function is non-linear in w"""
+
+import numpy as np
+import torch
+
+from VarDACAE.AEs import Jacobian
+from VarDACAE.VarDA.direct_solver import DirectSolver
+from VarDACAE.VarDA.operators import get_H, get_R_inv, IdentityOperator, ObsOperator
+
+
+class GaussNewtonSolver():
+    """Minimises the full-space AE cost function
+            J(w) = 0.5 * ALPHA * w.T @ w + 0.5 * Q.T @ R_inv @ Q,  Q = H @ decode(w) - d
+    with outer/inner loops. In each outer loop the decoder is linearised
+    around the current w_k:
+            H @ decode(w) ~= H @ decode(w_k) + HJ_k @ (w - w_k)
+    where HJ_k is the (nobs x L) observed decoder jacobian (from vmapped
+    jvps/vjps). The inner problem is then the quadratic VarDA problem with
+            G_V = HJ_k  and  d' = d - H @ decode(w_k) + HJ_k @ w_k
+    which is solved exactly with a DirectSolver. The step to the inner minimum
+    is then damped with a backtracking (Armijo) line search on the non-linear
+    cost so that the outer loops cannot cycle (e.g. around ReLU kinks).
+    Each outer loop costs one (batched) jacobian evaluation and one decoder
+    evaluation per line search step (usually one)."""
+
+    MAX_BACKTRACK = 10
+    ARMIJO_C = 1e-4
+
+    def __init__(self, data, settings):
+        if not (settings.COMPRESSION_METHOD == "AE" and not settings.REDUCED_SPACE):
+            raise ValueError("The Gauss-Newton solver is only required for the full-space AE. Use DA_SOLVER = `direct`")
+        self.settings = settings
+        self.model = data.get("model")
+        if self.model is None:
+            raise ValueError("model must be initialized in `data` dict")
+        param = next(self.model.parameters())
+        self.device, self.dtype = param.device, param.dtype
+        self.R_inv = data.get("R_inv")
+        self.R_inv_op = get_R_inv(data, settings)
+
+        H = get_H(data)
+        self.obs_agg = None
+        if isinstance(H, IdentityOperator):
+            self.obs_idx = None
+        elif isinstance(H, ObsOperator):
+            self.obs_idx = torch.tensor(H.obs_idx, device=self.device)
+            self.obs_agg = H.agg #super-observations (see SuperObs)
+        else:
+            raise ValueError("The Gauss-Newton solver requires an ObsOperator or IdentityOperator for G")
+
+        self.outer_loops = settings.GN_OUTER_LOOPS if hasattr(settings, "GN_OUTER_LOOPS") else 10
+        self.tol = settings.GN_TOL if hasattr(settings, "GN_TOL") else 1e-4
+        self.jac_mode = settings.JAC_MODE if hasattr(settings, "JAC_MODE") else "auto"
+        self.jac_max_bytes = settings.JAC_MAX_BYTES if hasattr(settings, "JAC_MAX_BYTES") else 2 ** 28
+
+    def observe(self, w):
+        """Returns H @ decode(w) (nobs,)"""
+        w = torch.as_tensor(np.asarray(w), dtype=self.dtype, device=self.device)
+        with torch.no_grad():
+            H_u = self.model.decode(w).flatten()
+        if self.obs_idx is not None:
+            H_u = H_u[self.obs_idx]
+        H_u = H_u.cpu().numpy().astype(float)
+        return H_u if self.obs_agg is None else self.obs_agg @ H_u
+
+    def linearize(self, w):
+        """Returns the observed jacobian HJ (nobs x L) of the decoder at w"""
+        w = torch.as_tensor(np.asarray(w), dtype=self.dtype, device=self.device)
+        HJ = Jacobian.vmap_model(w, self.model, self.device, self.jac_mode,
+                                self.jac_max_bytes, out_idx=self.obs_idx)
+        HJ = HJ.cpu().numpy().astype(float)
+        return HJ if self.obs_agg is None else self.obs_agg @ HJ
+
+    def cost(self, w, H_u, d):
+        Q = H_u - d
+        return 0.5 * self.settings.ALPHA * np.dot(w, w) + 0.5 * np.dot(Q, self.R_inv_op @ Q)
+
+    def minimize(self, d, w_0):
+        """Returns (w_opt, info) where info is a dict with the number of
+        outer loops (nit) and decoder evaluations (nfev)"""
+        w = np.asarray(w_0, dtype=float).flatten()
+        H_u = self.observe(w)
+        J = self.cost(w, H_u, d)
+        nit, nfev = 0, 1
+        for nit in range(1, self.outer_loops + 1):
+            HJ = self.linearize(w)
+            d_lin = d - H_u + HJ @ w
+
+            solver = DirectSolver(HJ, self.settings.ALPHA, self.R_inv,
+                                self.settings.OBS_VARIANCE)
+            p = solver.solve(d_lin) - w #Gauss-Newton direction
+
+            grad = self.settings.ALPHA * w + HJ.T @ (self.R_inv_op @ (H_u - d))
+            slope = np.dot(grad, p) #< 0 for a descent direction
+            lam = 1.0
+            for _ in range(self.MAX_BACKTRACK):
+                w_new = w + lam * p
+                H_u_new = self.observe(w_new)
+                J_new = self.cost(w_new, H_u_new, d)
+                nfev += 1
+                if J_new <= J + self.ARMIJO_C * lam * slope:
+                    break
+                lam *= 0.5
+            else:
+                break #no decrease along p: w is (numerically) optimal
+
+            step = np.linalg.norm(w_new - w)
+            w, H_u, J = w_new, H_u_new, J_new
+            if step <= self.tol * max(np.linalg.norm(w), 1.0):
+                break
+        info = {"nit": nit, "nfev": nfev}
+        return w, info
@@ -0,0 +1,69 @@
+"""Random observation networks (i.e. sets of observation locations)"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ObsNetwork():
+    """Generates random observation networks as sorted (read-only) int64
+    arrays of flat state indexes. Each network is drawn from its own local
+    np.random.Generator seeded by (seed, network index) so the global RNG
+    state is never used or modified (which makes this thread safe) and the
+    i-th network is the same regardless of how many networks are requested.
+    Networks are memoised per (seed, nobs, shape, network index)."""
+
+    MAX_CACHED = 256 #least recently used networks are evicted above this
+
+    _cache = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(seed, nobs, shape, network=0):
+        """Returns the `network`-th random network of `nobs` locations
+        in a state of shape `shape` as a sorted int64 array of shape (nobs,)"""
+        npoints = ObsNetwork.get_npoints(shape)
+        if nobs > npoints:
+            raise ValueError("You can't select more observations ({}) than are in the state space ({})".format(nobs, npoints))
+        key = (int(seed), int(nobs), npoints, int(network))
+        with ObsNetwork._lock:
+            obs_idx = ObsNetwork._cache.get(key)
+            if obs_idx is not None:
+                ObsNetwork._cache.move_to_end(key)
+                return obs_idx
+
+        obs_idx = ObsNetwork.__sample(*key)
+
+        with ObsNetwork._lock:
+            ObsNetwork._cache[key] = obs_idx
+            while len(ObsNetwork._cache) > ObsNetwork.MAX_CACHED:
+                ObsNetwork._cache.popitem(last=False)
+        return obs_idx
+
+    @staticmethod
+    def get_many(seed, nobs, shape, num_networks):
+        """Returns `num_networks` independent networks as a (read-only)
+        int64 array of shape (num_networks x nobs). Row i is get(.., network=i)"""
+        nets = np.stack([ObsNetwork.get(seed, nobs, shape, i) for i in range(num_networks)])
+        nets.flags.writeable = False
+        return nets
+
+    @staticmethod
+    def clear():
+        with ObsNetwork._lock:
+            ObsNetwork._cache.clear()
+
+    @staticmethod
+    def get_npoints(shape):
+        if isinstance(shape, (int, np.integer)):
+            return int(shape)
+        return int(np.prod(shape))
+
+    @staticmethod
+    def __sample(seed, nobs, npoints, network):
+        rng = np.random.default_rng([seed, network])
+        obs_idx = rng.choice(npoints, size=nobs, replace=False, shuffle=False)
+        obs_idx = np.sort(obs_idx).astype(np.int64)
+        obs_idx.flags.writeable = False
+        return obs_idx
@@ -0,0 +1,242 @@
+"""Matrix-free operators used in the VarDA cost function.
+These replace dense (nobs x n) observation matrices, (nobs x nobs)
+observation error matrices and the dense (n x M) truncated SVD background. All operators support the `@` operator
+(from both sides), `.T` and conversion to a dense array with np.asarray()"""
+
+import numpy as np
+
+
+class IdentityOperator():
+    """Identity operator of size (n x n). No storage is required."""
+
+    __array_ufunc__ = None #so that `ndarray @ op` defers to op.__rmatmul__
+
+    def __init__(self, n):
+        self.shape = (n, n)
+
+    def __matmul__(self, x):
+        return x
+
+    def __rmatmul__(self, x):
+        return x
+
+    @property
+    def T(self):
+        return self
+
+    def __array__(self, dtype=None, copy=None):
+        return np.eye(self.shape[0], dtype=dtype)
+
+
+class ObsOperator():
+    """Observation operator H that selects the state at the observation
+    locations `obs_idx`. H @ x is an index gather (rows of x if x is 2D) and
+    H.T @ y is a scatter-add back into state space.
+    This is equivalent to a (nobs x n) matrix of zeros with a single one in
+    each row but requires O(nobs) storage.
+    If `agg` (an aggregation operator of shape (nsup x nobs) e.g. SuperObs)
+    is given then H = agg @ H_obs i.e. the observations at obs_idx are
+    aggregated into nsup super-observations."""
+
+    __array_ufunc__ = None
+
+    def __init__(self, obs_idx, n, agg=None):
+        self.obs_idx = np.asarray(obs_idx, dtype=np.int64).flatten()
+        self.n = n
+        self.agg = agg
+        nobs = len(self.obs_idx) if agg is None else agg.shape[0]
+        self.shape = (nobs, n)
+
+    def __matmul__(self, x):
+        x = np.asarray(x)
+        if len(x.shape) == 1 or x.shape[0] == self.n:
+            x_obs = np.take(x, self.obs_idx, axis=0)
+        else:
+            #multidimensional state e.g. (nx x ny x nz)
+            x_obs = np.take(x.flatten(), self.obs_idx)
+        return x_obs if self.agg is None else self.agg @ x_obs
+
+    def __rmatmul__(self, y):
+        """y @ H for y of shape (nobs,) or (B x nobs). Returns (n,) or (B x n)"""
+        y = np.asarray(y)
+        return self.rmatvec(y.T).T
+
+    def rmatvec(self, y):
+        """H.T @ y for y of shape (nobs,) or (nobs x k)"""
+        y = np.asarray(y)
+        if self.agg is not None:
+            y = self.agg.rmatvec(y)
+        out = np.zeros((self.n,) + y.shape[1:], dtype=y.dtype)
+        np.add.at(out, self.obs_idx, y)
+        return out
+
+    @property
+    def T(self):
+        return _AdjointObsOperator(self)
+
+    def __array__(self, dtype=None, copy=None):
+        H = np.zeros((len(self.obs_idx), self.n), dtype=dtype)
+        H[np.arange(len(self.obs_idx)), self.obs_idx] = 1
+        return H if self.agg is None else np.asarray(self.agg, dtype=dtype) @ H
+
+
+class _AdjointObsOperator():
+    """H.T for an ObsOperator H"""
+
+    __array_ufunc__ = None
+
+    def __init__(self, H):
+        self.H = H
+        self.shape = H.shape[::-1]
+
+    def __matmul__(self, y):
+        return self.H.rmatvec(y)
+
+    def __rmatmul__(self, x):
+        return (self.H @ np.asarray(x).T).T
+
+    @property
+    def T(self):
+        return self.H
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.H, dtype=dtype).T
+
+
+class ObsErrorInv():
+    """Inverse observation error covariance R_inv for independent
+    observation errors. R_inv can be:
+        i) a scalar (R proportional to identity), or
+        ii) a vector of length nobs (i.e. per-sensor error variances)"""
+
+    __array_ufunc__ = None
+
+    def __init__(self, r_inv, nobs=None):
+        self.r_inv = r_inv if np.isscalar(r_inv) else np.asarray(r_inv, dtype=float)
+        if nobs is None and not np.isscalar(r_inv):
+            nobs = len(self.r_inv)
+        self.nobs = nobs
+
+    @staticmethod
+    def from_variance(variance, nobs=None):
+        """Creates R_inv from the observation error variance(s)"""
+        if np.isscalar(variance):
+            return ObsErrorInv(1.0 / variance, nobs)
+        return ObsErrorInv(1.0 / np.asarray(variance, dtype=float), nobs)
+
+    def __matmul__(self, Q):
+        """R_inv @ Q for Q of shape (nobs,) or (nobs x k)"""
+        Q = np.asarray(Q)
+        if np.isscalar(self.r_inv) or len(Q.shape) == 1:
+            return self.r_inv * Q
+        return self.r_inv[:, None] * Q
+
+    def __rmatmul__(self, Q):
+        """Q @ R_inv for Q of shape (nobs,) or (B x nobs)"""
+        return self.r_inv * np.asarray(Q)
+
+    @property
+    def T(self):
+        return self
+
+    @property
+    def shape(self):
+        return (self.nobs, self.nobs)
+
+    def __array__(self, dtype=None, copy=None):
+        if np.isscalar(self.r_inv):
+            if self.nobs is None:
+                raise ValueError("nobs must be provided to create a dense R_inv from a scalar")
+            return self.r_inv * np.eye(self.nobs, dtype=dtype)
+        return np.diag(self.r_inv).astype(dtype)
+
+
+class LowRankOperator():
+    """Low-rank operator A = U @ np.diag(s) @ W of shape (n x M) that is
+    stored in factored form (U: (n x k), s: (k,), W: (k x M)). Products
+    cost O((n + M) * k) rather than O(n * M) and storage is O((n + M) * k).
+    Used for the truncated SVD background V_trunc (and G_V = V_trunc[obs_idx])"""
+
+    __array_ufunc__ = None
+
+    def __init__(self, U, s, W):
+        self.U = U
+        self.s = np.asarray(s)
+        self.W = W
+        self.shape = (U.shape[0], W.shape[-1])
+
+    @property
+    def rank(self):
+        return len(self.s)
+
+    @property
+    def dtype(self):
+        return np.result_type(self.U, self.s, self.W)
+
+    def matmul(self, x, out=None):
+        """A @ x for x of shape (M,) or (M x B). The result is written
+        into `out` (if given) i.e. only the (k,) intermediate is allocated"""
+        x = np.asarray(x)
+        z = self.W @ x
+        z = self.s * z if len(x.shape) == 1 else self.s[:, None] * z
+        return np.matmul(self.U, z, out=out)
+
+    def rmatmul(self, y, out=None):
+        """y @ A for y of shape (n,) or (B x n) (written into `out` if given)"""
+        return np.matmul((np.asarray(y) @ self.U) * self.s, self.W, out=out)
+
+    def __matmul__(self, x):
+        return self.matmul(x)
+
+    def __rmatmul__(self, y):
+        return self.rmatmul(y)
+
+    def __getitem__(self, idx):
+        """Row gather e.g. A[obs_idx]. Returns a LowRankOperator"""
+        U = self.U[idx]
+        if len(U.shape) == 1: #single integer index
+            U = U[None, :]
+        return LowRankOperator(U, self.s, self.W)
+
+    @property
+    def T(self):
+        return LowRankOperator(self.W.T, self.s, self.U.T)
+
+    def pinv(self):
+        """Moore-Penrose pseudo-inverse (assuming U and W.T have
+        orthonormal columns as is the case for SVD factors).
+        Zero singular values are replaced by one (as in SVD.SVD_V_trunc_plus)"""
+        s = np.where(self.s <= 0., 1, self.s)
+        return LowRankOperator(self.W.T, 1 / s, self.U.T)
+
+    def __array__(self, dtype=None, copy=None):
+        A = self.U * self.s @ self.W
+        return A if dtype is None else A.astype(dtype)
+
+
+def get_H(data):
+    """Returns the observation operator for the `data` dict. i.e. data["G"]
+    if it is set or an ObsOperator built from data["obs_idx"] (and the
+    super-observation aggregation data["obs_agg"] if it is set)"""
+    G = data.get("G")
+    if G is not None:
+        return G
+    obs_idx = data.get("obs_idx")
+    if obs_idx is None:
+        raise ValueError("Either G or obs_idx must be initialized in `data` dict")
+    u_0 = data.get("u_0")
+    n = u_0.size if u_0 is not None else int(np.max(obs_idx)) + 1
+    return ObsOperator(obs_idx, n, data.get("obs_agg"))
+
+
+def get_R_inv(data, settings):
+    """Returns R_inv. If data["R_inv"] is not set, R is taken as
+    proportional to identity (or diagonal if settings.OBS_VARIANCE
+    is a vector) with settings.OBS_VARIANCE as variance"""
+    R_inv = data.get("R_inv")
+    if R_inv is not None:
+        return R_inv
+    variance = settings.OBS_VARIANCE
+    if variance is None or (np.isscalar(variance) and not variance):
+        raise ValueError("Either R_inv or sigma must be provided")
+    return ObsErrorInv.from_variance(variance)
@@ -0,0 +1,213 @@
+"""Process-pool execution of BatchDA. Read-only arrays (SVD factors, mean,
+std, u_0, control states etc.) are placed in shared memory and the torch model
+is shared (model.share_memory()) so that they are not copied to each worker"""
+
+import numpy as np
+import os
+import random
+import contextlib
+from multiprocessing import shared_memory
+
+import torch
+
+from VarDACAE.VarDA.operators import LowRankOperator
+
+
+#entries of DAPipeline.data that are not required (or cannot be pickled)
+#in the workers. encoder/decoder and V_grad are recreated in each worker
+_DROP_KEYS = ["X", "train_X", "test_X", "V", "encoder", "decoder", "V_grad",
+            "direct_solver", "D", "U_c"]
+
+_THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                    "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS"]
+
+_worker = {} #per-process state (set in _init_worker)
+
+
+class SharedArrays():
+    """Copies numpy arrays into multiprocessing.shared_memory blocks.
+    Arrays are replaced by SharedRef placeholders that are resolved
+    (without copying) in the worker processes with SharedArrays.attach()"""
+
+    def __init__(self):
+        self.specs = {}
+        self.__blocks = []
+
+    def add(self, array):
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        shared[...] = array
+        self.__blocks.append(shm)
+
+        key = shm.name
+        self.specs[key] = (array.shape, array.dtype.str)
+        return SharedRef(key)
+
+    def close(self):
+        for shm in self.__blocks:
+            shm.close()
+            shm.unlink()
+        self.__blocks = []
+
+    @staticmethod
+    def attach(specs):
+        """Returns a dict of read-only arrays (keyed by SharedRef.key)
+        and the list of attached SharedMemory blocks (which must be kept alive)"""
+        arrays, blocks = {}, []
+        for key, (shape, dtype) in specs.items():
+            shm = _attach_block(key)
+            arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            arr.flags.writeable = False
+            arrays[key] = arr
+            blocks.append(shm)
+        return arrays, blocks
+
+
+def _attach_block(name):
+    """Attaches to an existing block. The creating process is responsible for
+    unlinking it. (Before python 3.13 the block is also registered with the
+    resource tracker, which spawned workers share with the parent so it is
+    only unregistered once, on unlink)"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) #python >= 3.13
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedRef():
+    """Placeholder for an array in shared memory"""
+    def __init__(self, key):
+        self.key = key
+
+
+def share_data(data, shared):
+    """Returns a copy of the DAPipeline `data` dict that can be sent to
+    workers. Numeric arrays (and LowRankOperator factors) are moved to
+    `shared` (a SharedArrays instance)"""
+    out = {}
+    for k, v in data.items():
+        if k in _DROP_KEYS or k == "model":
+            continue
+        out[k] = _to_shared(v, shared)
+    return out
+
+def _to_shared(v, shared):
+    if isinstance(v, np.ndarray) and v.dtype != object:
+        return shared.add(v)
+    if isinstance(v, LowRankOperator):
+        return _SharedLowRank(_to_shared(v.U, shared), v.s, _to_shared(v.W, shared))
+    return v
+
+def _from_shared(v, arrays):
+    if isinstance(v, SharedRef):
+        return arrays[v.key]
+    if isinstance(v, _SharedLowRank):
+        return LowRankOperator(_from_shared(v.U, arrays), v.s, _from_shared(v.W, arrays))
+    return v
+
+
+class _SharedLowRank():
+    """Placeholder for a LowRankOperator with factors in shared memory"""
+    def __init__(self, U, s, W):
+        self.U, self.s, self.W = U, s, W
+
+
+@contextlib.contextmanager
+def thread_env(num_threads):
+    """Sets the BLAS/OpenMP thread count environment variables (which are
+    inherited by spawned processes) and restores them on exit"""
+    old = {k: os.environ.get(k) for k in _THREAD_ENV_VARS}
+    for k in _THREAD_ENV_VARS:
+        os.environ[k] = str(num_threads)
+    try:
+        yield
+    finally:
+        for k, v in old.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+def run_parallel(DA_pipeline, control_states, num_workers, threads_per_worker=1,
+                save_vtu=False, reconstruction=False):
+    """Assimilates each control state in a pool of `num_workers` processes.
+    The states are split into contiguous shards (several per worker for load
+    balancing) and each shard uses its own RNG stream from
+    np.random.SeedSequence(settings.SEED) so that the results do not depend on
+    which worker processes which shard.
+    returns
+        :list of BatchDA.assimilate_state() outputs ordered by state index"""
+    settings = DA_pipeline.settings
+    num_states = control_states.shape[0]
+    num_shards = min(num_states, 4 * num_workers)
+    shards = np.array_split(np.arange(num_states), num_shards)
+    seeds = np.random.SeedSequence(settings.SEED).spawn(num_shards)
+
+    model = DA_pipeline.data.get("model")
+    if model is not None:
+        model.share_memory()
+
+    shared = SharedArrays()
+    try:
+        worker_data = share_data(DA_pipeline.data, shared)
+        states_ref = shared.add(control_states)
+
+        ctx = torch.multiprocessing.get_context("spawn")
+        with thread_env(threads_per_worker):
+            pool = ctx.Pool(num_workers, initializer=_init_worker,
+                            initargs=(settings, worker_data, model, shared.specs,
+                                    states_ref, threads_per_worker, save_vtu, reconstruction))
+        try:
+            shard_results = pool.map(_run_shard, zip(shards, seeds))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shared.close()
+
+    results = [None] * num_states
+    for shard, res in zip(shards, shard_results):
+        for idx, r in zip(shard, res):
+            results[idx] = r
+    return results
+
+
+def _init_worker(settings, data, model, specs, states_ref, threads, save_vtu, reconstruction):
+    from VarDACAE.VarDA import DAPipeline, VDAInit
+
+    torch.set_num_threads(threads)
+    arrays, blocks = SharedArrays.attach(specs)
+    data = {k: _from_shared(v, arrays) for k, v in data.items()}
+
+    if model is not None:
+        data["model"] = model
+        encoder, decoder = VDAInit.create_encoder_decoder(model, settings, data.get("device"))
+        data["encoder"], data["decoder"] = encoder, decoder
+
+    DA_pipeline = DAPipeline(settings, data=data)
+    if settings.COMPRESSION_METHOD == "AE":
+        DA_pipeline.init_AE()
+
+    _worker.update({"DA_pipeline": DA_pipeline, "blocks": blocks,
+                    "control_states": arrays[states_ref.key],
+                    "save_vtu": save_vtu, "reconstruction": reconstruction})
+
+
+def _run_shard(args):
+    from VarDACAE.VarDA.batch_DA import BatchDA
+
+    idxs, seed_seq = args
+    seed = int(seed_seq.generate_state(1)[0])
+    np.random.seed(seed)
+    random.seed(seed)
+    torch.manual_seed(seed)
+
+    res = []
+    for idx in idxs:
+        u_c = np.array(_worker["control_states"][idx]) #writeable copy
+        res.append(BatchDA.assimilate_state(_worker["DA_pipeline"], u_c,
+                                            _worker["save_vtu"], _worker["reconstruction"],
+                                            keep_full=False))
+    return res
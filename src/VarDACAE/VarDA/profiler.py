@@ -0,0 +1,165 @@
+"""Per-assimilation instrumentation. A DAProfiler records the wall time of each
+phase of a single assimilation along with the solver iteration counts, the
+number of decoder evaluations and the peak memory allocated in each phase"""
+
+import contextlib
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+class DAProfiler():
+    """Phases (in order):
+            setup - initialisation of the background (SVD/AE) matrices
+            obs - observation selection and innovation (d) for u_c
+            minimize - minimisation of the cost function
+            decode - decoding of w_opt to the DA increment
+            unnorm - adding the increment to u_0 and undoing normalisation
+            metrics - calculation of the DA statistics
+    If trace_memory is True (settings.PROFILE_MEMORY), the memory of a phase
+    is the peak (numpy and python) memory allocated during the phase above
+    that allocated at its start (traced with tracemalloc so torch tensors are
+    not included). peak_mem_mb is the max over all phases. This is off by
+    default as tracemalloc hooks every allocation and so slows down (and skews
+    the timings of) the phases that it traces.
+    Phases should not be nested (the inner phase is timed but its memory is
+    attributed to the outer phase)
+    """
+    PHASES = ["setup", "obs", "minimize", "decode", "unnorm", "metrics"]
+    COUNTERS = ["nit", "nfev", "decoder_calls"]
+
+    def __init__(self, trace_memory=False):
+        self.times = {p: 0. for p in self.PHASES}
+        self.counts = {c: 0 for c in self.COUNTERS}
+        self.mem = {p: None for p in self.PHASES} #MB
+        self.trace_memory = trace_memory
+        self.__in_phase = False
+
+    @staticmethod
+    def from_settings(settings):
+        trace_memory = settings.PROFILE_MEMORY if hasattr(settings, "PROFILE_MEMORY") else False
+        return DAProfiler(trace_memory)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        with self.memory(name):
+            t1 = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.add_time(name, time.perf_counter() - t1)
+
+    @contextlib.contextmanager
+    def memory(self, name):
+        """Records the peak memory allocated in the context (above that at its
+        start) for phase `name`. Used directly for phases that are timed
+        separately (with add_time). Does nothing unless trace_memory is set"""
+        if name not in self.mem:
+            raise ValueError("phase must be in {}. Got {}".format(self.PHASES, name))
+        if not self.trace_memory or self.__in_phase:
+            yield
+            return
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        else:
+            tracemalloc.reset_peak()
+        mem_0, _ = tracemalloc.get_traced_memory()
+        self.__in_phase = True
+        try:
+            yield
+        finally:
+            self.__in_phase = False
+            _, peak = tracemalloc.get_traced_memory()
+            if started:
+                tracemalloc.stop()
+            mem = max(peak - mem_0, 0) / 2 ** 20
+            self.mem[name] = mem if self.mem[name] is None else max(self.mem[name], mem)
+
+    def add_time(self, name, t):
+        if name not in self.times:
+            raise ValueError("phase must be in {}. Got {}".format(self.PHASES, name))
+        self.times[name] += t
+
+    def record_solver(self, info):
+        """Records the nit/nfev from a solver info dict (or a scipy OptimizeResult)"""
+        for k in ["nit", "nfev"]:
+            v = info.get(k) if isinstance(info, dict) else getattr(info, k, None)
+            if v is not None:
+                self.counts[k] += int(v)
+
+    @contextlib.contextmanager
+    def count_decoder(self, data):
+        """Counts calls of data["decoder"] and data["model"].decode (which
+        are patched for the duration of the context)"""
+        patched = []
+        decoder = data.get("decoder")
+        if callable(decoder):
+            data["decoder"] = self.__counted(decoder)
+            patched.append((data, "decoder", decoder))
+        model = data.get("model")
+        if model is not None and hasattr(model, "decode"):
+            orig = model.__dict__.get("decode") #None unless already patched
+            model.decode = self.__counted(model.decode) #instance attribute shadows method
+            patched.append((model, "decode", orig))
+        try:
+            yield
+        finally:
+            for obj, name, orig in patched:
+                if isinstance(obj, dict):
+                    obj[name] = orig
+                elif orig is None:
+                    delattr(obj, name)
+                else:
+                    setattr(obj, name, orig)
+
+    def __counted(self, fn):
+        def counted_fn(*args, **kwargs):
+            self.counts["decoder_calls"] += 1
+            return fn(*args, **kwargs)
+        return counted_fn
+
+    def scaled(self, n):
+        """Returns a copy with phase times divided by n (e.g. the per-state
+        share of a batch of n states). Counters and memory are not scaled"""
+        prof = DAProfiler(self.trace_memory)
+        prof.times = {k: v / n for k, v in self.times.items()}
+        prof.counts = dict(self.counts)
+        prof.mem = dict(self.mem)
+        return prof
+
+    def peak_mem_mb(self):
+        """Max of the per-phase peak memory (MB). None if memory was not traced"""
+        mems = [m for m in self.mem.values() if m is not None]
+        return max(mems) if mems else None
+
+    def as_dict(self):
+        res = {"t_" + k: v for k, v in self.times.items()}
+        res.update(self.counts)
+        res["peak_mem_mb"] = self.peak_mem_mb()
+        return res
+
+
+def profile_columns():
+    return ["t_" + p for p in DAProfiler.PHASES] + DAProfiler.COUNTERS + ["peak_mem_mb"]
+
+
+def summarize(results_df, percentiles=(50, 90, 99)):
+    """Returns a DataFrame (one row per profile column in results_df) with
+    the mean, percentiles and max over all states"""
+    cols = [c for c in ["time", "time_online"] + profile_columns() if c in results_df.columns]
+    summary = {}
+    for c in cols:
+        vals = results_df[c].astype(float).values
+        vals = vals[~np.isnan(vals)]
+        row = {"mean": np.nan, "max": np.nan}
+        row.update({"p{}".format(p): np.nan for p in percentiles})
+        if len(vals) > 0:
+            row["mean"] = vals.mean()
+            for p, v in zip(percentiles, np.percentile(vals, percentiles)):
+                row["p{}".format(p)] = v
+            row["max"] = vals.max()
+        summary[c] = row
+    cols_out = ["mean"] + ["p{}".format(p) for p in percentiles] + ["max"]
+    return pd.DataFrame.from_dict(summary, orient="index")[cols_out]
@@ -0,0 +1,124 @@
+"""Regularisation path for the quadratic VarDA cost function. Used to select
+ALPHA (for a given OBS_VARIANCE) without re-solving the DA problem"""
+
+import numpy as np
+
+from VarDACAE.VarDA.operators import LowRankOperator
+
+
+class RegPathSolver():
+    """For R = OBS_VARIANCE * I the quadratic VarDA cost function
+            J(w) = 0.5 * ALPHA * w.T @ w + 0.5 / OBS_VARIANCE * |G_V @ w - d|^2
+    has minimiser
+            w_opt = (G_V.T @ G_V + mu * I)^-1 @ G_V.T @ d,   mu = ALPHA * OBS_VARIANCE
+    so only the product mu can be identified. With the (thin) SVD
+    G_V = P @ diag(sig) @ Q.T (computed once per observation network):
+            w_opt = Q @ (f / sig * P.T @ d),   f = sig^2 / (sig^2 + mu)
+    where f are the (Tikhonov) filter factors. After the projection c = P.T @ d
+    the analysis for any (ALPHA, OBS_VARIANCE) costs O(k) and the residual and
+    solution norms (for the L-curve and GCV) are also O(k) per value:
+            |G_V @ w_opt - d|^2 = sum(((1 - f) * c)^2) + |d|^2 - |c|^2
+            |w_opt|^2 = sum((f / sig * c)^2)
+
+    If G_V is a LowRankOperator U_o @ diag(s) @ W (TSVD background) the SVD
+    is of G_z = U_o * s (nobs x k) and w = W.T @ z."""
+
+    def __init__(self, G_V):
+        self.G_V_in = G_V
+        if isinstance(G_V, LowRankOperator):
+            self.W = np.asarray(G_V.W)
+            G = np.asarray(G_V.U * G_V.s, dtype=float)
+        else:
+            self.W = None
+            G = np.asarray(G_V, dtype=float)
+        self.nobs = G.shape[0]
+        self.P, self.sig, Qt = np.linalg.svd(G, full_matrices=False)
+        self.Q = Qt.T
+
+    @staticmethod
+    def from_data(data):
+        """Returns the RegPathSolver cached in `data` (if it was created for
+        the current G_V) or creates (and caches) a new one"""
+        G_V = data.get("G_V")
+        if G_V is None:
+            raise ValueError("G_V must be initialized in `data` dict")
+        solver = data.get("reg_path_solver")
+        if solver is None or solver.G_V_in is not G_V:
+            solver = RegPathSolver(G_V)
+            data["reg_path_solver"] = solver
+        return solver
+
+    def filter_factors(self, alpha, obs_variance):
+        """Returns f of shape (k,) or (len(alpha) x k) for a vector of alphas"""
+        mu = np.asarray(alpha, dtype=float) * obs_variance
+        sig2 = self.sig ** 2
+        return sig2 / (sig2 + mu[..., None])
+
+    def project(self, d):
+        """Returns c = P.T @ d (k,) or (k x B) for d (nobs,) or (B x nobs)"""
+        d = np.asarray(d, dtype=float)
+        return self.P.T @ (d.T if len(d.shape) == 2 else d)
+
+    def solve(self, d, alpha, obs_variance):
+        """Returns w_opt (M,) or (B x M) for innovation(s) d (nobs,) or (B x nobs)"""
+        batched = len(np.shape(d)) == 2
+        c = self.project(d)
+        f = self.filter_factors(alpha, obs_variance)
+        coef = np.divide(f, self.sig, out=np.zeros_like(f), where=self.sig > 0)
+        coef = coef[:, None] * c if batched else coef * c
+        w_opt = self.Q @ coef
+        if self.W is not None: #z -> w
+            w_opt = self.W.T @ w_opt
+        return w_opt.T if batched else w_opt
+
+    def path(self, d, alphas, obs_variance):
+        """Returns a dict of arrays (over alphas) with the residual norm
+        |G_V @ w - d|, the solution norm |w| and the GCV function. For a batch
+        of innovations D (B x nobs) the norms are over all states (i.e. a single
+        ALPHA for all states)"""
+        alphas = np.asarray(alphas, dtype=float)
+        d = np.asarray(d, dtype=float)
+        c = self.project(d)
+        c2 = c ** 2 if len(c.shape) == 1 else (c ** 2).sum(axis=1)
+        perp2 = max((d ** 2).sum() - c2.sum(), 0.) #component of d outside range(G_V)
+
+        F = self.filter_factors(alphas, obs_variance) #(A x k)
+        res2 = ((1 - F) ** 2) @ c2 + perp2
+        coef2 = np.divide(F ** 2, self.sig ** 2, out=np.zeros_like(F), where=self.sig > 0)
+        sol2 = coef2 @ c2
+        dof = self.nobs - F.sum(axis=1) #trace(I - influence matrix)
+        gcv = res2 / dof ** 2
+        return {"alpha": alphas, "residual_norm": np.sqrt(res2),
+                "solution_norm": np.sqrt(sol2), "gcv": gcv}
+
+    def select_alpha(self, d, alphas, obs_variance, method="gcv"):
+        """Selects ALPHA from `alphas` (for the given OBS_VARIANCE) by
+        minimising the GCV function (method="gcv") or at the point of
+        maximum curvature of the L-curve (method="lcurve").
+        returns
+            :alpha_opt, path (see RegPathSolver.path()) """
+        alphas = np.sort(np.asarray(alphas, dtype=float))
+        path = self.path(d, alphas, obs_variance)
+        if method == "gcv":
+            idx = np.argmin(path["gcv"])
+        elif method == "lcurve":
+            curvature = self.lcurve_curvature(path, obs_variance)
+            path["curvature"] = curvature
+            idx = np.nanargmax(curvature)
+        else:
+            raise ValueError("method must be in ['gcv', 'lcurve']. Got {}".format(method))
+        return alphas[idx], path
+
+    @staticmethod
+    def lcurve_curvature(path, obs_variance):
+        """Curvature of the L-curve (log |G_V @ w - d|, log |w|) parameterised
+        by log(mu). Computed with finite differences over the (sorted) alphas"""
+        if len(path["alpha"]) < 3:
+            raise ValueError("At least 3 values are required for the L-curve")
+        t = np.log(path["alpha"] * obs_variance)
+        x = np.log(path["residual_norm"])
+        y = np.log(path["solution_norm"])
+        dx, dy = np.gradient(x, t), np.gradient(y, t)
+        ddx, ddy = np.gradient(dx, t), np.gradient(dy, t)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (dx * ddy - ddx * dy) / (dx ** 2 + dy ** 2) ** 1.5
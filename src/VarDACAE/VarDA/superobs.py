@@ -0,0 +1,144 @@
+"""Super-observation thinning: (nearly redundant) neighbouring observations
+are averaged into a single super-observation before assimilation"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+from VarDACAE.VarDA.operators import LowRankOperator, ObsErrorInv
+
+
+class SuperObs():
+    """Aggregation operator S (nsup x nobs) that averages the observations in
+    each group. `groups` (nobs,) is the super-observation index of each
+    (raw) observation. The averaged innovation of a group of `count`
+    independent observations has variance sum(var_i) / count^2
+    (i.e. OBS_VARIANCE / count) so R_inv for the super-observations is
+    diagonal with count / OBS_VARIANCE.
+    S @ x is supported for x (nobs,), (nobs x k) and for a LowRankOperator
+    (e.g. G_V = S @ V_trunc[obs_idx]) in which case the result stays in
+    factored form"""
+
+    __array_ufunc__ = None
+
+    MAX_CACHED = 16
+
+    _cache = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, groups):
+        self.groups = np.asarray(groups, dtype=np.int64).flatten()
+        self.counts = np.bincount(self.groups)
+        if np.any(self.counts == 0):
+            raise ValueError("Super-observation groups must be labelled 0, ..., nsup - 1")
+        nsup, nobs = len(self.counts), len(self.groups)
+        self.S = sparse.csr_matrix((1.0 / self.counts[self.groups],
+                                    (self.groups, np.arange(nobs))), shape=(nsup, nobs))
+        self.shape = (nsup, nobs)
+        self.__R_inv = (None, None)
+
+    @staticmethod
+    def from_settings(settings, obs_idx, shape):
+        """Returns the SuperObs for observations at flat indexes `obs_idx` of a
+        state of shape `shape` (or None if settings.SUPEROBS_FACTOR is not set).
+        These are memoised (per obs_idx) so that the same network always gives
+        the same SuperObs (and R_inv) object"""
+        factor = settings.SUPEROBS_FACTOR if hasattr(settings, "SUPEROBS_FACTOR") else None
+        if not factor or factor == 1:
+            return None
+        mode = settings.SUPEROBS_MODE if hasattr(settings, "SUPEROBS_MODE") else "bin"
+
+        obs_idx = np.asarray(obs_idx, dtype=np.int64).flatten()
+        shape = tuple(shape) if np.iterable(shape) else (int(shape),)
+        key = (obs_idx.tobytes(), shape, factor, mode)
+        with SuperObs._lock:
+            agg = SuperObs._cache.get(key)
+            if agg is not None:
+                SuperObs._cache.move_to_end(key)
+                return agg
+
+        if mode == "bin":
+            agg = SuperObs.from_bins(obs_idx, shape, factor)
+        elif mode == "cluster":
+            agg = SuperObs.from_clusters(obs_idx, shape, factor)
+        else:
+            raise ValueError("SUPEROBS_MODE = {} is not allowed.".format(mode))
+
+        with SuperObs._lock:
+            SuperObs._cache[key] = agg
+            while len(SuperObs._cache) > SuperObs.MAX_CACHED:
+                SuperObs._cache.popitem(last=False)
+        return agg
+
+    @staticmethod
+    def from_bins(obs_idx, shape, factor):
+        """Groups observations that lie in the same cell of a grid that is
+        coarser by `factor` in every dimension of `shape` (i.e. up to
+        factor ** len(shape) observations per super-observation)"""
+        obs_idx = np.asarray(obs_idx, dtype=np.int64).flatten()
+        shape = tuple(shape) if np.iterable(shape) else (int(shape),)
+        coords = np.unravel_index(obs_idx, shape)
+        coarse_shape = tuple(-(-dim // factor) for dim in shape)
+        bins = np.ravel_multi_index(tuple(c // factor for c in coords), coarse_shape)
+        _, groups = np.unique(bins, return_inverse=True)
+        return SuperObs(groups)
+
+    @staticmethod
+    def from_clusters(obs_idx, shape, factor):
+        """Groups spatially neighbouring observations into clusters of `factor`
+        observations (i.e. nobs is reduced by `factor` except for a few smaller
+        clusters). The (unravelled) observation coordinates are recursively
+        bisected along their longest extent (a k-d tree) with each half holding
+        a multiple of `factor` observations"""
+        obs_idx = np.asarray(obs_idx, dtype=np.int64).flatten()
+        shape = tuple(shape) if np.iterable(shape) else (int(shape),)
+        factor = int(factor)
+        coords = np.stack(np.unravel_index(obs_idx, shape), axis=1)
+
+        groups = np.empty(len(obs_idx), dtype=np.int64)
+        label = 0
+        todo = [np.arange(len(obs_idx))]
+        while todo:
+            idx = todo.pop()
+            if len(idx) <= factor:
+                groups[idx] = label
+                label += 1
+                continue
+            c = coords[idx]
+            axis = np.argmax(c.max(axis=0) - c.min(axis=0))
+            idx = idx[np.argsort(c[:, axis], kind="stable")]
+            n_left = factor * ((len(idx) // factor + 1) // 2)
+            todo.append(idx[n_left:])
+            todo.append(idx[:n_left]) #i.e. left half is labelled first
+        return SuperObs(groups)
+
+    def variance(self, variance):
+        """Error variance of each super-observation (nsup,) from the
+        (scalar or (nobs,)) variance of the raw observations"""
+        if np.isscalar(variance):
+            return variance / self.counts
+        variance = np.asarray(variance, dtype=float)
+        return np.bincount(self.groups, weights=variance) / self.counts ** 2
+
+    def get_R_inv(self, variance):
+        """Returns the ObsErrorInv of the super-observations. The same object
+        is returned for the same variance (so cached factorisations stay valid)"""
+        last_variance, R_inv = self.__R_inv
+        if R_inv is None or not np.array_equal(last_variance, variance):
+            R_inv = ObsErrorInv.from_variance(self.variance(variance))
+            self.__R_inv = (variance, R_inv)
+        return R_inv
+
+    def __matmul__(self, x):
+        if isinstance(x, LowRankOperator):
+            return LowRankOperator(self.S @ np.asarray(x.U), x.s, x.W)
+        return self.S @ np.asarray(x)
+
+    def rmatvec(self, y):
+        """S.T @ y for y of shape (nsup,) or (nsup x k)"""
+        return self.S.T @ np.asarray(y)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.S.toarray().astype(dtype) if dtype is not None else self.S.toarray()
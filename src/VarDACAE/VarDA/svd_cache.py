@@ -0,0 +1,168 @@
+"""Content-addressed on-disk cache for truncated SVD factors"""
+
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+
+from VarDACAE.VarDA import SVD
+
+
+class SVDCache():
+    """Caches the truncated SVD factors U, s, W of the training snapshots.
+    Entries are keyed by a hash of the training data and of the settings that
+    affect the decomposition, so changing HIST_FRAC, NORMALIZE, SHUFFLE_DATA
+    or the data itself can never reuse stale factors. Only the requested modes
+    are stored and factors are loaded memory-mapped. The least recently used
+    entries are evicted when the cache exceeds settings.SVD_CACHE_MAX_BYTES.
+
+    Each entry is a directory <cache_dir>/<key>/ containing U.npy, s.npy,
+    W.npy and meta.json"""
+
+    #settings (other than the data) that change the computed factors
+    KEY_SETTINGS = ["SVD_METHOD", "SVD_OVERSAMPLE", "SVD_POWER_ITERS", "SEED"]
+
+    def __init__(self, settings, cache_dir=None, max_bytes=None):
+        if cache_dir is None:
+            cache_dir = settings.INTERMEDIATE_FP + "svd_cache/"
+        if max_bytes is None:
+            max_bytes = settings.SVD_CACHE_MAX_BYTES if hasattr(settings, "SVD_CACHE_MAX_BYTES") else 2 ** 34
+        if cache_dir[-1] != "/":
+            cache_dir += "/"
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def get_key(train_X, settings):
+        """Returns a hash of the training snapshots and relevant settings"""
+        h = hashlib.sha1()
+        h.update(str((train_X.shape, str(train_X.dtype))).encode())
+
+        X = train_X.reshape((train_X.shape[0], -1))
+        for row in X: #hash row by row to avoid copying all of X
+            h.update(np.ascontiguousarray(row).data)
+
+        key_settings = {}
+        for name in SVDCache.KEY_SETTINGS:
+            if hasattr(settings, name):
+                key_settings[name] = getattr(settings, name)
+        key_settings["SVD_METHOD"] = SVD.get_SVD_method(settings)
+        h.update(json.dumps(key_settings, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def load(self, key, modes=None):
+        """Returns memory-mapped (U, s, W) truncated to `modes` or None if
+        the entry does not exist or has too few modes.
+        If modes is None the truncation is chosen according to Rossella et al.
+        (as in SVD.TSVD()) which requires that at least one stored singular
+        value is below the threshold or that the entry was saved with that
+        truncation (meta.json "threshold_modes")"""
+        entry = self.__entry_dir(key)
+        meta_fp = entry + "meta.json"
+        if not os.path.exists(meta_fp):
+            return None
+        with open(meta_fp, "r") as f:
+            meta = json.load(f)
+
+        s = np.load(entry + "s.npy")
+        stored = len(s)
+        if modes is None or modes == -1:
+            if modes is None:
+                threshold = np.sqrt(s[0])
+                if meta.get("threshold_modes") is not None:
+                    modes = meta["threshold_modes"]
+                elif s[-1] > threshold and not meta["complete"]:
+                    return None
+                else:
+                    modes = max(int((s > threshold).sum()), 1)
+            elif not meta["complete"]:
+                return None
+        elif modes > stored and not meta["complete"]:
+            return None
+
+        U = np.load(entry + "U.npy", mmap_mode="r")
+        W = np.load(entry + "W.npy", mmap_mode="r")
+
+        os.utime(meta_fp) #mark as recently used
+        return U[:, :modes], s[:modes], W[:modes]
+
+    def save(self, key, U, s, W, complete=False, threshold_modes=None):
+        """Saves factors to the cache and applies the eviction policy.
+            :complete - True if (U, s, W) contain every non-zero mode
+            :threshold_modes - the number of modes chosen by the Rossella et al.
+                threshold (if known) so that it can be reused by load(key, None)"""
+        entry = self.__entry_dir(key)
+        meta_fp = entry + "meta.json"
+        if os.path.exists(meta_fp):
+            with open(meta_fp, "r") as f:
+                meta = json.load(f)
+            if meta["modes"] >= len(s): #an entry with more modes already exists
+                if threshold_modes is not None and meta.get("threshold_modes") is None:
+                    meta["threshold_modes"] = int(threshold_modes)
+                    with open(meta_fp, "w") as f:
+                        json.dump(meta, f)
+                return
+        if not os.path.isdir(entry):
+            os.makedirs(entry)
+
+        np.save(entry + "U.npy", U)
+        np.save(entry + "s.npy", s)
+        np.save(entry + "W.npy", W)
+        meta = {"modes": len(s), "complete": bool(complete)}
+        if threshold_modes is not None:
+            meta["threshold_modes"] = int(threshold_modes)
+        with open(meta_fp, "w") as f:
+            json.dump(meta, f)
+
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Deletes least recently used entries until the cache is
+        smaller than self.max_bytes"""
+        if not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = self.__entry_dir(key)
+            if not os.path.exists(entry + "meta.json"):
+                continue
+            size = sum(os.path.getsize(entry + fp) for fp in os.listdir(entry))
+            entries.append((os.path.getmtime(entry + "meta.json"), size, key))
+
+        total = sum(e[1] for e in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.__entry_dir(key))
+            total -= size
+
+    def get_TSVD(self, train_X, V_fn, settings, modes=None):
+        """Returns truncated (U, s, W) for train_X from the cache or
+        computes them with SVD.TSVD (and saves them to the cache).
+            :V_fn - function that returns the (n x M) matrix V for TSVD.
+                This is only called if there is a cache miss."""
+        key = self.get_key(train_X, settings)
+        factors = self.load(key, modes)
+        if factors is not None:
+            return factors
+
+        V = V_fn()
+        #only the truncated factors are stored (in the cache)
+        _, U, s, W = SVD.TSVD(V, settings, modes, save=False)
+        complete = len(s) == min(V.shape) and SVD.get_SVD_method(settings) == "full"
+        self.save(key, U, s, W, complete, len(s) if modes is None else None)
+        return U, s, W
+
+    def __entry_dir(self, key):
+        return self.cache_dir + key + "/"
+
+    @staticmethod
+    def use_cache(settings):
+        """The cache is used when intermediate results are saved
+        (i.e. settings.SAVE) unless settings.SVD_CACHE = False"""
+        if hasattr(settings, "SVD_CACHE") and not settings.SVD_CACHE:
+            return False
+        return settings.SAVE
@@ -0,0 +1,162 @@
+"""Evaluation of a grid of VarDA hyperparameters (NUMBER_MODES, NOBS/OBS_FRAC,
+OBS_VARIANCE and ALPHA) over a set of control states for TSVD-VarDA"""
+
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.linalg import solve_triangular
+
+from VarDACAE.VarDA import DAPipeline
+from VarDACAE.VarDA.obs_network import ObsNetwork
+from VarDACAE.VarDA.superobs import SuperObs
+
+
+class DASweep():
+    """Evaluates every point of a parameter grid such as:
+            grid = {"NUMBER_MODES": [2, 8, 32], "NOBS": [100, 1000],
+                    "OBS_VARIANCE": [0.01, 0.05], "ALPHA": [0.1, 1.0]}
+    over the control states and returns a tidy DataFrame with one row per
+    (grid point, state). Parameters that are not in the grid are taken from
+    settings. The following are shared between grid points:
+        - the data (loaded/split once in DAPipeline via data/context.py)
+        - the TSVD factors (a single TSVD with max(NUMBER_MODES) modes is
+          truncated for each NUMBER_MODES)
+        - the observation network for each NOBS (ObsNetwork)
+        - per network: G_z = U[obs_idx] * s, its Gram matrix G_z.T @ G_z
+          and the projected innovations G_z.T @ D for all states.
+    Each (NUMBER_MODES, OBS_VARIANCE, ALPHA) then only requires a (k x k)
+    Cholesky factorisation of the leading block. The per-network products and
+    then every grid point are evaluated as separate tasks in a thread pool.
+    Only the numpy (BLAS/LAPACK) work releases the GIL so the threads speed up
+    the products, factorisations and decoding of the increments (which dominate
+    for large n) while the per-state statistics (calc_DA_stats, mostly python)
+    are largely serialised by the GIL. The DA results are the exact minimisers
+    (i.e. the same as DA_SOLVER = "direct"). With SUPEROBS_FACTOR each
+    network is aggregated into super-observations (with the R_inv of
+    SuperObs.get_R_inv). The DA increments are decoded (and the stats
+    calculated) for CHUNK_SZ states at a time"""
+
+    PARAMS = ["NUMBER_MODES", "NOBS", "OBS_FRAC", "OBS_VARIANCE", "ALPHA"]
+    CHUNK_SZ = 64
+
+    def __init__(self, settings, control_states=None):
+        if settings.COMPRESSION_METHOD != "SVD":
+            raise NotImplementedError("DASweep is only implemented for COMPRESSION_METHOD = 'SVD'")
+        if settings.OBS_MODE != "rand":
+            raise ValueError("DASweep requires OBS_MODE = 'rand'")
+        self.settings = settings
+        self.DA_pipeline = DAPipeline(settings)
+        self.data = self.DA_pipeline.data
+        if control_states is None:
+            control_states = self.data.get("test_X")
+        self.control_states = control_states
+
+    def run(self, grid, num_workers=1):
+        """Evaluates `grid` (dict of parameter name: list of values) with
+        `num_workers` threads. Returns a DataFrame with the grid parameters,
+        `state_idx` and the DA results for each state"""
+        grid = self.__check_grid(grid)
+        obs_key = "OBS_FRAC" if "OBS_FRAC" in grid else "NOBS"
+
+        U, s, W = self.__get_factors(max(grid["NUMBER_MODES"]))
+        if max(grid["NUMBER_MODES"]) > len(s):
+            raise ValueError("NUMBER_MODES = {} is larger than the number of available modes ({}) "
+                        "i.e. min(n, M)".format(max(grid["NUMBER_MODES"]), len(s)))
+
+        B = self.control_states.shape[0]
+        U_c = self.control_states.reshape((B, -1))
+        u_0 = self.data["u_0"].flatten()
+        npoints = U_c.shape[1]
+        state_shape = self.control_states.shape[1:]
+        seed = self.settings.SEED
+        network = self.settings.OBS_NETWORK if hasattr(self.settings, "OBS_NETWORK") else 0
+
+        def prepare_network(obs_val):
+            nobs = obs_val if obs_key == "NOBS" else int(obs_val * npoints)
+            obs_idx = ObsNetwork.get(seed, nobs, npoints, network)
+            G_z = U[obs_idx] * s #(nobs x K)
+            D = U_c[:, obs_idx] - u_0[obs_idx] #(B x nobs)
+            r_inv = np.ones(len(obs_idx)) #R_inv * OBS_VARIANCE
+            obs_agg = SuperObs.from_settings(self.settings, obs_idx, state_shape)
+            if obs_agg is not None:
+                G_z = obs_agg @ G_z
+                D = (obs_agg @ D.T).T
+                r_inv = 1.0 / obs_agg.variance(1.0) #i.e. get_R_inv(OBS_VARIANCE) * OBS_VARIANCE
+            gram = G_z.T @ (r_inv[:, None] * G_z)
+            rhs = G_z.T @ (r_inv[:, None] * D.T) #(K x B)
+            return obs_val, nobs, gram, rhs
+
+        def run_point(net, k, obs_var, alpha):
+            obs_val, nobs, gram, rhs = net
+            t1 = time.time()
+            A = alpha * np.eye(k) + gram[:k, :k] / obs_var
+            L = np.linalg.cholesky(A)
+            y = solve_triangular(L, rhs[:k] / obs_var, lower=True)
+            z = solve_triangular(L.T, y, lower=False) #(k x B)
+            W_opt = (W[:k].T @ z).T #(B x M)
+            t_online = (time.time() - t1) / B
+
+            params = {"NUMBER_MODES": k, obs_key: obs_val, "nobs": nobs,
+                    "OBS_VARIANCE": obs_var, "ALPHA": alpha}
+            rows = []
+            for start in range(0, B, self.CHUNK_SZ):
+                chunk = range(start, min(start + self.CHUNK_SZ, B))
+                delta_u_DA = (U[:, :k] @ (s[:k, None] * z[:, chunk])).T #(chunk x n)
+                for i, idx in enumerate(chunk):
+                    res = DAPipeline.calc_DA_stats(delta_u_DA[i], W_opt[idx], self.data,
+                                                self.settings, u_c=U_c[idx])
+                    row = dict(params)
+                    row["state_idx"] = idx
+                    for key in ["percent_improvement", "ref_MAE_mean", "da_MAE_mean",
+                                "counts", "mse_ref", "mse_DA"]:
+                        row[key] = res[key]
+                    row["time_online"] = t_online
+                    rows.append(row)
+            return rows
+
+        with ThreadPoolExecutor(max_workers=max(int(num_workers), 1)) as pool:
+            networks = list(pool.map(prepare_network, grid[obs_key]))
+            futures = [pool.submit(run_point, net, k, obs_var, alpha)
+                        for net in networks
+                        for k, obs_var, alpha in itertools.product(grid["NUMBER_MODES"],
+                                                grid["OBS_VARIANCE"], grid["ALPHA"])]
+            results = [f.result() for f in futures]
+
+        df = pd.DataFrame([row for rows in results for row in rows])
+        return df.sort_values(["NUMBER_MODES", obs_key, "OBS_VARIANCE", "ALPHA",
+                                "state_idx"]).reset_index(drop=True)
+
+    def __check_grid(self, grid):
+        settings = self.settings
+        for k in grid:
+            if k not in self.PARAMS:
+                raise ValueError("Grid parameter must be in {}. Got {}".format(self.PARAMS, k))
+        if "NOBS" in grid and "OBS_FRAC" in grid:
+            raise ValueError("Only one of NOBS and OBS_FRAC can be in grid")
+
+        out = {}
+        defaults = {"NUMBER_MODES": settings.get_number_modes(),
+                    "OBS_VARIANCE": settings.OBS_VARIANCE,
+                    "ALPHA": settings.ALPHA}
+        if "NOBS" not in grid and "OBS_FRAC" not in grid:
+            if hasattr(settings, "NOBS"):
+                defaults["NOBS"] = settings.NOBS
+            else:
+                defaults["OBS_FRAC"] = settings.OBS_FRAC
+        for k, v in defaults.items():
+            out[k] = [v]
+        for k, v in grid.items():
+            out[k] = list(v) if np.iterable(v) else [v]
+
+        if None in out["NUMBER_MODES"]:
+            raise ValueError("NUMBER_MODES = None (Rossella et al. truncation) is not allowed in a sweep")
+        return out
+
+    def __get_factors(self, num_modes):
+        """Returns U, s, W for a TSVD with (at least) `num_modes` modes.
+        This is computed (or loaded from the SVD cache) once"""
+        U, s, W = self.DA_pipeline.init_SVD_modes(num_modes)
+        return np.asarray(U), np.asarray(s), np.asarray(W)
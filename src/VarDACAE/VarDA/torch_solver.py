@@ -0,0 +1,192 @@
+"""L-BFGS minimisation of the VarDA cost function in torch. Unlike the scipy
+(L-BFGS-B) solver, all DA state (w, d, the observation indexes and the model)
+stays on a single device with a single dtype so there are no numpy <-> torch
+conversions (or allocations) in each cost/gradient evaluation"""
+
+import numpy as np
+import torch
+
+from VarDACAE.VarDA.operators import get_H, get_R_inv
+from VarDACAE.VarDA.operators import IdentityOperator, ObsOperator, ObsErrorInv, LowRankOperator
+
+
+class TorchLBFGS():
+    """Minimises J(w) = 0.5 * ALPHA * w.T @ w + 0.5 * Q.T @ R_inv @ Q where
+    Q = G_V @ w - d (SVD or reduced-space AE) or Q = H @ decode(w) - d
+    (full-space AE) using torch.optim.LBFGS with a strong Wolfe line search.
+    The linear case accepts batched innovations D (B x nobs) in which case the
+    B independent cost functions are minimised together.
+
+    The stopping criteria follow scipy's L-BFGS-B: the minimisation stops when
+    the largest gradient component is below settings.TOL"""
+
+    MAX_ITER = 15000 #scipy defaults
+    HISTORY_SIZE = 10
+
+    #(private) torch.optim.LBFGS state that is read/written to carry the
+    #curvature pairs between minimisations. This is checked (once) against the
+    #installed torch version before any history is used
+    LBFGS_STATE_KEYS = ("d", "t", "old_dirs", "old_stps", "ro", "H_diag", "prev_flat_grad", "n_iter")
+    _state_keys_checked = False
+
+    def __init__(self, data, settings):
+        self.settings = settings
+        self.alpha = settings.ALPHA
+        self.full_space_AE = settings.COMPRESSION_METHOD == "AE" and not settings.REDUCED_SPACE
+        self.agg_groups = None
+
+        if self.full_space_AE:
+            self.model = data.get("model")
+            if self.model is None:
+                raise ValueError("model must be initialized in `data` dict")
+            param = next(self.model.parameters())
+            self.device, self.dtype = param.device, param.dtype
+
+            H = get_H(data)
+            if isinstance(H, IdentityOperator):
+                self.obs_idx = None
+            elif isinstance(H, ObsOperator):
+                self.obs_idx = torch.tensor(H.obs_idx, device=self.device)
+                if H.agg is not None: #super-observations (see SuperObs)
+                    self.agg_groups = torch.tensor(H.agg.groups, device=self.device)
+                    self.agg_counts = self.__tensor(H.agg.counts)
+            else:
+                raise ValueError("The torch solver requires an ObsOperator or IdentityOperator for G")
+        else:
+            device = data.get("device")
+            self.device = device if device is not None else torch.device("cpu")
+            self.dtype = torch.float64
+            G_V = data.get("G_V")
+            if G_V is None:
+                raise ValueError("G_V must be initialized in `data` dict")
+            if isinstance(G_V, LowRankOperator):
+                #G_V = U @ diag(s) @ W is kept in factored form
+                self.G_V = None
+                self.U = self.__tensor(G_V.U)
+                self.s = self.__tensor(G_V.s)
+                self.W = self.__tensor(G_V.W)
+            else:
+                self.G_V = self.__tensor(np.asarray(G_V))
+
+        R_inv = get_R_inv(data, settings)
+        if isinstance(R_inv, ObsErrorInv):
+            self.r_inv = self.__tensor(R_inv.r_inv) #scalar or per-sensor
+            self.R_inv = None
+        else:
+            self.r_inv = None
+            self.R_inv = self.__tensor(np.asarray(R_inv))
+
+    def __tensor(self, x):
+        return torch.as_tensor(np.asarray(x), dtype=self.dtype, device=self.device)
+
+    def cost(self, w, d):
+        """Torch VarDA cost function for w of shape (M,) and d (nobs,)
+        or (in the linear case) w of shape (B x M) and d (B x nobs)"""
+        if self.full_space_AE:
+            V_w = self.model.decode(w).flatten()
+            if self.obs_idx is not None:
+                V_w = V_w[self.obs_idx]
+            if self.agg_groups is not None:
+                V_w = torch.zeros_like(self.agg_counts).index_add(0, self.agg_groups, V_w) / self.agg_counts
+            Q = V_w - d
+        elif self.G_V is None:
+            Q = ((w @ self.W.T) * self.s) @ self.U.T - d
+        else:
+            Q = w @ self.G_V.T - d
+
+        if self.r_inv is not None:
+            R_inv_Q = self.r_inv * Q
+        else:
+            R_inv_Q = Q @ self.R_inv
+
+        J_o = 0.5 * (Q * R_inv_Q).sum()
+        J_b = 0.5 * self.alpha * (w * w).sum()
+        return J_b + J_o
+
+    def minimize(self, d, w_0, history=None):
+        """Returns (w_opt, info) where w_opt is a numpy array with the same
+        shape as w_0 and info is a dict with the number of iterations
+        (nit) and cost function evaluations (nfev).
+        If `history` is not None (e.g. {} for the first of a sequence of
+        related problems) the L-BFGS curvature pairs from a previous
+        minimisation in `history` are used to initialise the inverse Hessian
+        approximation and the final pairs are returned in info["history"]"""
+        d = self.__tensor(d)
+        w = self.__tensor(w_0).clone().requires_grad_(True)
+
+        optimizer = torch.optim.LBFGS([w], lr=1, max_iter=self.MAX_ITER,
+                                    max_eval=self.MAX_ITER * 5 // 4,
+                                    tolerance_grad=self.settings.TOL,
+                                    history_size=self.HISTORY_SIZE,
+                                    line_search_fn="strong_wolfe")
+        if history is not None:
+            self.check_lbfgs_state()
+        n_iter_0 = self.__load_history(optimizer, w, history) if history else 0
+
+        def closure():
+            optimizer.zero_grad()
+            J = self.cost(w, d)
+            J.backward()
+            return J
+
+        with torch.enable_grad():
+            optimizer.step(closure)
+
+        state = optimizer.state[w]
+        info = {"nit": state.get("n_iter", 0) - n_iter_0, "nfev": state.get("func_evals", 0)}
+        if history is not None:
+            info["history"] = self.__save_history(state, history)
+        w_opt = w.detach().cpu().numpy().astype(float)
+        return w_opt, info
+
+    @staticmethod
+    def check_lbfgs_state():
+        """Raises NotImplementedError if torch.optim.LBFGS does not store its
+        state under LBFGS_STATE_KEYS (in which case the L-BFGS history can't
+        be carried between minimisations with this torch version)"""
+        if TorchLBFGS._state_keys_checked:
+            return
+        w = torch.ones(2, requires_grad=True)
+        optimizer = torch.optim.LBFGS([w], max_iter=2, line_search_fn="strong_wolfe")
+
+        def closure():
+            optimizer.zero_grad()
+            J = (w * w * torch.tensor([1., 2.])).sum()
+            J.backward()
+            return J
+        optimizer.step(closure)
+
+        missing = [k for k in TorchLBFGS.LBFGS_STATE_KEYS if k not in optimizer.state[w]]
+        if missing:
+            raise NotImplementedError("torch.optim.LBFGS (torch {}) does not store {} in its state "
+                        "so the L-BFGS history can't be carried over".format(torch.__version__, missing))
+        TorchLBFGS._state_keys_checked = True
+
+    @staticmethod
+    def __load_history(optimizer, w, history):
+        """Sets the curvature pairs (s, y) and initial Hessian scaling of
+        `optimizer` from `history`. The optimizer then starts as if it were
+        in iteration 2 with a zero step (so no new pair is added) i.e. its
+        first direction is the L-BFGS direction from the stored pairs.
+        Returns the number of iterations that were skipped"""
+        if len(history.get("old_dirs", [])) == 0 or history["old_dirs"][0].shape != w.flatten().shape:
+            return 0
+        state = optimizer.state[w]
+        state["n_iter"] = 1
+        state["old_dirs"] = [y.clone() for y in history["old_dirs"]]
+        state["old_stps"] = [s.clone() for s in history["old_stps"]]
+        state["ro"] = list(history["ro"])
+        state["H_diag"] = history["H_diag"]
+        state["d"] = torch.zeros_like(w).flatten()
+        state["t"] = 0.
+        state["prev_flat_grad"] = torch.zeros_like(w).flatten()
+        return 1
+
+    @staticmethod
+    def __save_history(state, history):
+        old_dirs = state.get("old_dirs")
+        if not old_dirs: #converged before any pairs were stored
+            return history
+        return {"old_dirs": [y.detach().clone() for y in old_dirs],
+                "old_stps": [s.detach().clone() for s in state["old_stps"]],
+                "ro": list(state["ro"]), "H_diag": state["H_diag"]}
@@ -1,9 +1,12 @@
 import numpy as np
-import random
 import torch
 
 from VarDACAE import ML_utils
 from VarDACAE import SplitData
+from VarDACAE.data import context
+from VarDACAE.VarDA.operators import IdentityOperator, ObsOperator, ObsErrorInv
+from VarDACAE.VarDA.obs_network import ObsNetwork
+from VarDACAE.VarDA.superobs import SuperObs
 
 class VDAInit:
     def __init__(self, settings, AEmodel=None, u_c=None):
@@ -19,12 +22,10 @@ class VDAInit:
 
         data = {}
         loader = self.settings.get_loader()
-        splitter = SplitData()
         settings = self.settings
 
-        X = loader.get_X(settings)
-
-        train_X, test_X, u_c_std, X, mean, std = splitter.train_test_DA_split_maybe_normalize(X, settings)
+        #X is only loaded/split once per process (see data/context.py)
+        train_X, test_X, u_c_std, X, mean, std = context.get_split(settings, loader)
 
         if self.u_c is None:
             self.u_c = u_c_std
@@ -51,39 +52,9 @@ class VDAInit:
             if model is None:
                 model = ML_utils.load_model_from_settings(settings)
 
+            encoder, decoder = VDAInit.create_encoder_decoder(model, settings, device)
 
-            def __create_encoderOrDecoder(fn):
-                """This returns a function that deals with encoder/decoder
-                input dimensions (e.g. adds channel dim for 3D case)"""
-                def ret_fn(vec):
-                    vec = torch.Tensor(vec).to(device)
-
-                    #for 3D case, unsqueeze for channel
-                    if self.settings.THREE_DIM:
-                        dims = len(vec.shape)
-                        if dims == 3:
-
-                            vec = vec.unsqueeze(0)
-                        elif dims == 4:
-                            #batched input
-                            vec = vec.unsqueeze(1)
-                    with torch.no_grad():
-                        res = fn(vec).detach().cpu()
-                    #for 3D case, squeeze for channel
-                    dims = len(res.shape)
-                    if self.settings.THREE_DIM and dims > 2:
-                        if dims == 4:
-                            res = res.squeeze(0)
-                        elif dims == 5:   #batched input
-                            res = res.squeeze(1)
-                    return res.numpy()
-
-                return ret_fn
-
-            encoder = __create_encoderOrDecoder(model.encode)
-            decoder = __create_encoderOrDecoder(model.decode)
-
-        H_0, obs_idx = None, None
+        H_0, obs_idx, obs_agg = None, None, None
 
         if self.settings.REDUCED_SPACE == True:
             if self.settings.COMPRESSION_METHOD == "SVD":
@@ -94,7 +65,7 @@ class VDAInit:
             observations, H_0, w_0, d = self.__get_obs_and_d_reduced_space(self.settings, self.u_c, u_0, encoder)
 
         else:
-            observations, w_0, d, obs_idx = self.__get_obs_and_d_not_reduced(self.settings, self.u_c, u_0, encoder)
+            observations, w_0, d, obs_idx, obs_agg = self.__get_obs_and_d_not_reduced(self.settings, self.u_c, u_0, encoder)
 
         #TODO - **maybe** get rid of this monstrosity...:
         #i.e. you could return a class that has these attributes:
@@ -109,9 +80,51 @@ class VDAInit:
 
         if w_0 is not None:
             data["w_0"] = w_0
+        if obs_agg is not None:
+            data["obs_agg"] = obs_agg
+            data["R_inv"] = obs_agg.get_R_inv(self.settings.OBS_VARIANCE)
 
         return data
 
+    @staticmethod
+    def create_encoder_decoder(model, settings, device=None):
+        """Returns (encoder, decoder) functions for `model` that take and
+        return numpy arrays (and deal with the channel dimension in the 3D case)"""
+        if device is None:
+            device = ML_utils.get_device()
+
+        def create_encoderOrDecoder(fn):
+            """This returns a function that deals with encoder/decoder
+            input dimensions (e.g. adds channel dim for 3D case)"""
+            def ret_fn(vec):
+                vec = torch.Tensor(vec).to(device)
+
+                #for 3D case, unsqueeze for channel
+                if settings.THREE_DIM:
+                    dims = len(vec.shape)
+                    if dims == 3:
+
+                        vec = vec.unsqueeze(0)
+                    elif dims == 4:
+                        #batched input
+                        vec = vec.unsqueeze(1)
+                with torch.no_grad():
+                    res = fn(vec).detach().cpu()
+                #for 3D case, squeeze for channel
+                dims = len(res.shape)
+                if settings.THREE_DIM and dims > 2:
+                    if dims == 4:
+                        res = res.squeeze(0)
+                    elif dims == 5:   #batched input
+                        res = res.squeeze(1)
+                return res.numpy()
+
+            return ret_fn
+
+        encoder = create_encoderOrDecoder(model.encode)
+        decoder = create_encoderOrDecoder(model.decode)
+        return encoder, decoder
+
     @staticmethod
     def create_V_from_X(X_fp, settings):
         """Creates a mean centred matrix V from input matrix X.
@@ -153,8 +166,10 @@ class VDAInit:
             if nobs == npoints: #then we are selecting all points
                 settings.OBS_MODE = "all"
                 return VDAInit.__select_all_obs(vec)
-            ML_utils.set_seeds(seed = settings.SEED) #set seeds so that the selected subset is the same every time
-            obs_idx = random.sample(range(npoints), nobs) #select nobs integers w/o replacement
+            #sorted int64 indexes from a local RNG seeded by SEED (the same subset every
+            #time and global RNG state is not modified). These are memoised
+            network = settings.OBS_NETWORK if hasattr(settings, "OBS_NETWORK") else 0
+            obs_idx = ObsNetwork.get(settings.SEED, nobs, vec.shape, network)
             observations = np.take(vec, obs_idx)
         elif settings.OBS_MODE == "single_max":
             nobs = 1
@@ -175,7 +190,8 @@ class VDAInit:
             :n - size of state space
             :nobs - number of observations
         returns
-            :H - numpy array of size (nobs x n)
+            :H - ObsOperator of size (nobs x n). This is matrix-free (an index
+                gather) but can be converted to a dense array with np.asarray(H)
         """
         if three_dim:
              nx, ny, nz = n
@@ -183,13 +199,9 @@ class VDAInit:
         else:
             assert type(n) == int
         if obs_mode == "all":
-            return 1 #i.e. identity but no need to store full size
-        H = np.zeros((nobs, n))
-        H[range(nobs), obs_idxs] = 1
+            return IdentityOperator(n) #i.e. identity but no need to store full size
+        H = ObsOperator(obs_idxs, n)
 
-        assert H[0, obs_idxs[0]] == 1, "1s were not correctly assigned"
-        assert H[0, (obs_idxs[0] + 1) % n ] == 0, "0s were not correctly assigned"
-        assert H[nobs - 1, obs_idxs[-1]] == 1, "1s were not correctly assigned"
         assert H.shape == (nobs, n)
 
         return H
@@ -197,14 +209,18 @@ class VDAInit:
     @staticmethod
     def create_R_inv(sigma, nobs):
         """Creates inverse of R: the observation error matrix.
-        Assume all observations are independent s.t. R = sigma**2 * identity.
+        Assume all observations are independent s.t. R = sigma**2 * identity
+        (or R = diag(sigma**2) if sigma is a vector of per-sensor values).
         args
-            :sigma - observation error variance
+            :sigma - observation error standard deviation (scalar or (nobs,) array)
             :nobs - number of observations
         returns
-            :R_inv - (nobs x nobs) array"""
+            :R_inv - (nobs x nobs) diagonal ObsErrorInv operator"""
 
-        R_inv = 1.0 / sigma ** 2 * np.eye(nobs)
+        if np.isscalar(sigma):
+            R_inv = ObsErrorInv(1.0 / sigma ** 2, nobs)
+        else:
+            R_inv = ObsErrorInv(1.0 / np.asarray(sigma, dtype=float) ** 2, nobs)
 
         assert R_inv.shape == (nobs, nobs)
 
@@ -232,11 +248,16 @@ class VDAInit:
         # print("observations", observations.shape)
         #
         d = observations.flatten() - u_0.flatten()[obs_idx]
-        assert settings.COMPRESSION_METHOD == "SVD"
 
         #d = observations - H_0 @ u_0.flatten()
 
-        return observations, w_0, d, obs_idx
+        #optional thinning into super-observations (averaged obs and d)
+        obs_agg = SuperObs.from_settings(settings, obs_idx, u_c.shape)
+        if obs_agg is not None:
+            observations = obs_agg @ np.asarray(observations).flatten()
+            d = obs_agg @ d
+
+        return observations, w_0, d, obs_idx, obs_agg
 
     @staticmethod
     def __get_obs_and_d_reduced_space(settings, u_c, u_0, encoder):
@@ -253,7 +274,7 @@ class VDAInit:
             d = observations - H_0 @ z_0.flatten()
         else:
 
-            H_0 = np.eye(len(z_c))
+            H_0 = IdentityOperator(len(z_c))
             #d = z_c - encoder(u_0)
             d = z_c
             observations = z_c
@@ -270,9 +291,14 @@ class VDAInit:
         if u_0 is None:
             raise ValueError("u_0 must be initialized in `data` dict")
 
-        observations, w_0, d, obs_idx= VDAInit.__get_obs_and_d_not_reduced(settings, u_c, u_0, encoder)
+        observations, w_0, d, obs_idx, obs_agg = VDAInit.__get_obs_and_d_not_reduced(settings, u_c, u_0, encoder)
         data["observations"] = observations
         data["obs_idx"] = obs_idx
+        if obs_agg is not None:
+            data["obs_agg"] = obs_agg
+            data["R_inv"] = obs_agg.get_R_inv(settings.OBS_VARIANCE)
+        elif data.get("obs_agg") is not None: #thinning has been switched off
+            data["obs_agg"], data["R_inv"] = None, None
         if w_0 is not None: #i.e. don't update if no result was returned
             data["w_0"] = w_0
 
@@ -302,6 +328,39 @@ class VDAInit:
             data["w_0"] = w_0
         return data
 
+    @staticmethod
+    def provide_u_c_batch_update_data(data, settings, U_c):
+        """Batched equivalent of provide_u_c_update_data_*.
+        Adds the (B x nobs) innovation matrix D for the control states U_c to
+        `data`. The observation locations must be independent of the control
+        state so the `data` dict must already have been initialized for a single
+        state (i.e. obs_idx or G must be set)."""
+        if len(U_c.shape) in [1, 3]:
+            raise ValueError("This is not batched control_state input")
+        B = U_c.shape[0]
+
+        if settings.REDUCED_SPACE:
+            encoder = data.get("encoder")
+            if encoder is None:
+                raise ValueError("Encoder must be initialized in `data` dict")
+            D = encoder(U_c).reshape((B, -1))
+        else:
+            if settings.OBS_MODE not in ["rand", "all"]:
+                raise ValueError("Batched DA requires observation locations that do not depend on the control state. OBS_MODE = {} is not allowed.".format(settings.OBS_MODE))
+            obs_idx = data.get("obs_idx")
+            u_0 = data.get("u_0")
+            if obs_idx is None:
+                raise ValueError("obs_idx must be initialized in `data` dict")
+            if u_0 is None:
+                raise ValueError("u_0 must be initialized in `data` dict")
+            D = U_c.reshape((B, -1))[:, obs_idx] - u_0.flatten()[obs_idx]
+            if data.get("obs_agg") is not None:
+                D = (data["obs_agg"] @ D.T).T
+
+        data["D"] = D
+        data["U_c"] = U_c
+        return data
+
     @staticmethod
     def create_V_red(X, encoder, settings, number_modes=None):
         V = VDAInit.create_V_from_X(X, settings)
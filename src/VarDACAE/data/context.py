@@ -0,0 +1,102 @@
+"""Process-level cache of the snapshot matrix X and of its train/test/DA split
+(and normalisation statistics) so that X is only loaded (and split) once per
+process. This is shared by VDAInit, BatchDA and GetData.
+
+NOTE: the cached arrays are shared between callers and must not be modified
+in place."""
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from VarDACAE import ML_utils
+from VarDACAE.data.split import SplitData
+
+_X_CACHE = OrderedDict()
+_SPLIT_CACHE = OrderedDict()
+
+
+def use_cache(settings):
+    return not hasattr(settings, "DATA_CACHE") or settings.DATA_CACHE
+
+def get_cache_size(settings):
+    if hasattr(settings, "DATA_CACHE_SIZE") and settings.DATA_CACHE_SIZE:
+        return settings.DATA_CACHE_SIZE
+    return 2
+
+def clear():
+    _X_CACHE.clear()
+    _SPLIT_CACHE.clear()
+
+
+def get_X_key(settings, loader):
+    """Returns a key that identifies X (or None if X is not cached because
+    it must be (re)generated)"""
+    fp = settings.get_X_fp()
+    if settings.FORCE_GEN_X or not os.path.exists(fp):
+        return None
+    stat = os.stat(fp)
+    loader_cls = type(loader)
+    return (os.path.abspath(fp), stat.st_mtime_ns, stat.st_size,
+            loader_cls.__module__ + "." + loader_cls.__qualname__,
+            str(settings.get_n()), bool(settings.THREE_DIM))
+
+def get_split_key(settings, loader):
+    X_key = get_X_key(settings, loader)
+    if X_key is None:
+        return None
+    #the shuffle uses the SEED environment variable (see ML_utils.set_seeds)
+    seed = os.environ.get("SEED", settings.SEED)
+    return X_key + (settings.HIST_FRAC, settings.TDA_IDX_FROM_END,
+                    bool(settings.NORMALIZE), bool(settings.SHUFFLE_DATA), str(seed))
+
+
+def get_X(settings, loader=None):
+    """Returns X in the M x n format (loaded with `loader`.get_X)"""
+    if loader is None:
+        loader = settings.get_loader()
+    key = get_X_key(settings, loader) if use_cache(settings) else None
+    if key is None:
+        return loader.get_X(settings)
+    if key in _X_CACHE:
+        _X_CACHE.move_to_end(key)
+        return _X_CACHE[key]
+    X = loader.get_X(settings)
+    _add(_X_CACHE, key, X, get_cache_size(settings))
+    return X
+
+def get_split(settings, loader=None):
+    """Cached equivalent of:
+            X = loader.get_X(settings)
+            SplitData.train_test_DA_split_maybe_normalize(X, settings)
+    returns
+        :train_X, test_X, u_c, X, mean, std"""
+    if loader is None:
+        loader = settings.get_loader()
+    key = get_split_key(settings, loader) if use_cache(settings) else None
+    if key is None:
+        X = loader.get_X(settings)
+        return SplitData.train_test_DA_split_maybe_normalize(X, settings)
+
+    if key in _SPLIT_CACHE:
+        _SPLIT_CACHE.move_to_end(key)
+        split, np_state = _SPLIT_CACHE[key]
+        if settings.SHUFFLE_DATA:
+            #reproduce the side effect of the split on the global RNGs
+            ML_utils.set_seeds()
+            np.random.set_state(np_state)
+        return split
+
+    X = get_X(settings, loader)
+    if not settings.NORMALIZE:
+        #train_X/test_X are views of X that are shuffled in place
+        X = X.copy()
+    split = SplitData.train_test_DA_split_maybe_normalize(X, settings)
+    _add(_SPLIT_CACHE, key, (split, np.random.get_state()), get_cache_size(settings))
+    return split
+
+def _add(cache, key, value, max_size):
+    cache[key] = value
+    while len(cache) > max_size: #evict least recently used
+        cache.popitem(last=False)
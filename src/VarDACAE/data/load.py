@@ -6,6 +6,7 @@ import os
 from VarDACAE.fluidity import VtkSave, vtktools
 from VarDACAE.data import augmentation
 from VarDACAE.data.split import SplitData
+from VarDACAE.data import context
 
 from vtk.util import numpy_support as nps
 
@@ -34,10 +35,8 @@ class GetData():
     def get_train_test_loaders(self, settings, batch_sz, num_workers = 6, small_debug=False):
 
 
-        X = self.get_X(settings)
-
-        splitter = SplitData()
-        train_X, test_X, DA_u_c, X_norm,  mean, std = splitter.train_test_DA_split_maybe_normalize(X, settings)
+        #X is only loaded/split once per process (see context.py)
+        train_X, test_X, DA_u_c, X_norm,  mean, std = context.get_split(settings, self)
 
         if small_debug: #take v. small subset of test and train (for speed)
             batch_sz = 3 #to test sizes
@@ -21,6 +21,8 @@ class Config():
         self.INTERMEDIATE_FP = self.HOME_DIR + "data_/small3D_intermediate/"
         self.FIELD_NAME = "Pressure"
         self.FORCE_GEN_X = False
+        self.DATA_CACHE = True #Keep the loaded X (and its split) in memory for reuse in this process
+        self.DATA_CACHE_SIZE = 2 #max number of cached X (and splits) before least recently used are evicted
         self.__n = 100040
         self.THREE_DIM = False # i.e. is representation in 3D tensor or 1D array
         self.SAVE = True
@@ -45,6 +47,11 @@ class Config():
                          # observation or a random subset
         self.OBS_FRAC = 0.005 # (with OBS_MODE=rand). fraction of state used as "observations".
                         # This is ignored when OBS_MODE = single_max
+        self.OBS_NETWORK = 0 #(with OBS_MODE=rand) index of the random observation network for this SEED
+        self.SUPEROBS_FACTOR = None #if set (> 1), observations are averaged into super-observations
+                        # with error variance OBS_VARIANCE / count. See VarDA/superobs.py
+        self.SUPEROBS_MODE = "bin" # "bin": grid coarsened by SUPEROBS_FACTOR in each dimension
+                        # "cluster": clusters of SUPEROBS_FACTOR neighbouring observations
 
 
         #VarDA hyperparams
@@ -57,8 +64,34 @@ class Config():
             # If NUMBER_MODES = None (and COMPRESSION_METHOD = "SVD"), we use
             # the Rossella et al. method for selection of truncation parameter
 
+        self.SVD_METHOD = "full" #"full", "randomized" or "snapshots". The randomized (range-finder)
+            # SVD only computes the leading NUMBER_MODES + SVD_OVERSAMPLE modes. "snapshots"
+            # is an out-of-core method of snapshots that streams X from get_X_fp()
+        self.SVD_OVERSAMPLE = 10 #(with SVD_METHOD=randomized) number of extra random vectors
+        self.SVD_POWER_ITERS = 2 #(with SVD_METHOD=randomized) number of power iterations
+        self.SVD_CHUNK_SZ = 2 ** 14 #(with SVD_METHOD=snapshots) state variables per chunk
+        self.SVD_NUM_WORKERS = 1 #(with SVD_METHOD=snapshots) number of worker processes
+        self.SVD_RANK_GUESS = 32 #(with SVD_METHOD=randomized and NUMBER_MODES = None)
+            # initial rank. This is doubled until the Rossella et al. threshold is reached
+        self.SVD_CACHE = True #Cache truncated SVD factors in INTERMEDIATE_FP + "svd_cache/"
+            # (keyed by a hash of the training data). Only used if SAVE = True
+        self.SVD_CACHE_MAX_BYTES = 2 ** 34 #least recently used factors are evicted above this size
+
         self.TOL = 1e-2 #Tolerance in VarDA minimization routine
+        self.DA_SOLVER = "L-BFGS-B" #"L-BFGS-B", "direct" or "torch". The direct solver gives the
+            # exact minimum (via a cached Cholesky factorisation) but can only be used
+            # when the cost function is quadratic in w (i.e. not for full-space AE).
+            # "torch" runs L-BFGS in torch (on the model's device) without numpy conversions.
+            # "gauss-newton" (full-space AE only) relinearises the decoder in outer loops
+        self.GN_OUTER_LOOPS = 10 #(with DA_SOLVER=gauss-newton) max number of relinearisations
+        self.GN_TOL = 1e-4 #(with DA_SOLVER=gauss-newton) stop when |w_k+1 - w_k| < GN_TOL * |w_k+1|
+        self.AE_GRAD_MODE = "vjp" #(full-space AE) "vjp" backpropagates the weighted innovation
+            # through the decoder once per iteration. "jacobian" forms the full decoder jacobian
         self.JAC_NOT_IMPLEM = True #whether explicit jacobian has been implemented
+        self.JAC_MODE = "auto" #(if JAC_NOT_IMPLEM) "fwd", "rev" or "auto" mode for Jacobian.vmap_model
+        self.JAC_MAX_BYTES = 2 ** 28 #memory budget for each chunk of jacobian products
+        self.PROFILE_MEMORY = False #trace the peak memory of each DA phase (with tracemalloc).
+            # This slows down the traced phases so is off by default. See VarDA/profiler.py
         self.export_env_vars()
 
     def get_loader(self):
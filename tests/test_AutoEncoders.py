@@ -160,6 +160,24 @@ class TestJacExplicit():
 
         assert torch.allclose(jac_true, jac_expl, rtol=1e-02), "Two jacobians are not equal"
 
+    def test_jac_vmap(self):
+        input_size = 7
+        hidden = [5, 6]
+        latent_dim = 3
+        Batch_sz = 4
+
+        model = ToyAE(input_size, latent_dim, "relu", hidden)
+        for decoder_input in [torch.rand((latent_dim,), requires_grad=True),
+                            torch.rand((Batch_sz, latent_dim), requires_grad=True)]:
+            decoder_output = model.decode(decoder_input)
+            jac_true = Jacobian.accumulated_slow(decoder_input, decoder_output)
+
+            for mode in ["fwd", "rev", "auto"]:
+                #small memory budget so that the basis vectors are chunked
+                jac = Jacobian.vmap_model(decoder_input, model, mode=mode, max_bytes=100)
+                assert jac.shape == jac_true.shape
+                assert torch.allclose(jac_true, jac, atol=1e-6), "Two jacobians are not equal"
+
 class TestCAE_3D():
     """These tests are the ToyAE equivalents of the above but are all placed here
     (rather than in respective classes such as TestAEInit and TestAEForward
@@ -251,4 +269,4 @@ class TestCAE_3D():
             pytest.fail("Unable to do forward pass")
 
         assert len(w.shape) == 1, "There should only be one dimension"
-        assert w.shape[0] == settings.get_number_modes()
\ No newline at end of file
+        assert w.shape[0] == settings.get_number_modes()
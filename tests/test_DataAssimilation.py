@@ -3,10 +3,30 @@ from VarDACAE.settings import base as config
 import pytest
 import numpy as np
 from VarDACAE.VarDA import VDAInit
-from VarDACAE.VarDA.SVD import TSVD
-from VarDACAE.VarDA.cost_fn import cost_fn_J
+from VarDACAE import SplitData, GetData
+from VarDACAE.data import context
+from VarDACAE.VarDA import SVD
+from VarDACAE.VarDA.SVD import TSVD, incremental_SVD_update, snapshot_TSVD
+from VarDACAE.VarDA.SVD import SVD_reconstruction_trunc, SVD_reconstruction_proj, SVD_reconstruction_errors
+from VarDACAE.VarDA.cost_fn import cost_fn_J, grad_J, cost_and_grad_J
+from VarDACAE.VarDA.cost_fn import cost_fn_J_batch, grad_J_batch, cost_and_grad_J_batch
+from VarDACAE.VarDA.svd_cache import SVDCache
+from VarDACAE.VarDA.operators import LowRankOperator, ObsOperator, get_H
+from VarDACAE.VarDA.torch_solver import TorchLBFGS
+from VarDACAE.VarDA.superobs import SuperObs
+from VarDACAE.VarDA import DirectSolver, BatchDA
+from VarDACAE.VarDA.gauss_newton import GaussNewtonSolver
+from VarDACAE.VarDA.profiler import DAProfiler, profile_columns
+from VarDACAE.VarDA.obs_network import ObsNetwork
+from VarDACAE.VarDA.sweep import DASweep
+from VarDACAE.VarDA.reg_path import RegPathSolver
+from VarDACAE.VarDA.direct_solver import chol_update, chol_downdate
 
 import numpy.random as random
+import pandas as pd
+import torch
+from VarDACAE.AEs import VanillaAE, Jacobian
+from VarDACAE.AEs.AE_general import GenCAE, MODES as M
 
 
 import os
@@ -34,6 +54,37 @@ class TestSetup():
 
         assert nobs == 3, "nobs should be 3"
 
+    def test_obs_network(self):
+        ObsNetwork.clear()
+        np.random.seed(3)
+        state = np.random.get_state()
+
+        obs_idx = ObsNetwork.get(42, 20, (10, 8, 5))
+        assert obs_idx.dtype == np.int64 and not obs_idx.flags.writeable
+        assert np.all(np.diff(obs_idx) > 0) and obs_idx.max() < 400 #sorted w/o replacement
+        assert ObsNetwork.get(42, 20, (10, 8, 5)) is obs_idx #memoised
+        assert np.array_equal(ObsNetwork.get(42, 20, 400), obs_idx)
+
+        nets = ObsNetwork.get_many(42, 20, 400, 3)
+        assert nets.shape == (3, 20)
+        assert np.array_equal(nets[0], obs_idx)
+        assert not np.array_equal(nets[1], nets[2])
+        assert not np.array_equal(ObsNetwork.get(43, 20, 400), obs_idx)
+
+        #global RNG state is untouched
+        assert np.array_equal(np.random.get_state()[1], state[1])
+        with pytest.raises(ValueError):
+            ObsNetwork.get(42, 401, 400)
+
+        settings = config.Config()
+        settings.OBS_FRAC = 0.05
+        u_c = random.rand(400)
+        _, obs_idx_1, _ = VDAInit.select_obs(settings, u_c)
+        settings.OBS_NETWORK = 2
+        _, obs_idx_2, _ = VDAInit.select_obs(settings, u_c)
+        assert np.array_equal(obs_idx_1, ObsNetwork.get(settings.SEED, 20, 400))
+        assert np.array_equal(obs_idx_2, ObsNetwork.get(settings.SEED, 20, 400, 2))
+
     def test_select_obs2(self):
         settings = config.Config()
         settings.OBS_MODE = "single_max"
@@ -175,6 +226,47 @@ class TestSetup():
         assert np.array_equal(std_exp, data.get("std"))
         assert np.array_equal(mean_exp, data.get("mean"))
 
+    def test_data_context(self, tmpdir):
+        class CountingLoader(GetData):
+            calls = 0
+            def get_X(self, settings):
+                CountingLoader.calls += 1
+                return super(CountingLoader, self).get_X(settings)
+
+        random.seed(0)
+        p = tmpdir.mkdir("inter").join("X_fp.npy")
+        p.dump(random.rand(20, 10))
+        settings = config.Config()
+        settings.set_X_fp(str(p))
+        settings.set_n(10)
+        settings.HIST_FRAC = 0.5
+        context.clear()
+        loader = CountingLoader()
+
+        split = context.get_split(settings, loader)
+        a = np.random.rand(5)
+        split_2 = context.get_split(settings, loader)
+        b = np.random.rand(5)
+        assert CountingLoader.calls == 1
+        assert all(x is y for x, y in zip(split, split_2))
+        assert np.allclose(a, b) #same global RNG state as an uncached split
+
+        settings.SHUFFLE_DATA = False #new split of the cached X
+        split_3 = context.get_split(settings, loader)
+        assert CountingLoader.calls == 1
+        assert not np.array_equal(split[0], split_3[0])
+        assert np.array_equal(np.sort(split[0], axis=0), np.sort(split_3[0], axis=0))
+
+        p.dump(random.rand(20, 10)) #new file contents
+        os.utime(str(p), ns=(0, 0))
+        context.get_split(settings, loader)
+        assert CountingLoader.calls == 2
+
+        settings.DATA_CACHE = False
+        context.get_split(settings, loader)
+        assert CountingLoader.calls == 3
+        context.clear()
+
 class TestTruncSVD():
 
 
@@ -188,6 +280,103 @@ class TestTruncSVD():
         V_trunc, U_trunc, s_trunc, W_trunc = TSVD(V, settings, trunc_idx = 5, test=True)
         V_trunc, U_trunc, s_trunc, W_trunc = TSVD(V, settings, trunc_idx = None, test=True)
 
+    def test_TSVD_randomized(self):
+        "Test randomized SVD gives the same leading modes as the full SVD"
+        settings = config.Config()
+        settings.SAVE = False
+        settings.DEBUG = False
+        random.seed(0)
+        V = random.rand(60, 8) @ random.rand(8, 30) + 1e-3 * random.rand(60, 30)
+
+        settings.SVD_METHOD = "full"
+        V_trunc, U, s, W = TSVD(V, settings, trunc_idx = 5)
+        _, _, s_ross, _ = TSVD(V, settings, trunc_idx = None)
+
+        settings.SVD_METHOD = "randomized"
+        settings.SVD_RANK_GUESS = 2
+        V_trunc_r, U_r, s_r, W_r = TSVD(V, settings, trunc_idx = 5, test=True)
+        _, _, s_ross_r, _ = TSVD(V, settings, trunc_idx = None)
+
+        assert U_r.shape == (60, 5)
+        assert np.allclose(s, s_r)
+        assert np.allclose(V_trunc, V_trunc_r)
+        assert len(s_ross) == len(s_ross_r)
+
+    def test_TSVD_save(self, tmpdir):
+        "Randomized factors don't overwrite the saved full SVD"
+        settings = config.Config()
+        settings.DEBUG = False
+        settings.SAVE = True
+        settings.INTERMEDIATE_FP = str(tmpdir) + "/"
+        settings.set_X_fp(settings.INTERMEDIATE_FP + "X_1D_Pressure.npy")
+        random.seed(0)
+        V = random.rand(40, 30)
+
+        settings.SVD_METHOD = "full"
+        TSVD(V, settings, trunc_idx = 3)
+        settings.SVD_METHOD = "randomized"
+        TSVD(V, settings, trunc_idx = 3)
+
+        s_full = np.load(settings.INTERMEDIATE_FP + "s_1D_Pressure.npy")
+        s_rand = np.load(settings.INTERMEDIATE_FP + "s_randomized_1D_Pressure.npy")
+        assert np.allclose(s_full, np.linalg.svd(V, compute_uv=False))
+        assert len(s_rand) == 3 + settings.SVD_OVERSAMPLE
+
+    def test_incremental_SVD_update(self):
+        random.seed(1)
+        V = random.rand(40, 5) @ random.rand(5, 20) #rank 5
+        C = random.rand(40, 3)
+        U, s, W = np.linalg.svd(V, False)
+        U, s, W = U[:, :5], s[:5], W[:5]
+
+        for forget in [1.0, 0.5]:
+            U_new, s_new, W_new = incremental_SVD_update(U, s, W, C, forget, max_rank=8)
+            V_new = np.concatenate([forget * V, C], axis=1)
+
+            assert W_new.shape == (8, 23)
+            assert np.allclose(U_new * s_new @ W_new, V_new)
+            assert np.allclose(s_new, np.linalg.svd(V_new, compute_uv=False)[:8])
+            assert np.allclose(U_new.T @ U_new, np.eye(8))
+
+    def test_snapshot_TSVD(self, tmpdir):
+        "Test out-of-core method of snapshots against TSVD"
+        random.seed(2)
+        X = random.rand(16, 50)
+        X_fp = str(tmpdir.join("X.npy"))
+        np.save(X_fp, X)
+
+        settings = config.Config()
+        settings.set_n(50)
+        settings.SAVE = False
+        settings.DEBUG = False
+        settings.NORMALIZE = True
+        settings.SHUFFLE_DATA = False
+        settings.HIST_FRAC = 0.75
+
+        train_X, _, _, _, _, _ = SplitData.train_test_DA_split_maybe_normalize(X, settings)
+        V = VDAInit.create_V_from_X(train_X, settings).T
+        V_trunc, U, s, W = TSVD(V, settings, trunc_idx = 4)
+
+        U_fp = str(tmpdir.join("U.npy"))
+        U_s, s_s, W_s = snapshot_TSVD(X_fp, settings, 4, U_fp=U_fp, chunk_sz=7, num_workers=2)
+
+        assert U_s.shape == (50, 4)
+        assert np.allclose(s, s_s)
+        assert np.allclose(V_trunc, U_s * s_s @ W_s)
+
+
+    def test_SVD_reconstruction_errors(self):
+        random.seed(3)
+        X = random.rand(5, 2, 3, 4)
+        U, s, W = np.linalg.svd(random.rand(24, 7), False)
+
+        X_hat = SVD_reconstruction_trunc(X, U, s, W, 3)
+        l1, l2 = SVD_reconstruction_errors(X, U, 3, chunk_sz=5)
+
+        assert np.allclose(SVD_reconstruction_proj(X, U, 3, chunk_sz=5), X_hat)
+        assert np.allclose(l1, np.abs(X_hat - X).reshape((5, -1)).sum(axis=1))
+        assert np.allclose(l2, ((X_hat - X) ** 2).reshape((5, -1)).sum(axis=1))
+
 
 class TestMinimizeJ():
     """End-to-end tests"""
@@ -267,6 +456,44 @@ class TestMinimizeJ():
         assert np.isclose(J_2, 1.5)
 
 
+    def test_cost_and_grad_J(self, tmpdir):
+        """Check fused cost/gradient against the separate functions"""
+        normalize = False
+        settings = self.__settings(tmpdir, normalize, force_init=True)
+        data = self.data
+        w = np.array([0.3, -1.2])
+
+        for R_inv in [None, self.R_inv]:
+            data["R_inv"] = R_inv
+            Q_buf = np.empty(self.nobs)
+
+            J, grad = cost_and_grad_J(w, data, settings, Q_buf)
+
+            assert np.isclose(J, cost_fn_J(w, data, settings))
+            assert np.allclose(grad, grad_J(w, data, settings))
+            assert np.allclose(Q_buf, self.G_V @ w - self.d)
+
+        #factored (TSVD) G_V writes into the buffers without a dense product
+        data["R_inv"] = None
+        U, s, W = np.linalg.svd(np.asarray(self.G_V, dtype=float), full_matrices=False)
+        G_V = data["G_V"]
+        data["G_V"] = LowRankOperator(U, s, W)
+        Q_buf = np.empty(self.nobs)
+        J_lr, grad_lr = cost_and_grad_J(w, data, settings, Q_buf)
+        assert np.allclose(Q_buf, self.G_V @ w - self.d)
+        assert np.isclose(J_lr, cost_fn_J(w, data, settings))
+        assert np.allclose(grad_lr, grad_J(w, data, settings))
+
+        data["D"] = np.stack([self.d, 2 * self.d])
+        W_batch = np.stack([w, -w])
+        Q_buf = np.empty(data["D"].shape)
+        J_lr, grad_lr = cost_and_grad_J_batch(W_batch.flatten(), data, settings, Q_buf)
+        assert np.allclose(Q_buf, W_batch @ np.asarray(self.G_V, dtype=float).T - data["D"])
+        assert np.isclose(J_lr, cost_fn_J_batch(W_batch.flatten(), data, settings))
+        assert np.allclose(grad_lr, grad_J_batch(W_batch.flatten(), data, settings))
+        data["G_V"] = G_V
+        data.pop("D")
+
     def test_minimize_J_normalized(self, tmpdir):
         """Check that system is finding correct answer found by
         rearranging gradient eqn"""
@@ -290,6 +517,25 @@ class TestMinimizeJ():
         assert np.allclose(LHS, RHS)
 
 
+    def test_minimize_J_direct(self, tmpdir):
+        """Check that the direct solver gives the exact solution of the
+        normal equations"""
+        normalize = True
+        settings = self.__settings(tmpdir, normalize, force_init=True)
+        settings.DA_SOLVER = "direct"
+
+        alpha = settings.ALPHA
+        DA = DAPipeline(settings)
+
+        w_opt_ret = DA.run()
+
+        prefix = self.G_V.T @ self.R_inv
+
+        LHS = prefix @ self.d
+        RHS = (prefix @ self.G_V + alpha * np.eye(w_opt_ret.shape[0])) @ w_opt_ret
+
+        assert np.allclose(LHS, RHS, atol=1e-12)
+
     def test_minimize_J_unnormalized(self, tmpdir):
         #Now check for normalized system
         normalize = False
@@ -325,6 +571,744 @@ class TestMinimizeJ():
         assert np.allclose(LHS, RHS)
 
 
+def small_settings(tmpdir):
+    """Settings for DA on a small (20 x 10) random dataset that is dumped to tmpdir"""
+    random.seed(0)
+    X = random.rand(20, 10)
+
+    p = tmpdir.mkdir("inter").join("X_fp.npy")
+    p.dump(X)
+
+    settings = config.Config()
+    settings.set_X_fp(str(p))
+    settings.set_n(10)
+    settings.FORCE_GEN_X = False
+    settings.OBS_MODE = "rand"
+    settings.OBS_FRAC = 0.5
+    settings.OBS_VARIANCE = 0.5
+    settings.TDA_IDX_FROM_END = 0
+    settings.HIST_FRAC = 0.5
+    settings.ALPHA = 1.0
+    settings.NUMBER_MODES = 3
+    settings.COMPRESSION_METHOD = "SVD"
+    settings.SAVE = False
+    settings.DEBUG = False
+    settings.TOL = 1e-10
+    settings.NORMALIZE = True
+    settings.SHUFFLE_DATA = False
+    return settings
+
+
+@pytest.fixture
+def settings(tmpdir):
+    return small_settings(tmpdir)
+
+
+class TestBatchedDA():
+    def test_batch_equals_sequential(self, settings):
+        DA = DAPipeline(settings)
+        control_states = DA.data.get("test_X")
+
+        batch_results = DA.DA_batch(control_states)
+
+        assert len(batch_results) == control_states.shape[0]
+        for idx, u_c in enumerate(control_states):
+            DA.data = VDAInit.provide_u_c_update_data_full_space(DA.data, settings, u_c)
+            results = DA.DA_SVD()
+            assert np.allclose(results["w_opt"], batch_results[idx]["w_opt"], atol=1e-5)
+            assert np.isclose(results["da_MAE_mean"], batch_results[idx]["da_MAE_mean"])
+
+    def test_batch_single_max_raises(self, settings):
+        DA = DAPipeline(settings)
+        settings.OBS_MODE = "single_max"
+        with pytest.raises(ValueError):
+            DA.DA_batch(DA.data.get("test_X"))
+
+    def test_BatchDA_reconstruction(self, settings):
+        DA = DAPipeline(settings)
+        control_states = DA.data.get("test_X")
+
+        df = BatchDA(settings, control_states, batch_sz=-1).run(print_every=100)
+        U, s, W = DA.init_SVD()["U"], DA.data["s"], DA.data["W"]
+        for idx, u_c in enumerate(control_states):
+            u_hat = SVD_reconstruction_trunc(u_c, U, s, W)
+            assert np.isclose(df["l1_loss"][idx], np.abs(u_hat - u_c).sum())
+            assert np.isclose(df["l2_loss"][idx], ((u_hat - u_c) ** 2).sum())
+
+    def test_BatchDA_reconstruction_AE(self, settings):
+        settings.COMPRESSION_METHOD = "AE"
+        settings.REDUCED_SPACE = True #batched DA is only available in the reduced space
+        torch.manual_seed(0)
+        model = VanillaAE(10, 3, hidden=[8])
+        control_states = DAPipeline(settings, model).data.get("test_X")
+
+        df_seq = BatchDA(settings, control_states, AEModel=model).run(print_every=100)
+        df_batch = BatchDA(settings, control_states, AEModel=model, batch_sz=-1).run(print_every=100)
+        assert df_batch["l1_loss"].notnull().all()
+        assert np.allclose(df_batch["l1_loss"], df_seq["l1_loss"].astype(float), rtol=1e-5)
+        assert np.allclose(df_batch["l2_loss"], df_seq["l2_loss"].astype(float), rtol=1e-5)
+
+    def test_BatchDA_parallel(self, settings):
+        DA = DAPipeline(settings)
+        control_states = DA.data.get("test_X")
+
+        df = BatchDA(settings, control_states).run(print_every=100)
+        df_par = BatchDA(settings, control_states, num_workers=2).run(print_every=100)
+
+        cols = [c for c in df.columns if not c.startswith("t") and c != "peak_mem_mb"]
+        assert list(df.columns) == list(df_par.columns)
+        assert np.allclose(df[cols].values.astype(float),
+                            df_par[cols].values.astype(float))
+
+        with pytest.raises(ValueError):
+            BatchDA(settings, control_states, batch_sz=2, num_workers=2).run()
+
+    def test_BatchDA_resume(self, tmpdir, settings, monkeypatch):
+        DA = DAPipeline(settings)
+        control_states = DA.data.get("test_X")
+        monkeypatch.chdir(tmpdir) #expdir is relative to the working directory
+        csv_fp = "experiments/batch/results.csv"
+
+        df = BatchDA(settings, control_states, csv_fp=csv_fp).run(print_every=100)
+        fp = str(tmpdir.join(csv_fp))
+        assert np.allclose(pd.read_csv(fp, index_col="state_idx")["mse_DA"], df["mse_DA"])
+
+        #simulate a crash after 3 states (with a partially written 4th row)
+        with open(fp) as f:
+            lines = f.readlines()
+        with open(fp, "w") as f:
+            f.writelines(lines[:4])
+            f.write(lines[4][:5])
+
+        df_res = BatchDA(settings, control_states, csv_fp=csv_fp, resume=True).run(print_every=100)
+        assert list(df_res.index) == list(range(len(control_states)))
+        for col in ["mse_DA", "da_MAE_mean", "percent_improvement", "l1_loss"]:
+            assert np.allclose(df_res[col].values.astype(float), df[col].values.astype(float))
+        df_file = pd.read_csv(fp)
+        assert sorted(df_file["state_idx"]) == list(range(len(control_states)))
+        assert np.allclose(df_file.sort_values("state_idx")["mse_DA"], df["mse_DA"])
+
+    def test_BatchDA_profile(self, settings):
+        DA = DAPipeline(settings)
+        control_states = DA.data.get("test_X")
+
+        batcher = BatchDA(settings, control_states)
+        df = batcher.run(print_every=100)
+        for col in profile_columns():
+            assert col in df.columns
+        assert (df["nit"] > 0).all() and (df["nfev"] >= df["nit"]).all()
+        assert (df["decoder_calls"] == 0).all() #SVD
+        assert (df["t_minimize"] <= df["time_online"]).all()
+        summary = batcher.profile_summary
+        assert list(summary.columns) == ["mean", "p50", "p90", "p99", "max"]
+        assert np.isclose(summary.loc["nit", "p50"], df["nit"].median())
+
+        df_batch = BatchDA(settings, control_states, batch_sz=-1).run(print_every=100)
+        assert (df_batch["nit"] == df_batch["nit"][0]).all() #one minimisation
+
+        settings.COMPRESSION_METHOD = "AE"
+        torch.manual_seed(0)
+        model = VanillaAE(10, 3, hidden=[8])
+        DA = DAPipeline(settings, model)
+        prof = DAProfiler()
+        results = DA.DA_AE(profiler=prof)
+        assert results["profile"]["decoder_calls"] > 0 and results["profile"]["nfev"] > 0
+        assert "decode" not in model.__dict__ #counting wrapper removed
+
+        #memory is only traced on request (tracemalloc slows down the phases)
+        assert df["peak_mem_mb"].isnull().all()
+        prof = DAProfiler()
+        with prof.phase("setup"):
+            big = np.ones(2 ** 21)
+        assert prof.as_dict()["peak_mem_mb"] is None
+
+        #memory is measured per phase (not the process lifetime peak)
+        prof = DAProfiler(trace_memory=True)
+        with prof.phase("setup"):
+            big = np.ones(2 ** 21) #16 MB
+        del big
+        with prof.phase("obs"):
+            small = np.ones(2 ** 10)
+        assert prof.mem["setup"] >= 16 and prof.mem["obs"] < 1
+        assert prof.as_dict()["peak_mem_mb"] == prof.mem["setup"]
+
+        settings.COMPRESSION_METHOD = "SVD"
+        settings.PROFILE_MEMORY = True
+        DA = DAPipeline(settings)
+        prof = DAProfiler.from_settings(settings)
+        DA.DA_SVD(profiler=prof)
+        assert all(prof.mem[p] is not None for p in ["minimize", "decode", "unnorm", "metrics"])
+        df = BatchDA(settings, control_states).run(print_every=100)
+        assert (df["peak_mem_mb"] < 16).all()
+
+    def test_BatchDA_cycle(self, settings, monkeypatch):
+        settings.NUMBER_MODES = 8
+        settings.TOL = 1e-8
+        settings.DA_SOLVER = "torch"
+        DA = DAPipeline(settings)
+        #time-correlated control states
+        control_states = DA.data["test_X"][0] + 0.02 * np.cumsum(random.randn(12, 10), axis=0)
+
+        df = BatchDA(settings, control_states, reconstruction=False).run(print_every=100)
+        df_cycle = BatchDA(settings, control_states, reconstruction=False,
+                            cycle=True).run(print_every=100)
+        batch_DA = BatchDA(settings, control_states, reconstruction=False,
+                            cycle=True, carry_lbfgs=True)
+        df_carry = batch_DA.run(print_every=100)
+
+        for df_warm in [df_cycle, df_carry]:
+            assert np.allclose(df_warm["mse_DA"], df["mse_DA"], rtol=1e-4)
+            assert df_warm["nit"].iloc[0] == df["nit"].iloc[0] #first state is a cold start
+        assert df_cycle["nit"].sum() <= df["nit"].sum()
+        assert df_carry["nit"].sum() < df_cycle["nit"].sum()
+        assert "lbfgs_history" not in batch_DA.DA_pipeline.data
+
+        with pytest.raises(ValueError):
+            BatchDA(settings, control_states, cycle=True, batch_sz=2)
+        with pytest.raises(ValueError):
+            BatchDA(settings, control_states, carry_lbfgs=True)
+        settings.DA_SOLVER = "L-BFGS-B"
+        with pytest.raises(ValueError):
+            BatchDA(settings, control_states, cycle=True, carry_lbfgs=True)
+        TorchLBFGS.check_lbfgs_state() #this torch version stores the expected LBFGS state
+        monkeypatch.setattr(TorchLBFGS, "_state_keys_checked", False)
+        monkeypatch.setattr(TorchLBFGS, "LBFGS_STATE_KEYS", TorchLBFGS.LBFGS_STATE_KEYS + ("not_a_key",))
+        with pytest.raises(NotImplementedError):
+            TorchLBFGS.check_lbfgs_state()
+
+class TestSVDBackground():
+    def test_update_SVD(self, settings):
+        DA = DAPipeline(settings)
+        DA.init_SVD()
+        M = DA.data["W"].shape[1]
+        X_new = random.rand(4, 10)
+
+        DA.update_SVD(X_new)
+
+        assert DA.data["W"].shape == (settings.NUMBER_MODES, M + 4)
+        assert DA.data["w_0"].shape == (M + 4,)
+        assert DA.data["G_V"].shape == (5, M + 4)
+        results = DA.DA_SVD()
+        assert np.isfinite(results["da_MAE_mean"])
+
+    def test_SVD_cache(self, tmpdir, settings):
+        settings.SAVE = True
+        settings.INTERMEDIATE_FP = str(tmpdir.mkdir("cache")) + "/"
+        DA = DAPipeline(settings)
+        DA.init_SVD()
+        U, s, W = DA.data["U"], DA.data["s"], DA.data["W"]
+
+        cache = SVDCache(settings)
+        key = cache.get_key(DA.data["train_X"], settings)
+        U_c, s_c, W_c = cache.load(key, 2) #subset of stored modes
+        assert isinstance(U_c, np.memmap)
+        assert np.allclose(U_c, U[:, :2]) and np.allclose(s_c, s[:2])
+        assert cache.load(key, 4) is None #only requested modes are stored
+
+        DA2 = DAPipeline(settings)
+        DA2.init_SVD()
+        assert np.allclose(DA2.data["W"], W)
+        assert np.allclose(DA2.data["G_V"], DA.data["G_V"])
+
+        #different settings must not reuse factors
+        settings.HIST_FRAC = 0.6
+        assert SVDCache.get_key(DAPipeline(settings).data["train_X"], settings) != key
+
+        cache.max_bytes = 0
+        cache.evict()
+        assert cache.load(key, 2) is None
+
+    def test_SVD_cache_threshold(self, tmpdir, settings, monkeypatch):
+        settings.SAVE = True
+        settings.NUMBER_MODES = None #Rossella et al. truncation
+        settings.INTERMEDIATE_FP = str(tmpdir.mkdir("cache")) + "/"
+        calls = []
+        TSVD_fn = SVD.TSVD
+        monkeypatch.setattr(SVD, "TSVD", lambda *args, **kwargs: calls.append(1) or TSVD_fn(*args, **kwargs))
+
+        results = [DAPipeline(settings).DA_SVD() for _ in range(3)]
+        assert len(calls) == 1
+        for res in results[1:]:
+            assert np.allclose(res["w_opt"], results[0]["w_opt"])
+        #only the cache entry is written (not the full factors)
+        assert os.listdir(settings.INTERMEDIATE_FP) == ["svd_cache"]
+
+    def test_DA_SVD_levels(self, tmpdir, settings):
+        DA = DAPipeline(settings)
+        before = DA.DA_SVD()
+        levels = [-1, 3, 1, 2]
+        results = DA.DA_SVD_levels(levels)
+        #the pipeline's NUMBER_MODES background is unchanged
+        assert DA.data["V_trunc"].rank == settings.NUMBER_MODES
+        assert np.allclose(DA.DA_SVD()["w_opt"], before["w_opt"])
+        assert list(results.keys()) == levels
+        assert results[-1]["num_modes"] == 10 #min(M_train, n)
+
+        for level in levels:
+            settings_k = small_settings(tmpdir.mkdir("modes{}".format(level)))
+            settings_k.DA_SOLVER = "direct"
+            settings_k.NUMBER_MODES = results[level]["num_modes"]
+            expected = DAPipeline(settings_k).DA_SVD()
+            assert np.allclose(results[level]["w_opt"], expected["w_opt"])
+            assert np.isclose(results[level]["da_MAE_mean"], expected["da_MAE_mean"])
+
+        with pytest.raises(ValueError):
+            DA.DA_SVD_levels([0, 2])
+
+class TestSolvers():
+    def test_torch_solver(self, settings):
+        settings.DA_SOLVER = "direct"
+        DA = DAPipeline(settings)
+        control_states = DA.data.get("test_X")
+        batch_direct = DA.DA_batch(control_states)
+        direct = DA.DA_SVD()
+
+        settings.DA_SOLVER = "torch"
+        settings.TOL = 1e-8
+        batch_torch = DA.DA_batch(control_states)
+        results = DA.DA_SVD()
+
+        assert np.allclose(results["w_opt"], direct["w_opt"], atol=1e-5)
+        assert np.isclose(results["da_MAE_mean"], direct["da_MAE_mean"])
+        for res_t, res_d in zip(batch_torch, batch_direct):
+            assert np.allclose(res_t["w_opt"], res_d["w_opt"], atol=1e-5)
+
+    def test_full_space_AE_vjp(self, settings):
+        settings.COMPRESSION_METHOD = "AE"
+        torch.manual_seed(0)
+        model = VanillaAE(10, 3, hidden=[8])
+        DA = DAPipeline(settings, model)
+        data = DA.init_AE()
+        assert data["V_grad"] is None
+        w = random.rand(3)
+
+        J, grad = cost_and_grad_J(w, data, settings)
+
+        settings.AE_GRAD_MODE = "jacobian"
+        DA.init_AE() #vmap jacobian engine
+        _, grad_vmap = cost_and_grad_J(w, data, settings)
+        data["V_grad"] = lambda x: Jacobian.accumulated_slow_model(x, model, data["device"])
+        J_jac, grad_jac = cost_and_grad_J(w, data, settings)
+        assert np.allclose(grad_vmap, grad_jac, atol=1e-5)
+        assert np.isclose(J, J_jac)
+        assert np.allclose(grad, grad_jac, atol=1e-5)
+        assert np.allclose(grad_J(w, data, settings), grad_jac, atol=1e-5)
+
+        settings.AE_GRAD_MODE = "vjp"
+        assert np.allclose(grad_J(w, data, settings), grad_jac, atol=1e-5)
+        results = DA.DA_AE()
+        assert np.isfinite(results["da_MAE_mean"])
+
+    def test_vmap_jacobian_without_jac_explicit(self, settings):
+        settings.COMPRESSION_METHOD = "AE"
+        settings.JAC_NOT_IMPLEM = False #as in base_CAE.py
+        settings.AE_GRAD_MODE = "jacobian"
+        torch.manual_seed(0)
+        conv = {"conv_kwargs": {"in_channels": 1, "out_channels": 2, "kernel_size": 3,
+                                "stride": 2, "padding": 1},
+                "dropout": False, "batch_norm": False}
+        model = GenCAE([M.S, (1, "conv", conv)]) #no jac_explicit
+        device = torch.device("cpu")
+        data = DAPipeline(settings, data={"model": model, "device": device}).init_AE()
+
+        z = model.encode(torch.rand(1, 1, 4, 4, 2))[0].detach()
+        J = data["V_grad"](z)
+        J_slow = Jacobian.accumulated_slow_model(z, model, device)
+        assert J.shape == (9, 8)
+        assert np.allclose(np.asarray(J.detach().cpu()), np.asarray(J_slow.detach().cpu()).reshape(J.shape), atol=1e-5)
+
+    def test_torch_solver_full_space_AE(self, settings):
+        settings.COMPRESSION_METHOD = "AE"
+        settings.OBS_NETWORK = 1 #a network where J has a well defined (smooth) minimum
+        torch.manual_seed(0)
+        DA = DAPipeline(settings, VanillaAE(10, 3, hidden=[8]))
+        data = DA.init_AE()
+
+        settings.TOL = 1e-8
+        w_scipy = DA.minimize_J(data, settings)
+        settings.DA_SOLVER = "torch"
+        w_opt = DA.minimize_J(data, settings)
+        assert np.allclose(w_opt, w_scipy, atol=1e-3)
+
+        J, _ = cost_and_grad_J(w_opt, data, settings)
+        J_scipy, _ = cost_and_grad_J(w_scipy, data, settings)
+        assert np.isclose(J, J_scipy, rtol=1e-5)
+
+    def test_gauss_newton_full_space_AE(self, settings):
+        settings.COMPRESSION_METHOD = "AE"
+        torch.manual_seed(0)
+        DA = DAPipeline(settings, VanillaAE(10, 3, hidden=[8]))
+        data = DA.init_AE()
+
+        settings.TOL = 1e-8
+        w_scipy = DA.minimize_J(data, settings)
+
+        settings.DA_SOLVER = "gauss-newton"
+        settings.GN_TOL = 1e-8
+        w_opt, info = GaussNewtonSolver(data, settings).minimize(data["d"], data["w_0"])
+
+        assert info["nit"] < settings.GN_OUTER_LOOPS
+        J, _ = cost_and_grad_J(w_opt, data, settings)
+        J_scipy, _ = cost_and_grad_J(w_scipy, data, settings)
+        assert J <= J_scipy * (1 + 1e-4) #cost is non-smooth (ReLU)
+        assert np.allclose(DA.minimize_J(data, settings), w_opt)
+
+class TestDirectSolver():
+    def test_direct_solver_cached(self, settings):
+        settings.DA_SOLVER = "direct"
+        DA = DAPipeline(settings)
+        control_states = DA.data.get("test_X")
+
+        batch_results = DA.DA_batch(control_states)
+        solver = DA.data.get("direct_solver")
+        assert solver is not None
+
+        for idx, u_c in enumerate(control_states):
+            DA.data = VDAInit.provide_u_c_update_data_full_space(DA.data, settings, u_c)
+            results = DA.DA_SVD()
+            assert DA.data.get("direct_solver") is solver
+            assert np.allclose(results["w_opt"], batch_results[idx]["w_opt"])
+
+        settings.ALPHA = 2.0
+        DA.DA_SVD()
+        assert DA.data.get("direct_solver") is not solver
+
+    def test_chol_update_downdate(self):
+        k = 6
+        A = random.rand(k, k)
+        A = A @ A.T + k * np.eye(k)
+        x = random.rand(k)
+        L = np.linalg.cholesky(A)
+        L_up = chol_update(L, x)
+        assert np.allclose(L_up, np.linalg.cholesky(A + np.outer(x, x)))
+        assert np.allclose(chol_downdate(L_up, x), L)
+        with pytest.raises(np.linalg.LinAlgError):
+            chol_downdate(L, 10 * np.sqrt(k) * np.ones(k))
+
+    def test_update_obs_network(self, settings):
+        settings.DA_SOLVER = "direct"
+        DA = DAPipeline(settings)
+        DA.DA_SVD()
+        solver = DA.data["direct_solver"]
+        obs_idx = DA.data["obs_idx"]
+        unobserved = np.setdiff1d(np.arange(10), obs_idx)
+
+        data = DA.update_obs_network(add_idx=unobserved[:2], remove_idx=obs_idx[:1])
+        new_idx = np.union1d(obs_idx[1:], unobserved[:2])
+        assert np.array_equal(data["obs_idx"], new_idx)
+        assert DirectSolver.from_data(data, settings) is solver #not refactorised
+
+        G_V = np.asarray(data["V_trunc"])[new_idx]
+        expected = DirectSolver(G_V, settings.ALPHA, obs_variance=settings.OBS_VARIANCE)
+        assert np.allclose(np.asarray(data["G_V"]), G_V)
+        assert np.allclose(solver.solve(data["d"]), expected.solve(data["d"]))
+
+        DA_results = DA.DA_SVD()
+        assert np.allclose(DA_results["w_opt"], expected.solve(data["d"]))
+        u_c = data["u_c"].flatten()
+        assert np.allclose(data["d"], u_c[new_idx] - data["u_0"].flatten()[new_idx])
+
+        with pytest.raises(ValueError):
+            DA.update_obs_network(np.array([1, 1, 2]))
+
+        #batched innovations follow the new network
+        control_states = data["test_X"]
+        data = VDAInit.provide_u_c_batch_update_data(data, settings, control_states)
+        data = DA.update_obs_network(remove_idx=new_idx[:1])
+        U_c = control_states.reshape((len(control_states), -1))
+        assert np.allclose(data["D"], U_c[:, new_idx[1:]] - data["u_0"].flatten()[new_idx[1:]])
+
+    def test_update_network_changed_rows_only(self):
+        np.random.seed(3)
+        U, s, W = np.linalg.svd(np.random.rand(12, 6), full_matrices=False)
+        V_lr = LowRankOperator(U[:, :4], s[:4], W[:4])
+        obs_idx = np.array([0, 2, 3, 5, 7, 8, 10])
+        new_idx = np.array([0, 1, 3, 5, 7, 10, 11])
+
+        class Recorder(): #records the rows gathered from V_trunc
+            def __init__(self, V):
+                self.V, self.gathered = V, []
+            def __getitem__(self, idx):
+                self.gathered.extend(np.atleast_1d(idx))
+                return self.V[idx]
+
+        for V_trunc in [V_lr, np.asarray(V_lr)]:
+            solver = DirectSolver(V_trunc[obs_idx], 0.5, obs_variance=0.1, obs_idx=obs_idx)
+            rec = Recorder(V_trunc)
+            G_V = solver.update_network(rec, new_idx)
+            assert sorted(rec.gathered) == [1, 2, 8, 11]
+            assert np.array_equal(solver.obs_idx, new_idx)
+
+            expected = DirectSolver(V_trunc[new_idx], 0.5, obs_variance=0.1)
+            assert np.allclose(np.asarray(G_V), np.asarray(V_trunc[new_idx]))
+            assert np.allclose(solver.R_inv_G_V, expected.R_inv_G_V)
+            d = np.random.rand(len(new_idx))
+            assert np.allclose(solver.solve(d), expected.solve(d))
+
+    def test_update_obs_network_superobs(self, settings):
+        settings.DA_SOLVER = "direct"
+        settings.SUPEROBS_FACTOR = 2
+        DA = DAPipeline(settings)
+        DA.DA_SVD()
+        with pytest.raises(NotImplementedError):
+            DA.update_obs_network(remove_idx=DA.data["obs_idx"][:1])
+
+        solver = DA.data["direct_solver"]
+        with pytest.raises(NotImplementedError):
+            solver.update_network(DA.data["V_trunc"], DA.data["obs_idx"][1:])
+
+class TestSuperObs():
+    def test_superobs_DA(self, settings):
+        settings.OBS_MODE = "all"
+        settings.DA_SOLVER = "direct"
+        settings.SUPEROBS_FACTOR = 2
+        DA = DAPipeline(settings)
+        data = DA.data
+        assert len(data["d"]) == 5
+        DA_results = DA.DA_SVD()
+
+        #explicit solution with the dense (aggregated) observation operator
+        agg = data["obs_agg"]
+        H = np.asarray(agg) @ np.eye(10)[data["obs_idx"]]
+        G_V = H @ np.asarray(data["V_trunc"])
+        d = H @ (data["u_c"].flatten() - data["u_0"].flatten())
+        R_inv = np.diag(agg.counts / settings.OBS_VARIANCE)
+        A = settings.ALPHA * np.eye(G_V.shape[1]) + G_V.T @ R_inv @ G_V
+        w_opt = np.linalg.solve(A, G_V.T @ R_inv @ d)
+        assert np.allclose(data["d"], d)
+        assert np.allclose(DA_results["w_opt"], w_opt)
+
+        for solver in ["L-BFGS-B", "torch"]:
+            settings.DA_SOLVER = solver
+            assert np.allclose(DA.DA_SVD()["w_opt"], w_opt, atol=1e-5)
+
+        settings.DA_SOLVER = "direct"
+        control_states = data.get("test_X")
+        batch_results = DA.DA_batch(control_states)
+        for idx in [0, 3]:
+            DA_idx = DAPipeline(settings, u_c=control_states[idx])
+            assert np.allclose(batch_results[idx]["w_opt"], DA_idx.DA_SVD()["w_opt"])
+
+    def test_superobs_full_space_AE(self, settings):
+        settings.COMPRESSION_METHOD = "AE"
+        settings.OBS_MODE = "all"
+        settings.SUPEROBS_FACTOR = 3
+        torch.manual_seed(0)
+        DA = DAPipeline(settings, VanillaAE(10, 3, hidden=[8]))
+        data = DA.init_AE()
+        assert len(data["d"]) == 4
+
+        w = random.rand(3)
+        J, _ = cost_and_grad_J(w, data, settings)
+        settings.DA_SOLVER = "torch"
+        J_torch = TorchLBFGS(data, settings).cost(torch.tensor(w, dtype=torch.float),
+                                            torch.tensor(data["d"], dtype=torch.float))
+        assert np.isclose(J, J_torch.item(), rtol=1e-5)
+
+        GN = GaussNewtonSolver(data, settings)
+        assert np.allclose(GN.observe(w), get_H(data) @ data["model"].decode(
+                            torch.tensor(w, dtype=torch.float)).detach().numpy().flatten())
+        assert GN.linearize(w).shape == (4, 3)
+
+class TestRegPath():
+    def test_reg_path(self, settings):
+        DA = DAPipeline(settings)
+        DA.init_SVD()
+        data = DA.data
+        solver = RegPathSolver.from_data(data)
+        assert RegPathSolver.from_data(data) is solver
+
+        D = DA.data.get("test_X")[:, data["obs_idx"]] - data["u_0"][data["obs_idx"]]
+        for alpha, obs_var in [(1.0, 0.5), (0.01, 0.1), (10., 2.)]:
+            G_V = data["G_V"]
+            expected = DirectSolver(G_V, alpha, obs_variance=obs_var).solve(D)
+            assert np.allclose(solver.solve(D, alpha, obs_var), expected)
+            assert np.allclose(solver.solve(D[0], alpha, obs_var), expected[0])
+
+        alphas = np.logspace(-4, 4, 200)
+        path = solver.path(D[0], alphas, 0.5)
+        for idx in [0, 100, 199]:
+            w = solver.solve(D[0], alphas[idx], 0.5)
+            res = np.linalg.norm(data["G_V"] @ w - D[0])
+            assert np.isclose(path["residual_norm"][idx], res)
+            assert np.isclose(path["solution_norm"][idx], np.linalg.norm(w))
+
+        for method in ["gcv", "lcurve"]:
+            alpha, path = solver.select_alpha(D, alphas, 0.5, method)
+            assert alpha in alphas
+        with pytest.raises(ValueError):
+            solver.select_alpha(D, alphas, 0.5, "aic")
+
+        alpha, path = DA.select_alpha(alphas)
+        assert np.array_equal(path["gcv"], solver.path(data["d"], alphas, 0.5)["gcv"])
+
+    def test_reg_path_selection(self):
+        #ill-posed problem with known solution
+        rng = np.random.default_rng(0)
+        n = 60
+        U, _ = np.linalg.qr(rng.standard_normal((n, n)))
+        V, _ = np.linalg.qr(rng.standard_normal((n, n)))
+        s = np.logspace(0, -6, n)
+        A = U @ np.diag(s) @ V.T
+        x = V @ (s ** 0.5 * rng.standard_normal(n))
+        b = A @ x + 1e-3 * rng.standard_normal(n)
+
+        solver = RegPathSolver(A)
+        alphas = np.logspace(-12, 2, 300)
+        err_min = min(np.linalg.norm(solver.solve(b, a, 1.) - x) for a in alphas)
+        err_unreg = np.linalg.norm(solver.solve(b, 1e-12, 1.) - x)
+        for method in ["gcv", "lcurve"]:
+            alpha, _ = solver.select_alpha(b, alphas, 1., method)
+            err = np.linalg.norm(solver.solve(b, alpha, 1.) - x)
+            assert err < 3 * err_min
+            assert err < 0.01 * err_unreg
+
+class TestSweep():
+    def test_sweep(self, tmpdir, settings):
+        sweep = DASweep(settings)
+        control_states = sweep.control_states
+        grid = {"NUMBER_MODES": [1, 3], "NOBS": [3, 6], "ALPHA": [0.1, 1.0]}
+        df = sweep.run(grid, num_workers=2)
+
+        assert len(df) == 8 * len(control_states)
+        assert set(df.columns) >= {"NUMBER_MODES", "NOBS", "OBS_VARIANCE", "ALPHA",
+                                    "state_idx", "da_MAE_mean", "percent_improvement"}
+        assert (df["OBS_VARIANCE"] == settings.OBS_VARIANCE).all()
+
+        #compare with the (direct) DAPipeline at each grid point
+        for (k, nobs, alpha), df_pt in df.groupby(["NUMBER_MODES", "NOBS", "ALPHA"]):
+            settings_pt = small_settings(tmpdir.mkdir("{}_{}_{}".format(k, nobs, alpha)))
+            settings_pt.NUMBER_MODES, settings_pt.NOBS, settings_pt.ALPHA = k, nobs, alpha
+            settings_pt.DA_SOLVER = "direct"
+            results = DAPipeline(settings_pt).DA_batch(control_states)
+            assert np.allclose(df_pt["da_MAE_mean"], [r["da_MAE_mean"] for r in results])
+            assert np.allclose(df_pt["mse_DA"], [r["mse_DA"] for r in results])
+
+        with pytest.raises(ValueError):
+            sweep.run({"NOBS": [3], "OBS_FRAC": [0.5]})
+        with pytest.raises(ValueError, match="NUMBER_MODES"):
+            sweep.run({"NUMBER_MODES": [3, 11]}) #only min(n, M) = 10 modes
+
+        #a single network is still split into one task per grid point
+        df_1 = sweep.run({"NOBS": [6], "NUMBER_MODES": [1, 3], "ALPHA": [0.1, 1.0]}, num_workers=4)
+        df_6 = df[df["NOBS"] == 6].reset_index(drop=True)
+        assert np.allclose(df_1["mse_DA"], df_6["mse_DA"])
+
+    def test_sweep_superobs(self, tmpdir, settings):
+        settings.SUPEROBS_FACTOR = 2
+        sweep = DASweep(settings)
+        sweep.CHUNK_SZ = 3 #more than one chunk
+        control_states = sweep.control_states
+        df = sweep.run({"NOBS": [6], "OBS_VARIANCE": [0.1, 0.5]})
+
+        for obs_var, df_pt in df.groupby("OBS_VARIANCE"):
+            settings_pt = small_settings(tmpdir.mkdir("var{}".format(obs_var)))
+            settings_pt.SUPEROBS_FACTOR = 2
+            settings_pt.NOBS, settings_pt.OBS_VARIANCE = 6, obs_var
+            settings_pt.DA_SOLVER = "direct"
+            results = DAPipeline(settings_pt).DA_batch(control_states)
+            assert np.allclose(df_pt["mse_DA"], [r["mse_DA"] for r in results])
+
+class TestOperators():
+    def test_obs_operator_matches_dense(self):
+        n = 7
+        obs_idx = [5, 1, 1, 3]
+        H = VDAInit.create_H(obs_idx, n, len(obs_idx))
+        H_dense = np.asarray(H)
+        x = random.rand(n)
+        X = random.rand(n, 3)
+        y = random.rand(len(obs_idx))
+
+        assert np.allclose(H @ x, H_dense @ x)
+        assert np.allclose(H @ X, H_dense @ X)
+        assert np.allclose(H.T @ y, H_dense.T @ y) #scatter-add of repeated idx
+        assert np.allclose(y @ H, y @ H_dense)
+
+    def test_R_inv_per_sensor(self):
+        nobs = 4
+        sigma = np.array([0.1, 0.2, 0.5, 1.0])
+        R_inv = VDAInit.create_R_inv(sigma, nobs)
+        R_inv_dense = np.diag(1 / sigma ** 2)
+        Q = random.rand(nobs)
+        Q_batch = random.rand(3, nobs)
+
+        assert np.allclose(np.asarray(R_inv), R_inv_dense)
+        assert np.allclose(R_inv @ Q, R_inv_dense @ Q)
+        assert np.allclose(Q_batch @ R_inv, Q_batch @ R_inv_dense)
+
+        R_inv_scalar = VDAInit.create_R_inv(0.5, nobs)
+        assert np.allclose(np.asarray(R_inv_scalar), 4 * np.eye(nobs))
+
+    def test_superobs_operator(self):
+        n = (4, 4, 2)
+        obs_idx = np.array([0, 1, 4, 5, 10, 31])
+        agg = SuperObs.from_bins(obs_idx, n, 2)
+        coords = np.stack(np.unravel_index(obs_idx, n), axis=1) // 2
+        assert agg.shape == (len(np.unique(coords, axis=0)), len(obs_idx))
+        assert agg.counts.sum() == len(obs_idx)
+
+        H = ObsOperator(obs_idx, 32, agg)
+        H_dense = np.asarray(agg) @ np.asarray(ObsOperator(obs_idx, 32))
+        x = random.rand(32)
+        y = random.rand(agg.shape[0])
+        assert np.allclose(np.asarray(H), H_dense)
+        assert np.allclose(H @ x, H_dense @ x)
+        assert np.allclose(H.T @ y, H_dense.T @ y)
+        assert np.allclose(agg.variance(0.5), 0.5 / agg.counts)
+        var = random.rand(len(obs_idx))
+        assert np.allclose(agg.variance(var), (np.asarray(agg) ** 2) @ var)
+
+        U, _ = np.linalg.qr(random.rand(len(obs_idx), 2))
+        A = LowRankOperator(U, np.array([2., 1.]), np.eye(2))
+        assert np.allclose(np.asarray(agg @ A), np.asarray(agg) @ np.asarray(A))
+
+        agg = SuperObs.from_clusters(np.array([9, 2, 5, 7, 1]), 10, 2)
+        assert np.array_equal(agg.groups, [2, 0, 1, 1, 0])
+
+        #clusters are spatial neighbours (not neighbours in flat index order)
+        shape = (16, 16, 4)
+        obs_idx = np.sort(random.choice(np.prod(shape), 200, replace=False))
+        agg = SuperObs.from_clusters(obs_idx, shape, 4)
+        assert agg.shape[0] == 50 and (agg.counts == 4).all()
+        coords = np.stack(np.unravel_index(obs_idx, shape), axis=1)
+        for g in range(agg.shape[0]):
+            c = coords[agg.groups == g]
+            assert (c.max(axis=0) - c.min(axis=0)).max() <= 8
+        consecutive = coords.reshape((50, 4, 3))
+        assert (np.ptp(consecutive, axis=1).max(axis=1) > 8).any()
+
+    def test_low_rank_operator(self):
+        U, _ = np.linalg.qr(random.rand(8, 3))
+        W, _ = np.linalg.qr(random.rand(6, 3))
+        s = np.array([3., 2., 0.5])
+        A = LowRankOperator(U, s, W.T)
+        A_dense = np.asarray(A)
+        x = random.rand(6)
+        X = random.rand(6, 4)
+        y = random.rand(2, 8)
+        obs_idx = [7, 0, 3]
+
+        assert A.shape == (8, 6) and A.T.shape == (6, 8)
+        assert np.allclose(A @ x, A_dense @ x)
+        assert np.allclose(A @ X, A_dense @ X)
+        assert np.allclose(y @ A, y @ A_dense)
+        assert np.allclose(A.T @ y.T, A_dense.T @ y.T)
+        assert np.allclose(np.asarray(A[obs_idx]), A_dense[obs_idx])
+        assert np.allclose(np.asarray(A.pinv()), np.linalg.pinv(A_dense))
+
+    def test_direct_solver_low_rank(self):
+        U, _ = np.linalg.qr(random.rand(8, 3))
+        W, _ = np.linalg.qr(random.rand(6, 3))
+        G_V = LowRankOperator(U, np.array([3., 2., 0.5]), W.T)
+        D = random.rand(2, 8)
+
+        solver = DirectSolver(G_V, 0.7, obs_variance=0.5)
+        solver_dense = DirectSolver(np.asarray(G_V), 0.7, obs_variance=0.5)
+
+        assert solver.L.shape == (3, 3)
+        assert np.allclose(solver.solve(D), solver_dense.solve(D))
+        assert np.allclose(solver.solve(D[0]), solver_dense.solve(D[0]))
+
 
 if __name__ == "__main__":
     pytest.main()